@@ -0,0 +1,387 @@
+"""
+Execution engines for AutoPWN.
+
+An engine takes the list of services to attack and decides how they get
+dispatched to the protocol functions. Every engine hands each
+:py:class:`~flag_slurper.autolib.service.Result` to a callback on the calling
+thread, so printing and bookkeeping never have to be thread-safe.
+
+If the callback returns a timestamp, the service is attacked again once that
+time has passed. A callback that always does keeps the engine (and its
+workers) running forever, which is how the AutoPWN daemon works.
+
+The pool and async engines also take a ``deadline``, a hard limit on how
+long a single service may take. A service that hasn't finished by then gets
+a timed out result instead of holding up the run. The attack itself can't
+be interrupted, so its worker stays busy until the protocol's own timeouts
+fire. Whatever it eventually returns isn't reported or rescheduled, but is
+handed to ``on_late`` so what it found can still be recorded.
+
+An attack that raises is logged and handed to the callback as a failed
+result, so one broken host or plugin can't end the run.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import partial
+from multiprocessing import Pool
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from .models import Service
+from .service import Result
+
+logger = logging.getLogger(__name__)
+
+PwnFunc = Callable[[Service], Result]
+ResultCallback = Callable[[Result], Optional[float]]
+LateCallback = Optional[Callable[[Result], None]]
+StartTimes = Optional[Dict[int, float]]
+
+
+class Recheck:
+    """
+    Decides how long to wait before attacking a service again.
+
+    A service whose result just changed (a credential started or stopped
+    working) is checked again after ``min_interval``. Each failure in a row
+    doubles the wait up to ``max_interval``, so hardened services are left
+    alone while ones that keep working hold their pace. Services that were
+    skipped wait ``max_interval``, and ones that timed out are retried after
+    ``min_interval``.
+    """
+
+    def __init__(self, min_interval: float, max_interval: float):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+    def interval(self, result: Result, previous_interval: Optional[float] = None,
+                 previous_success: Optional[bool] = None) -> float:
+        if result.timed_out:
+            # It never got a fair attempt, so don't count it as a failure
+            return self.min_interval
+        if result.skipped:
+            return self.max_interval
+        if previous_interval is None or previous_success != result.success:
+            return self.min_interval
+        if result.success:
+            return min(max(previous_interval, self.min_interval), self.max_interval)
+        return min(previous_interval * 2, self.max_interval)
+
+
+class Progress:
+    """
+    Tracks how far through a run we are, for the live progress line.
+
+    >>> progress = Progress(40)
+    >>> progress.advance()
+    >>> str(progress)
+    ... '1/40 done, 0.5/s, ETA 0:01:18'
+    """
+
+    def __init__(self, total: int, clock: Callable[[], float] = time.monotonic):
+        self.total = total
+        self.done = 0
+        self.clock = clock
+        self.started = clock()
+
+    def advance(self, count: int = 1):
+        self.done += count
+
+    @property
+    def elapsed(self) -> float:
+        return self.clock() - self.started
+
+    @property
+    def rate(self) -> float:
+        """
+        Completed services per second.
+        """
+        elapsed = self.elapsed
+        if elapsed <= 0:
+            return 0.0
+        return self.done / elapsed
+
+    @property
+    def eta(self) -> Optional[float]:
+        """
+        Estimated seconds until the run finishes, or None until the first result.
+        """
+        rate = self.rate
+        if not rate:
+            return None
+        return (self.total - self.done) / rate
+
+    def __str__(self):
+        eta = self.eta
+        eta = '?' if eta is None else str(timedelta(seconds=int(eta)))
+        return '{}/{} done, {:.1f}/s, ETA {}'.format(self.done, self.total, self.rate, eta)
+
+
+class Schedule:
+    """
+    The services waiting to be attacked, ordered by when they may next be attacked.
+
+    Services start out ready in the order given. A service the governor
+    deferred is pushed back with its ``not_before`` time, so only that service
+    waits while services on other hosts keep being attacked.
+    """
+
+    def __init__(self, services: Iterable[Service] = (), clock: Callable[[], float] = time.time,
+                 start: StartTimes = None):
+        self.clock = clock
+        self._heap = []
+        self._counter = itertools.count()
+        for service in services:
+            self.push(service, start.get(service.id, 0.0) if start else 0.0)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, service: Service, not_before: float = 0.0, resume: Optional[dict] = None):
+        # The counter keeps services with the same time in the order they were pushed
+        heapq.heappush(self._heap, (not_before, next(self._counter), service, resume))
+
+    def pop_ready(self) -> Optional[Tuple[Service, Optional[dict]]]:
+        """
+        Take the next service that may be attacked now, if any.
+
+        :return: The service and its resume state, or None if nothing is ready
+        """
+        if not self._heap or self._heap[0][0] > self.clock():
+            return None
+        _, _, service, resume = heapq.heappop(self._heap)
+        return service, resume
+
+    def wait_time(self) -> Optional[float]:
+        """
+        How many seconds until the next service is ready, or None if there is nothing scheduled.
+        """
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - self.clock())
+
+
+def _call(func: PwnFunc, service: Service, resume: Optional[dict]) -> Result:
+    if resume is None:
+        return func(service)
+    return func(service, resume=resume)
+
+
+def _failed(service: Service, error: BaseException) -> Result:
+    logger.error("Attacking %s:%d raised %r", service.service_url, service.service_port, error,
+                 exc_info=(type(error), error, error.__traceback__))
+    return Result.error(service, error)
+
+
+def _handle(schedule: Schedule, service: Service, result: Result, callback: ResultCallback):
+    if result.deferred:
+        logger.info("%s", result)
+        schedule.push(service, result.not_before, result.resume)
+        return
+
+    again = callback(result)
+    if again is not None:
+        schedule.push(service, again)
+
+
+def run_serial(func: PwnFunc, services: Iterable[Service], callback: ResultCallback, start: StartTimes = None):
+    """
+    Run ``func`` against every service, one at a time.
+
+    :param func: Called with each service, must return a ``Result``
+    :param services: The services to attack
+    :param callback: Called with each ``Result`` as it completes
+    :param start: When to first attack each service, by service id. Other services are attacked straight away.
+    """
+    schedule = Schedule(services, start=start)
+    while schedule:
+        job = schedule.pop_ready()
+        if not job:
+            time.sleep(schedule.wait_time())
+            continue
+
+        service, resume = job
+        try:
+            result = _call(func, service, resume)
+        except Exception as error:
+            result = _failed(service, error)
+        _handle(schedule, service, result, callback)
+
+
+Running = Dict[int, Tuple[Service, float]]
+
+
+def _put(completed: queue.Queue, job: int, result):
+    completed.put((job, result))
+
+
+def _wait_time(schedule: Optional[Schedule], running: Running, deadline: Optional[float]) -> Optional[float]:
+    """
+    How long to wait for a result before the next service is ready or a running one runs out of time.
+
+    :param schedule: The services waiting to be attacked, or None if no worker is free to attack them
+    """
+    waits = [schedule.wait_time()] if schedule is not None else []
+    if deadline is not None:
+        now = time.monotonic()
+        waits.extend(started + deadline - now for _, started in running.values())
+    waits = [wait for wait in waits if wait is not None]
+    return max(0.0, min(waits)) if waits else None
+
+
+def _overdue(running: Running, deadline: Optional[float]) -> List[int]:
+    """
+    The jobs that have run past the deadline.
+    """
+    if deadline is None:
+        return []
+    now = time.monotonic()
+    return [job for job, (_, started) in running.items() if now - started >= deadline]
+
+
+def _late(on_late: LateCallback, service: Service, result):
+    if isinstance(result, BaseException):
+        logger.error("Attacking %s:%d raised %r after its deadline", service.service_url, service.service_port,
+                     result, exc_info=(type(result), result, result.__traceback__))
+        return
+    logger.info("Result arrived after its deadline: %s", result)
+    if on_late is not None:
+        on_late(result)
+
+
+def run_pool(func: PwnFunc, services: Iterable[Service], callback: ResultCallback, processes: int,
+             start: StartTimes = None, deadline: Optional[float] = None, on_late: LateCallback = None):
+    """
+    Run ``func`` against every service in a multiprocessing pool.
+
+    Results are streamed back in completion order, so a single hung host
+    only holds back its own result instead of the whole run. Services are only
+    handed to the pool when a worker is free, so the deadline is measured from
+    when the attack actually starts.
+
+    :param func: Called with each service, must return a ``Result``. This must be picklable.
+    :param services: The services to attack
+    :param callback: Called with each ``Result`` as it completes
+    :param processes: The number of worker processes
+    :param start: When to first attack each service, by service id. Other services are attacked straight away.
+    :param deadline: How many seconds a service may take before it is given up on
+    :param on_late: Called on the calling thread with the result of a service that was given up on, once it arrives
+    """
+    schedule = Schedule(services, start=start)
+    completed = queue.Queue()
+    running: Running = {}
+    # Jobs that were given up on but are still tying up a worker
+    stuck: Dict[int, Service] = {}
+    jobs = itertools.count()
+
+    with Pool(processes=processes) as pool:
+        while schedule or running:
+            while len(running) + len(stuck) < processes:
+                job = schedule.pop_ready()
+                if not job:
+                    break
+                service, resume = job
+                kwds = {} if resume is None else {'resume': resume}
+                job_id = next(jobs)
+                put = partial(_put, completed, job_id)
+                running[job_id] = (service, time.monotonic())
+                pool.apply_async(func, (service,), kwds, callback=put, error_callback=put)
+
+            free = len(running) + len(stuck) < processes
+            try:
+                job_id, result = completed.get(timeout=_wait_time(schedule if free else None, running, deadline))
+            except queue.Empty:
+                pass
+            else:
+                if job_id in stuck:
+                    _late(on_late, stuck.pop(job_id), result)
+                else:
+                    service, _ = running.pop(job_id)
+                    if isinstance(result, BaseException):
+                        result = _failed(service, result)
+                    _handle(schedule, service, result, callback)
+
+            for job_id in _overdue(running, deadline):
+                service, _ = running.pop(job_id)
+                stuck[job_id] = service
+                _handle(schedule, service, Result.timeout(service, deadline), callback)
+
+
+def run_async(func: PwnFunc, services: Iterable[Service], callback: ResultCallback, concurrency: int = 64,
+              start: StartTimes = None, deadline: Optional[float] = None, on_late: LateCallback = None):
+    """
+    Run ``func`` against every service from an asyncio event loop.
+
+    Paramiko and the other protocol libraries are blocking, so each attack is
+    shimmed onto a thread executor. Almost all of the time is spent waiting on
+    the network, which lets a single process keep far more services in flight
+    than the multiprocessing pool.
+
+    As with the pool, a service that was given up on keeps its slot until its
+    thread returns, and the deadline is measured from when the attack
+    actually starts.
+
+    :param func: Called with each service, must return a ``Result``
+    :param services: The services to attack
+    :param callback: Called with each ``Result`` as it completes
+    :param concurrency: The maximum number of services attacked at once
+    :param start: When to first attack each service, by service id. Other services are attacked straight away.
+    :param deadline: How many seconds a service may take before it is given up on
+    :param on_late: Called on the calling thread with the result of a service that was given up on, once it arrives
+    """
+    if concurrency < 1:
+        raise ValueError('concurrency must be at least 1')
+    asyncio.run(_run_async(func, list(services), callback, concurrency, start, deadline, on_late))
+
+
+def _call_started(loop: asyncio.AbstractEventLoop, started: asyncio.Future, func: PwnFunc, service: Service,
+                  resume: Optional[dict]) -> Result:
+    loop.call_soon_threadsafe(started.set_result, None)
+    return _call(func, service, resume)
+
+
+async def _run_async(func: PwnFunc, services: list, callback: ResultCallback, concurrency: int,
+                     start: StartTimes, deadline: Optional[float], on_late: LateCallback):
+    loop = asyncio.get_event_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='autopwn') as executor:
+        async def _pwn(service: Service):
+            resume = None
+            not_before = start.get(service.id, 0.0) if start else 0.0
+            while not_before is not None:
+                # Only this service waits, its slot goes to the next service
+                await asyncio.sleep(max(0.0, not_before - time.time()))
+                await semaphore.acquire()
+                started = loop.create_future()
+                attack = loop.run_in_executor(executor, _call_started, loop, started, func, service, resume)
+                # The slot is only freed once the thread returns, even if we stop waiting for it
+                attack.add_done_callback(lambda _: semaphore.release())
+                try:
+                    await started
+                    # Shielded so giving up on the attack doesn't mark it done while its thread is still running
+                    result = await asyncio.wait_for(asyncio.shield(attack), deadline)
+                except asyncio.TimeoutError:
+                    resume, not_before = None, callback(Result.timeout(service, deadline))
+                    try:
+                        late = await attack
+                    except Exception as error:
+                        late = error
+                    _late(on_late, service, late)
+                    continue
+                except Exception as error:
+                    result = _failed(service, error)
+
+                if result.deferred:
+                    logger.info("%s", result)
+                    resume, not_before = result.resume, result.not_before
+                else:
+                    # The callback runs on the event loop, which is the calling thread
+                    resume, not_before = None, callback(result)
+
+        await asyncio.gather(*[_pwn(service) for service in services])
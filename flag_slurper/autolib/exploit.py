@@ -74,6 +74,32 @@ def get_file(ssh: paramiko.SSHClient, file: str, sudo: SUDO_OPT = None) -> Union
     return stdout.read()
 
 
+def get_archive(ssh: paramiko.SSHClient, paths: List[str], sudo: SUDO_OPT = None) -> Optional[bytes]:
+    """
+    Retrieve many files and directories from the remote server in a single gzipped tar stream.
+
+    Wildcards are expanded by the remote shell and directories are archived
+    recursively. Paths that don't exist or can't be read are left out of the
+    archive rather than failing the whole transfer.
+
+    :param ssh: The current ssh session to use
+    :param paths: The full paths to retrieve
+    :param sudo: The sudo password to use if the current session can sudo
+    :return: The gzipped tar archive, or None if nothing could be archived
+    """
+    command = 'tar czf - --ignore-failed-read {} 2>/dev/null'.format(' '.join(paths))
+    if sudo:
+        logger.debug("Using sudo")
+        _, stdout, _ = run_sudo(ssh, command, sudo)
+    else:
+        _, stdout, _ = ssh.exec_command(command)
+
+    archive = stdout.read()
+    if not archive:
+        return None
+    return archive
+
+
 def get_directory(ssh: paramiko.SSHClient, path: str, sudo: Optional[str] = None) -> Union[List[str], bool]:
     """
     Retrieve a directory listing on a remote server.
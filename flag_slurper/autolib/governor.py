@@ -1,13 +1,172 @@
 import logging
+import os
 import socket
+import sqlite3
+import threading
 import time
-from collections import defaultdict
-from datetime import datetime, timedelta
-from typing import Optional
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple, Iterable, Dict
 
 logger = logging.getLogger(__name__)
 
 
+class Throttled(Exception):
+    """
+    Raised when the governor will not allow an attempt yet.
+
+    The attempt should be rescheduled for ``not_before`` (a unix timestamp)
+    instead of blocking the worker.
+    """
+
+    def __init__(self, ipaddr: str, not_before: float):
+        super().__init__('{} is throttled until {}'.format(ipaddr, time.ctime(not_before)))
+        self.ipaddr = ipaddr
+        self.not_before = not_before
+
+
+def throttle(count: int, slot: Optional[float], now: float, times: int,
+             delay: int) -> Tuple[Optional[float], Optional[float]]:
+    """
+    Decide whether an attempt may go ahead.
+
+    The first ``times`` attempts inside the window are free. After that,
+    attempts are spaced ``delay`` seconds apart until the window drains.
+
+    :param count: The number of attempts already inside the window
+    :param slot: When the next attempt over the limit may happen, if limited
+    :param now: The current unix timestamp
+    :param times: The number of attempts allowed inside the window
+    :param delay: How far apart attempts over the limit are spaced
+    :return: The time the attempt may not happen before (None if it may go ahead), and the new slot
+    """
+    if count < times:
+        return None, None
+    if slot is None:
+        return now + delay, now + delay
+    if now < slot:
+        return slot, slot
+    return None, now + delay
+
+
+class GovernorStore:
+    """
+    A SQLite backed attempt log shared by every process using the same file.
+
+    Each process (and thread) opens its own connection, so the store can be
+    inherited by forked pool workers. Attempts are recorded with wall clock
+    timestamps so they survive across invocations.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        if getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS attempts (ipaddr TEXT NOT NULL, ts REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS attempts_ipaddr_ts ON attempts (ipaddr, ts)')
+            conn.execute('CREATE TABLE IF NOT EXISTS slots (ipaddr TEXT PRIMARY KEY, not_before REAL NOT NULL)')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    def acquire(self, ipaddr: str, window: int, times: int, delay: int) -> Optional[float]:
+        """
+        Attempt to take a slot for the given ip address.
+
+        :param ipaddr: The ip address being attempted
+        :param window: How far back (in seconds) attempts are counted
+        :param times: The number of attempts allowed inside the window
+        :param delay: How far apart attempts over the limit are spaced
+        :return: None if the attempt may go ahead, otherwise the time it may not happen before
+        """
+        now = time.time()
+        conn = self._connection()
+        # IMMEDIATE takes the write lock up front, so concurrent workers can't
+        # both count the same window and go over the limit.
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM attempts WHERE ipaddr = ? AND ts <= ?', (ipaddr, now - window))
+            count, = conn.execute('SELECT COUNT(*) FROM attempts WHERE ipaddr = ?', (ipaddr,)).fetchone()
+            row = conn.execute('SELECT not_before FROM slots WHERE ipaddr = ?', (ipaddr,)).fetchone()
+
+            not_before, slot = throttle(count, row[0] if row else None, now, times, delay)
+            if not_before is None:
+                conn.execute('INSERT INTO attempts (ipaddr, ts) VALUES (?, ?)', (ipaddr, now))
+            if slot is None:
+                conn.execute('DELETE FROM slots WHERE ipaddr = ?', (ipaddr,))
+            else:
+                conn.execute('INSERT OR REPLACE INTO slots (ipaddr, not_before) VALUES (?, ?)', (ipaddr, slot))
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return not_before
+
+
+class ResolverCache:
+    """
+    A TTL bounded cache of hostname resolutions.
+
+    Failed resolutions are cached as well (for ``negative_ttl``), so an
+    unresolvable host isn't looked up again for every credential. The cache
+    lives on the class of :py:class:`Governor` so it is shared by every
+    thread, and pool workers inherit whatever was resolved before they
+    were forked.
+    """
+
+    def __init__(self, ttl: int = 5 * 60, negative_ttl: int = 60):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # Dict[hostname, (ipaddr, monotonic expiry)]
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def resolve(self, hostname: str) -> Optional[str]:
+        """
+        Resolve a hostname, using the cache when possible.
+
+        :param hostname: The hostname to resolve
+        :return: The ip address, or None if it could not be resolved
+        """
+        entry = self.cache.get(hostname)
+        if entry and entry[1] > time.monotonic():
+            return entry[0]
+
+        try:
+            ipaddr = socket.gethostbyname(hostname)
+            ttl = self.ttl
+        except socket.gaierror:
+            logger.warning("Failed to resolve url: %s", hostname)
+            ipaddr = None
+            ttl = self.negative_ttl
+
+        with self.lock:
+            self.cache[hostname] = (ipaddr, time.monotonic() + ttl)
+        return ipaddr
+
+    def resolve_all(self, hostnames: Iterable[str], workers: int = 32) -> Dict[str, Optional[str]]:
+        """
+        Resolve many hostnames concurrently, warming the cache.
+
+        :param hostnames: The hostnames to resolve
+        :param workers: How many lookups to run at once
+        :return: Each hostname mapped to its ip address (or None)
+        """
+        hostnames = list(set(hostnames))
+        if not hostnames:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(workers, len(hostnames))) as executor:
+            return dict(zip(hostnames, executor.map(self.resolve, hostnames)))
+
+
 class Governor:
     """
     The governor tracks the number of connections over time
@@ -15,26 +174,37 @@ class Governor:
 
     This can be configured in the flagrc.
 
-    .. warning::
-
-       The governor only tracks withing it's worker process, for a single run.
-       It **DOES NOT** persist across invocations.
+    When the project has a ``store`` configured, attempts are tracked in a
+    :py:class:`GovernorStore` that is shared by every worker process and
+    persists across invocations. Otherwise the governor only tracks within
+    its worker process, for a single run.
 
     * ``autopwn->governor`` (default false) whether the governor is enabled.
-    * ``autopwn->delay`` (default 5m) how long to wait after limiting.
+    * ``autopwn->delay`` (default 5m) how far apart attempts over the limit are spaced.
     * ``autopwn->window`` (default 30m) the window to track attempts in.
     * ``autopwn->times`` (default 3) max attempts inside of the window.
+    * ``autopwn->governor_store`` (default ``{{ project }}/governor.sqlite3``) the shared attempt log. Leave this
+      empty to only track attempts in memory.
+    * ``autopwn->dns_ttl`` (default 5m) how long resolved hostnames are cached.
+    * ``autopwn->dns_negative_ttl`` (default 1m) how long failed resolutions are cached.
     """
     instance = None
+    resolver = ResolverCache()
 
-    def __init__(self, enabled: bool, delay: int = 5 * 60, window: int = 30 * 60, times: int = 3):
+    def __init__(self, enabled: bool, delay: int = 5 * 60, window: int = 30 * 60, times: int = 3,
+                 store: Optional[GovernorStore] = None):
         self.enabled = enabled
         self.delay = delay
         self.window = window
         self.times = times
+        self.store = store
 
-        # Dict[IP, timestamp]
-        self.limits = defaultdict(list)
+        # Dict[IP, deque of monotonic timestamps, oldest first]
+        self.limits = defaultdict(deque)
+        # Dict[IP, unix timestamp of the next attempt allowed over the limit]
+        self.slots = {}
+        self.lock = threading.Lock()
+        self.last_sweep = time.monotonic()
 
     @classmethod
     def get_instance(cls, enabled: Optional[bool] = False, delay: Optional[int] = 5 * 60,
@@ -43,28 +213,78 @@ class Governor:
             Governor.instance = cls(enabled, delay, window, times)
         return Governor.instance
 
-    def filter(self, ipaddr: str):
-        def _filter(x: datetime):
-            return x > datetime.now() - timedelta(seconds=self.window)
+    def filter(self, ipaddr: str, now: Optional[float] = None):
+        """
+        Drop attempts against the ip address that have left the window.
 
-        self.limits[ipaddr] = list(filter(_filter, self.limits[ipaddr]))
+        Attempts are appended in order, so expired ones are always on the left.
 
-    def attempt(self, ipaddr: str):
+        :param ipaddr: The ip address to filter
+        :param now: The current monotonic time, if the caller already has it
+        """
+        if now is None:
+            now = time.monotonic()
+        cutoff = now - self.window
+        attempts = self.limits[ipaddr]
+        while attempts and attempts[0] <= cutoff:
+            attempts.popleft()
+
+    def sweep(self):
+        """
+        Forget ip addresses that have no attempts left in the window.
+
+        Over a multi-day competition this keeps ``limits`` from holding every
+        ip address ever attempted. This runs automatically at most once per
+        window from :py:meth:`attempt`.
+        """
+        now = time.monotonic()
+        with self.lock:
+            for ipaddr in list(self.limits):
+                self.filter(ipaddr, now)
+                # With an empty window the slot no longer applies either
+                if not self.limits[ipaddr]:
+                    del self.limits[ipaddr]
+                    self.slots.pop(ipaddr, None)
+            self.last_sweep = now
+
+    def attempt(self, ipaddr: str) -> Optional[float]:
+        """
+        Record an attempt against the given ip address.
+
+        This never blocks. When the ip address is over its limit the attempt
+        is not recorded, and the caller should try again once the returned
+        time has passed.
+
+        :param ipaddr: The ip address about to be attempted
+        :return: None if the attempt may go ahead, otherwise the unix timestamp it may not happen before
+        """
         if not ipaddr:
-            return
+            return None
         if not self.enabled:
-            return
+            return None
+
+        if self.store:
+            not_before = self.store.acquire(ipaddr, self.window, self.times, self.delay)
+        else:
+            now = time.monotonic()
+            if now - self.last_sweep > self.window:
+                self.sweep()
+
+            with self.lock:
+                self.filter(ipaddr, now)
+                not_before, slot = throttle(len(self.limits[ipaddr]), self.slots.get(ipaddr), time.time(),
+                                            self.times, self.delay)
+                if not_before is None:
+                    self.limits[ipaddr].append(now)
+                if slot is None:
+                    self.slots.pop(ipaddr, None)
+                else:
+                    self.slots[ipaddr] = slot
 
-        self.filter(ipaddr)
-        self.limits[ipaddr].append(datetime.now())
-        if len(self.limits[ipaddr]) > self.times:
-            logger.info("Attempting %d second delay for %s", self.delay, ipaddr)
-            time.sleep(self.delay)
+        if not_before is not None:
+            logger.info("Delaying attempts against %s until %s", ipaddr, time.ctime(not_before))
+        return not_before
 
     @staticmethod
-    def resolve_url(url: str) -> str:
-        try:
-            return socket.gethostbyname(url)
-        except socket.gaierror:
-            logger.warning("Failed to resolve url: %s", url)
-            return None
+    def resolve_url(url: str) -> Optional[str]:
+        return Governor.resolver.resolve(url)
@@ -1,6 +1,7 @@
 import click
 import peewee
 import playhouse.db_url
+from playhouse.migrate import SchemaMigrator, migrate
 
 # We want to allow setting up the database connection from .flagrc
 database_proxy = peewee.Proxy()
@@ -8,8 +9,13 @@ SUDO_FLAG = click.style('!', fg='red', bold=True)
 
 
 def initialize(database_url: str):
-    database = playhouse.db_url.connect(database_url)
+    if database_url.startswith('sqlite'):
+        # WAL lets the attack workers keep reading while results are committed
+        database = playhouse.db_url.connect(database_url, pragmas={'journal_mode': 'wal'})
+    else:
+        database = playhouse.db_url.connect(database_url)
     database_proxy.initialize(database)
+    upgrade(database)
 
 
 class BaseModel(peewee.Model):
@@ -29,7 +35,7 @@ class CredentialBag(BaseModel):
 class Team(BaseModel):
     id = peewee.IntegerField(primary_key=True)
     name = peewee.CharField(max_length=200)
-    number = peewee.IntegerField()
+    number = peewee.IntegerField(index=True)
     domain = peewee.CharField(max_length=200)
 
 
@@ -37,7 +43,7 @@ class Service(BaseModel):
     id = peewee.AutoField(primary_key=True)
     remote_id = peewee.IntegerField(unique=True, null=True)
     service_id = peewee.IntegerField(null=True)
-    service_name = peewee.CharField(max_length=100)
+    service_name = peewee.CharField(max_length=100, index=True)
     service_port = peewee.SmallIntegerField()
     service_url = peewee.CharField(max_length=100)
     admin_status = peewee.CharField(choices=['DOWN', 'CAPPED'], null=True)
@@ -45,16 +51,23 @@ class Service(BaseModel):
     low_target = peewee.IntegerField(null=True)
     is_rand = peewee.BooleanField(default=False)
     team = peewee.ForeignKeyField(Team, backref='services', on_delete='CASCADE')
+    protocol = peewee.CharField(max_length=20, null=True, help_text="The protocol detected from the service's banner")
 
 
 class Credential(BaseModel):
     WORKS = 'works'
     REJECT = 'reject'
     id = peewee.AutoField(primary_key=True)
-    state = peewee.CharField(choices=[WORKS, REJECT])
+    state = peewee.CharField(choices=[WORKS, REJECT], index=True)
     bag = peewee.ForeignKeyField(CredentialBag, backref='credentials', on_delete='CASCADE')
     service = peewee.ForeignKeyField(Service, backref='credentials', on_delete='CASCADE')
     sudo = peewee.BooleanField(default=False)
+    checked = peewee.DateTimeField(null=True, help_text="When the credential was last tried against the service")
+
+    class Meta:
+        indexes = (
+            (('bag', 'service'), True),
+        )
 
     def __str__(self):
         flags = ""
@@ -81,6 +94,11 @@ class CaptureNote(BaseModel):
     searched = peewee.BooleanField(default=False)
     used_creds = peewee.ForeignKeyField(Credential, backref='captures', on_delete='CASCADE', null=True)
 
+    class Meta:
+        indexes = (
+            (('flag', 'service', 'location'), False),
+        )
+
     def __str__(self):
         flags = ""
 
@@ -98,6 +116,11 @@ class File(BaseModel):
     info = peewee.TextField(null=True, help_text="Output of `file`")
     service = peewee.ForeignKeyField(Service, backref='files', on_delete='CASCADE')
 
+    class Meta:
+        indexes = (
+            (('service', 'path'), True),
+        )
+
 
 class DNSResult(BaseModel):
     id = peewee.AutoField(primary_key=True)
@@ -121,9 +144,108 @@ class ShadowEntry(BaseModel):
     hash = peewee.TextField()
 
 
+class ServiceSchedule(BaseModel):
+    service = peewee.ForeignKeyField(Service, primary_key=True, backref='schedule', on_delete='CASCADE')
+    next_check = peewee.DateTimeField()
+    interval = peewee.IntegerField(help_text="Seconds between checks")
+    success = peewee.BooleanField(null=True, help_text="Whether the last check succeeded")
+
+
+class ServiceStatus(BaseModel):
+    service = peewee.ForeignKeyField(Service, primary_key=True, backref='status', on_delete='CASCADE')
+    up = peewee.BooleanField(help_text="Whether the port accepted a connection")
+    checked = peewee.DateTimeField()
+
+
 def create():  # pragma: no cover
     database_proxy.create_tables([CredentialBag, Team, Service, Credential, Flag, CaptureNote, File, DNSResult, Key,
-                                  ShadowEntry])
+                                  ShadowEntry, ServiceSchedule, ServiceStatus])
+
+
+#: Columns added after their table was first released, as (model, column, field)
+COLUMNS = [
+    (Credential, 'checked', peewee.DateTimeField(null=True)),
+    (Service, 'protocol', peewee.CharField(max_length=20, null=True)),
+]
+
+
+#: Indexes added after their table was first released, as (model, columns, unique)
+INDEXES = [
+    (Team, ('number',), False),
+    (Service, ('service_name',), False),
+    (Credential, ('bag_id', 'service_id'), True),
+    (Credential, ('state',), False),
+    (File, ('service_id', 'path'), True),
+    (CaptureNote, ('flag_id', 'service_id', 'location'), False),
+]
+
+
+def _merge_credentials():
+    # Older versions could record a credential against a service more than once
+    duplicates = Credential.select(Credential.bag, Credential.service) \
+        .group_by(Credential.bag, Credential.service) \
+        .having(peewee.fn.COUNT(Credential.id) > 1)
+    for bag, service in duplicates.tuples():
+        creds = list(Credential.select().where(Credential.bag == bag, Credential.service == service)
+                     .order_by(Credential.id))
+        keep, extra = creds[0], [cred.id for cred in creds[1:]]
+        works = any(cred.state == Credential.WORKS for cred in creds)
+        checked = [cred.checked for cred in creds if cred.checked is not None]
+        Credential.update(state=Credential.WORKS if works else Credential.REJECT,
+                          sudo=works and any(cred.sudo for cred in creds),
+                          checked=max(checked) if checked else None).where(Credential.id == keep.id).execute()
+        CaptureNote.update(used_creds=keep.id).where(CaptureNote.used_creds.in_(extra)).execute()
+        Credential.delete().where(Credential.id.in_(extra)).execute()
+
+
+def _merge_files():
+    # Only the first copy of a file was ever used, so the rest can go
+    duplicates = File.select(File.service, File.path, peewee.fn.MIN(File.id)) \
+        .group_by(File.service, File.path) \
+        .having(peewee.fn.COUNT(File.id) > 1)
+    for service, path, keep in duplicates.tuples():
+        extra = File.select(File.id).where(File.service == service, File.path == path, File.id != keep)
+        ShadowEntry.update(source=keep).where(ShadowEntry.source.in_(extra)).execute()
+        File.delete().where(File.id.in_([file_id for file_id, in extra.tuples()])).execute()
+
+
+#: Run before creating a unique index, to remove the rows that would violate it
+MERGES = {
+    Credential: _merge_credentials,
+    File: _merge_files,
+}
+
+
+def upgrade(database: peewee.Database):
+    """
+    Add any tables, columns and indexes that are missing from a database created by an older version.
+    """
+    if not database.table_exists(Credential._meta.table_name):
+        return
+
+    database.create_tables([ServiceSchedule, ServiceStatus], safe=True)
+
+    migrator = SchemaMigrator.from_database(database)
+    for model, column, field in COLUMNS:
+        table = model._meta.table_name
+        if not database.table_exists(table):
+            continue
+        if column not in {c.name for c in database.get_columns(table)}:
+            with database.atomic():
+                migrate(migrator.add_column(table, column, field))
+
+    for model, columns, unique in INDEXES:
+        table = model._meta.table_name
+        if not database.table_exists(table):
+            continue
+        if not set(columns) <= {c.name for c in database.get_columns(table)}:
+            continue
+        if any(tuple(index.columns) == columns for index in database.get_indexes(table)):
+            continue
+        with database.atomic():
+            if unique and model in MERGES:
+                MERGES[model]()
+            migrate(migrator.add_index(table, columns, unique))
 
 
 def delete():  # pragma: no cover
@@ -140,3 +262,5 @@ def delete():  # pragma: no cover
     list(map(_del_instance, DNSResult.select()))
     list(map(_del_instance, Key.select()))
     list(map(_del_instance, ShadowEntry.select()))
+    list(map(_del_instance, ServiceSchedule.select()))
+    list(map(_del_instance, ServiceStatus.select()))
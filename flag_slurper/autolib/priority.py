@@ -0,0 +1,76 @@
+"""
+Attack ordering based on what has worked before.
+
+Default credentials tend to be left in place across every team's copy of a
+service, so the rate a credential bag has worked against a service name is
+a good guess at whether it will work against the next one. Services and
+credentials are ranked by that hit rate so likely wins are attacked first.
+"""
+import itertools
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from peewee import Case, fn
+
+from .models import Credential, CredentialBag, Service
+
+HitRates = Dict[Tuple[int, str], float]
+
+
+def hit_rates(service_name: Optional[str] = None) -> HitRates:
+    """
+    How often each credential bag has worked against each service name.
+
+    Rates are smoothed so a bag that has only been tried once isn't ranked
+    as a certain win or loss. Pairs that have never been tried have no rate.
+
+    :param service_name: Only calculate the rates for this service name
+    :return: The hit rate for each (bag id, service name) pair
+    """
+    works = fn.SUM(Case(None, [(Credential.state == Credential.WORKS, 1)], 0))
+    query = Credential.select(Credential.bag, Service.service_name, fn.COUNT(Credential.id), works) \
+        .join(Service) \
+        .group_by(Credential.bag, Service.service_name)
+    if service_name is not None:
+        query = query.where(Service.service_name == service_name)
+
+    return {(bag, name): (hits + 1) / (tries + 2) for bag, name, tries, hits in query.tuples()}
+
+
+def _rate(rates: HitRates, bag_id: int, service_name: str) -> float:
+    return rates.get((bag_id, service_name), 0.5)
+
+
+def rank_credentials(credentials: List[CredentialBag], service: Service, rates: HitRates) -> List[CredentialBag]:
+    """
+    Order credentials by how often they have worked against services like this one.
+    Credentials with the same rate keep their original order.
+    """
+    return sorted(credentials, key=lambda bag: _rate(rates, bag.id, service.service_name), reverse=True)
+
+
+def rank_services(services: List[Service], rates: HitRates) -> List[Service]:
+    """
+    Order services so the ones most likely to fall are attacked first.
+
+    A service scores the best hit rate of any credential against its name.
+    To avoid hammering a single team, the order goes round the teams: every
+    team's best service, then every team's second best, and so on.
+    """
+    best = {}
+    for (_, name), rate in rates.items():
+        best[name] = max(best.get(name, 0.0), rate)
+
+    def _score(service: Service) -> float:
+        return best.get(service.service_name, 0.5)
+
+    teams = defaultdict(list)
+    for service in services:
+        teams[service.team_id].append(service)
+    for team in teams.values():
+        team.sort(key=_score, reverse=True)
+
+    ranked = []
+    for tier in itertools.zip_longest(*teams.values()):
+        ranked.extend(sorted((service for service in tier if service is not None), key=_score, reverse=True))
+    return ranked
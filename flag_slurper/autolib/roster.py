@@ -0,0 +1,134 @@
+"""
+Importing the IScorE team and service lists into the project database.
+
+The IScorE payloads are diffed against the rows we already have in memory,
+and only new and changed rows are written, with one upsert per table, so
+generating a whole competition is a handful of queries. Reconciling removes
+what IScorE no longer has with one set-based delete per table.
+"""
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Tuple
+
+import peewee
+
+from .models import CaptureNote, Credential, DNSResult, File, Flag, Key, Service, ServiceSchedule, ServiceStatus, \
+    ShadowEntry, Team
+
+#: How many rows to send in a single insert
+BATCH_SIZE = 100
+
+
+def _upsert(model, rows: List[dict], conflict_target, preserve):
+    for batch in peewee.chunked(rows, BATCH_SIZE):
+        model.insert_many(batch).on_conflict(conflict_target=conflict_target, preserve=preserve).execute()
+
+
+def import_teams(teams: Iterable[dict]) -> Tuple[int, int]:
+    """
+    Create or update teams from the IScorE team list.
+
+    :param teams: Teams from ``/teams.json``
+    :return: How many teams were created and how many were updated
+    """
+    existing = {team.id: (team.name, team.number, team.domain) for team in Team.select()}
+
+    created, updated = [], []
+    for team in teams:
+        row = {'id': team['id'], 'name': team['name'], 'number': team['number'], 'domain': team['team_url']}
+        if team['id'] not in existing:
+            created.append(row)
+        elif existing[team['id']] != (row['name'], row['number'], row['domain']):
+            updated.append(row)
+
+    _upsert(Team, created + updated, [Team.id], [Team.name, Team.number, Team.domain])
+    return len(created), len(updated)
+
+
+def import_services(statuses: Iterable[dict], get_service: Callable[[str], dict]) -> Tuple[int, int]:
+    """
+    Create or update services from the IScorE service status list.
+
+    Statuses for teams that aren't in the database are skipped. If a service's
+    port or url changed, its detected protocol is forgotten so it is probed again.
+
+    :param statuses: Service statuses from ``/servicestatus.json``
+    :param get_service: Looks up a service definition by name
+    :return: How many services were created and how many were updated
+    """
+    teams = {team_id for team_id, in Team.select(Team.id).tuples()}
+    existing: Dict[int, Service] = {service.remote_id: service
+                                    for service in Service.select().where(Service.remote_id.is_null(False))}
+
+    created, updated = [], []
+    for status in statuses:
+        if status['team_id'] not in teams:
+            continue
+
+        service = get_service(status['service_name'])
+        row = {'remote_id': status['id'], 'service_id': status['service_id'], 'service_name': status['service_name'],
+               'service_port': service['port'], 'service_url': service['url'].format(num=status['team_number']),
+               'team': status['team_id'], 'protocol': None}
+
+        old = existing.get(status['id'])
+        if old is None:
+            created.append(row)
+            continue
+
+        moved = (old.service_port, old.service_url) != (row['service_port'], row['service_url'])
+        if not moved:
+            row['protocol'] = old.protocol
+        old_fields = (old.service_id, old.service_name, old.team_id)
+        changed = old_fields != (row['service_id'], row['service_name'], row['team'])
+        if moved or changed:
+            updated.append(row)
+
+    _upsert(Service, created + updated, [Service.remote_id],
+            [Service.service_id, Service.service_name, Service.service_port, Service.service_url, Service.team,
+             Service.protocol])
+    return len(created), len(updated)
+
+
+def reconcile(teams: List[dict], statuses: List[dict]) -> Dict[str, int]:
+    """
+    Remove the teams and services that no longer exist in IScorE, along with everything found on them.
+
+    Services without a ``remote_id`` were added by hand and are only removed
+    along with their team. Credentials whose service is already gone are
+    removed too. Rows are deleted children first, so this works whether or
+    not the database enforces foreign keys.
+
+    :param teams: Teams from ``/teams.json``
+    :param statuses: Service statuses from ``/servicestatus.json``
+    :return: How many rows were removed, by what they were
+    :raises ValueError: If IScorE returned no teams or no services, which is more likely an outage than the truth
+    """
+    if not teams:
+        raise ValueError('IScorE returned no teams, refusing to remove every team')
+    if not statuses:
+        raise ValueError('IScorE returned no services, refusing to remove every service')
+
+    team_ids = [team['id'] for team in teams]
+    status_ids = [status['id'] for status in statuses]
+    gone_teams = [team_id for team_id, in Team.select(Team.id).where(Team.id.not_in(team_ids)).tuples()]
+    gone_services = [service_id for service_id, in Service.select(Service.id).where(
+        Service.team.in_(gone_teams) | (Service.remote_id.is_null(False) & Service.remote_id.not_in(status_ids))
+    ).tuples()]
+    gone_flags = Flag.select(Flag.id).where(Flag.team.in_(gone_teams))
+    stale_credentials = Credential.select(Credential.id).where(
+        Credential.service.in_(gone_services) | Credential.service.not_in(Service.select(Service.id)))
+
+    removed = OrderedDict()
+    removed['capture notes'] = CaptureNote.delete().where(
+        CaptureNote.service.in_(gone_services) | CaptureNote.flag.in_(gone_flags) |
+        CaptureNote.used_creds.in_(stale_credentials)).execute()
+    removed['shadow entries'] = ShadowEntry.delete().where(ShadowEntry.service.in_(gone_services)).execute()
+    removed['files'] = File.delete().where(File.service.in_(gone_services)).execute()
+    removed['credentials'] = Credential.delete().where(Credential.id.in_(stale_credentials)).execute()
+    ServiceSchedule.delete().where(ServiceSchedule.service.in_(gone_services)).execute()
+    ServiceStatus.delete().where(ServiceStatus.service.in_(gone_services)).execute()
+    removed['services'] = Service.delete().where(Service.id.in_(gone_services)).execute()
+    removed['flags'] = Flag.delete().where(Flag.team.in_(gone_teams)).execute()
+    removed['dns results'] = DNSResult.delete().where(DNSResult.team.in_(gone_teams)).execute()
+    removed['keys'] = Key.delete().where(Key.team.in_(gone_teams)).execute()
+    removed['teams'] = Team.delete().where(Team.id.in_(gone_teams)).execute()
+    return removed
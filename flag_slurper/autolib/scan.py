@@ -0,0 +1,150 @@
+"""
+Quick TCP probes run before AutoPWN attacks anything.
+
+A service whose box is down or whose port is closed would otherwise tie up
+an attack worker until the protocol's connect timeout fires. Scanning every
+port at once from an event loop with a short timeout takes about as long as
+that timeout, and lets the attack workers spend their time on services that
+can actually be attacked.
+
+Services on nonstandard ports can't be matched to a protocol by their port
+number, so their protocol is detected from what the server says when we
+connect instead.
+"""
+import asyncio
+import logging
+import re
+from typing import Awaitable, Callable, Dict, Iterable, Optional, TypeVar
+
+from .governor import Governor
+from .models import Service
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+#: Banners sent by servers as soon as a client connects, and the protocol they belong to. FTP greets clients
+#: with ``220`` too, so an SMTP server is only recognised when its greeting says so.
+BANNERS = [
+    (re.compile(rb'SSH-'), 'ssh'),
+    (re.compile(rb'220[ -][^\r\n]*\bE?SMTP\b', re.IGNORECASE), 'smtp'),
+]
+
+#: Sent to servers that wait for the client to speak first.
+HTTP_PROBE = b'HEAD / HTTP/1.0\r\n\r\n'
+
+
+async def is_open(host: Optional[str], port: int, timeout: float) -> bool:
+    """
+    Whether a TCP connection to the port can be made within the timeout.
+
+    :param host: The ip address or hostname to connect to, None if it couldn't be resolved
+    :param port: The port to connect to
+    :param timeout: How many seconds to wait for the connection
+    """
+    if host is None:
+        return False
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:  # pragma: no cover
+        pass
+    return True
+
+
+async def probe(host: Optional[str], port: int, timeout: float) -> Optional[str]:
+    """
+    Detect the protocol spoken on a port.
+
+    SSH and SMTP servers greet a client as soon as it connects, and any
+    other greeting is ``unknown``. If nothing is said within the timeout an
+    HTTP request is sent instead.
+
+    :param host: The ip address or hostname to connect to, None if it couldn't be resolved
+    :param port: The port to connect to
+    :param timeout: How many seconds to wait for the connection and each response
+    :return: The protocol, ``unknown`` if it wasn't recognised, or None if the port couldn't be reached
+    """
+    if host is None:
+        return None
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return None
+
+    try:
+        try:
+            banner = await asyncio.wait_for(reader.read(256), timeout)
+        except asyncio.TimeoutError:
+            writer.write(HTTP_PROBE)
+            await writer.drain()
+            response = await asyncio.wait_for(reader.read(64), timeout)
+            return 'http' if response.startswith(b'HTTP/') else 'unknown'
+
+        for pattern, protocol in BANNERS:
+            if pattern.match(banner):
+                return protocol
+        return 'unknown'
+    except (OSError, asyncio.TimeoutError):
+        return 'unknown'
+    finally:
+        writer.close()
+
+
+async def _gather(services: list, concurrency: int, check: Callable[[Service], Awaitable[T]]) -> Dict[int, T]:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _limited(service: Service) -> T:
+        async with semaphore:
+            return await check(service)
+
+    found = await asyncio.gather(*[_limited(service) for service in services])
+    return {service.id: value for service, value in zip(services, found)}
+
+
+def _run(services: Iterable[Service], concurrency: int, check: Callable[[Service], Awaitable[T]]) -> Dict[int, T]:
+    if concurrency < 1:
+        raise ValueError('concurrency must be at least 1')
+    return asyncio.run(_gather(list(services), concurrency, check))
+
+
+def scan(services: Iterable[Service], timeout: float = 2.0, concurrency: int = 256) -> Dict[int, bool]:
+    """
+    Check which services have an open port.
+
+    Hosts are resolved through the governor's resolver cache, so warm it
+    with ``resolve_all`` first to keep DNS out of the scan.
+
+    :param services: The services to scan
+    :param timeout: How many seconds to wait for each connection
+    :param concurrency: How many connections to have open at once
+    :return: Whether each service is up, by service id
+    """
+    async def _check(service: Service) -> bool:
+        up = await is_open(Governor.resolve_url(service.service_url), service.service_port, timeout)
+        logger.debug("%s:%d is %s", service.service_url, service.service_port, 'up' if up else 'down')
+        return up
+
+    return _run(services, concurrency, _check)
+
+
+def detect(services: Iterable[Service], timeout: float = 2.0, concurrency: int = 256) -> Dict[int, Optional[str]]:
+    """
+    Detect the protocol of every service with :py:func:`probe`.
+
+    :param services: The services to probe
+    :param timeout: How many seconds to wait for the connection and each response
+    :param concurrency: How many connections to have open at once
+    :return: The protocol of each service (or None if it couldn't be reached), by service id
+    """
+    async def _check(service: Service) -> Optional[str]:
+        protocol = await probe(Governor.resolve_url(service.service_url), service.service_port, timeout)
+        logger.debug("%s:%d speaks %s", service.service_url, service.service_port, protocol)
+        return protocol
+
+    return _run(services, concurrency, _check)
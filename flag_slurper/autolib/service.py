@@ -1,10 +1,13 @@
+import time
 from typing import Tuple, Dict, Any, Optional, List
 
 from flag_slurper.autolib.post import PostContext
 from .exploit import FlagConf
 from .models import Service
-from .protocols import PWN_FUNCS
+from .protocols import PWN_FUNCS, ssh_timeouts
 from .post import registry
+from .records import Records
+from .sessions import SSHSessions
 
 SERVICE_MAP = {
     22: 'ssh',
@@ -17,13 +20,43 @@ SERVICE_MAP = {
 
 
 class Result:
-    def __init__(self, service: Service, message: str, *, success: bool, skipped: bool):
+    def __init__(self, service: Service, message: str, *, success: bool, skipped: bool,
+                 not_before: Optional[float] = None, resume: Optional[dict] = None,
+                 records: Optional[Records] = None, timed_out: bool = False):
         self.service = service
         self.message = message
         self.success = success
         self.skipped = skipped
+        self.not_before = not_before
+        self.resume = resume
+        self.records = records if records is not None else Records()
+        self.timed_out = timed_out
         self.proto, self.url, self.port = detect_service(service)
 
+    @property
+    def deferred(self) -> bool:
+        """
+        Whether the governor cut this attack short. The service should be
+        attacked again once ``not_before`` has passed, passing along
+        ``resume`` so the protocol can pick up where it left off.
+        """
+        return self.not_before is not None
+
+    @classmethod
+    def timeout(cls, service: Service, deadline: float) -> 'Result':
+        """
+        The result of an attack the engine gave up on after ``deadline`` seconds.
+        """
+        return cls(service=service, message='No result within {:g}s'.format(deadline), success=False,
+                   skipped=False, timed_out=True)
+
+    @classmethod
+    def error(cls, service: Service, error: BaseException) -> 'Result':
+        """
+        The result of an attack that raised instead of returning a result.
+        """
+        return cls(service=service, message='Error: {!r}'.format(error), success=False, skipped=False)
+
     def __eq__(self, other):
         return self.service == other.service \
                and self.message == other.message \
@@ -33,7 +66,12 @@ class Result:
     def __str__(self):
         header = "{team}/{url}:{port}/{proto}".format(team=self.service.team.number, url=self.url, port=self.port,
                                                       proto=self.proto)
-        if not self.success and not self.skipped:
+        if self.deferred:
+            until = time.strftime('%H:%M:%S', time.localtime(self.not_before))
+            return "{} Deferred pwn until {}: {}".format(header, until, self.message)
+        elif self.timed_out:
+            return "{} Timed out pwn: {}".format(header, self.message)
+        elif not self.success and not self.skipped:
             return "{} Failed pwn: {}".format(header, self.message)
         elif not self.success and self.skipped:
             return "{} Skipped pwn: {}".format(header, self.message)
@@ -49,19 +87,68 @@ def coerce_service(service: Dict[str, Any]) -> Service:
 
 
 def detect_service(service: Service) -> Tuple[str, int, str]:
+    """
+    Work out which protocol a service speaks.
+
+    The protocol detected from the service's banner is used if there is one,
+    otherwise it's guessed from the port number.
+    """
+    if service.protocol and service.protocol != 'unknown':
+        return service.protocol, service.service_url, service.service_port
     if service.service_port not in SERVICE_MAP:
         return 'unknown', service.service_url, service.service_port
     return SERVICE_MAP[service.service_port], service.service_url, service.service_port
 
 
 def pwn_service(service: Service, flag_conf: Optional[FlagConf], limit_creds: Optional[List[str]],
-                config: List[dict]) -> Result:
+                config: List[dict], resume: Optional[dict] = None, incremental: bool = False,
+                priority: bool = False, deadline: Optional[float] = None) -> Result:
+    """
+    Attack a single service and run any post pwn plugins against it.
+
+    If the governor cuts the attack short, the protocol function leaves
+    ``not_before`` and ``resume`` in the context. Post pwn is skipped and a
+    deferred result is returned so the caller can reschedule the service.
+
+    Nothing is written to the database here. Everything found is left in the
+    result's ``records`` for the caller to commit.
+
+    If the attack runs past its ``deadline`` the protocol stops trying new
+    credentials, post pwn is skipped and the result is marked ``timed_out``
+    so the service can be retried later.
+
+    :param resume: The ``resume`` state of a previously deferred result for this service
+    :param incremental: Only try credentials that are new or haven't been checked recently
+    :param priority: Try the credentials that have worked most often against similar services first
+    :param deadline: How many seconds the attack may take
+    """
     registry.configure(config)
     proto, url, port = detect_service(service)
     if proto not in PWN_FUNCS:
         return Result(service=service, message="Protocol not supported for autopwn", success=False, skipped=True)
 
-    context = PostContext()
-    message, success, skipped = PWN_FUNCS[proto](url, port, service, flag_conf, limit_creds, context)
-    registry.post(service, context)
-    return Result(service=service, message=message, success=success, skipped=skipped)
+    context = PostContext(sessions=SSHSessions(ssh_timeouts()), incremental=incremental, priority=priority)
+    if deadline is not None:
+        context['deadline'] = time.time() + deadline
+    if resume is not None:
+        # Records from before the service was deferred are carried until it finishes
+        resume = dict(resume)
+        context['records'] = Records(resume.pop('records', ()))
+        context['resume'] = resume
+    try:
+        message, success, skipped = PWN_FUNCS[proto](url, port, service, flag_conf, limit_creds, context)
+        if context.get('not_before') is not None:
+            resume = dict(context['resume'], records=context.records.items)
+            return Result(service=service, message=message, success=success, skipped=skipped,
+                          not_before=context['not_before'], resume=resume)
+
+        if context.get('timed_out'):
+            return Result(service=service, message=message, success=success, skipped=skipped,
+                          records=context.records, timed_out=True)
+
+        # Nothing was attacked, so there's nothing new for post pwn either
+        if not skipped:
+            registry.post(service, context)
+    finally:
+        context['sessions'].close()
+    return Result(service=service, message=message, success=success, skipped=skipped, records=context.records)
@@ -0,0 +1,77 @@
+"""
+Authenticated sessions shared between a pwn function and its post plugins.
+
+Logging in is the expensive part of talking to a service, so once a
+credential works its connection is kept open for the rest of that
+service's attack instead of being re-established by every plugin.
+"""
+import logging
+from typing import Dict, Optional, Tuple
+
+import paramiko
+
+logger = logging.getLogger(__name__)
+
+SessionKey = Tuple[str, int, str]
+
+
+class SSHSessions:
+    """
+    Connected SSH clients, keyed by ``(host, port, username)``.
+
+    Sessions are scoped to a single service attack. ``pwn_service`` closes
+    them once post pwn has finished.
+
+    :param timeouts: Extra timeout keyword arguments for ``SSHClient.connect``
+    """
+
+    def __init__(self, timeouts: Optional[Dict[str, float]] = None):
+        self.clients: Dict[SessionKey, paramiko.SSHClient] = {}
+        self.timeouts = timeouts or {}
+
+    def __len__(self):
+        return len(self.clients)
+
+    def add(self, host: str, port: int, username: str, client: paramiko.SSHClient):
+        """
+        Keep an already authenticated client for reuse.
+        """
+        old = self.clients.get((host, port, username))
+        if old is not None and old is not client:
+            old.close()
+        self.clients[(host, port, username)] = client
+
+    def get(self, host: str, port: int, username: str) -> Optional[paramiko.SSHClient]:
+        """
+        Get the open session for the given user, if there is one.
+        """
+        client = self.clients.get((host, port, username))
+        if client is None:
+            return None
+
+        transport = client.get_transport()
+        if transport is None or not transport.is_active():
+            logger.debug("Dropping dead session for %s@%s:%d", username, host, port)
+            del self.clients[(host, port, username)]
+            return None
+        return client
+
+    def connect(self, host: str, port: int, username: str, password: str) -> paramiko.SSHClient:
+        """
+        Get the open session for the given user, logging in if there isn't one.
+        """
+        client = self.get(host, port, username)
+        if client is not None:
+            return client
+
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(host, port=port, username=username, password=password, look_for_keys=False,
+                       allow_agent=False, **self.timeouts)
+        self.add(host, port, username, client)
+        return client
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
+        self.clients = {}
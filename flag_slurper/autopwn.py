@@ -1,15 +1,22 @@
+import contextlib
+import json
 import logging
 import os
+import sys
+import time
+from datetime import datetime
 from functools import partial
-from multiprocessing import Pool, Manager
+from multiprocessing import Manager
 
 import click
 from peewee import fn
+from terminaltables import AsciiTable
 
+from flag_slurper.autolib.governor import Governor
 from flag_slurper.autolib.models import SUDO_FLAG
 from flag_slurper.conf import context
 from . import utils, autolib
-from .autolib import models
+from .autolib import models, engine as engines, priority, records, report, roster, scan as scanner
 from flag_slurper.conf.config import Config
 from flag_slurper.conf.project import Project
 
@@ -33,7 +40,7 @@ def autopwn(ctx):
     ctx.obj = p
 
 
-def _pwn_service(limit_creds, service, ctx=None):
+def _pwn_service(limit_creds, service, ctx=None, resume=None, incremental=False, priority=False, deadline=None):
     if ctx:
         context.deserialize(ctx)
     p = Project.get_instance()
@@ -45,13 +52,15 @@ def _pwn_service(limit_creds, service, ctx=None):
     flags = p.flag(team)
     flag = list(filter(lambda x: x['service'] == service.service_name, flags))
     logger.debug("pwning %d", team.number)
-    result = autolib.pwn_service(service, flag, limit_creds, config)
+    result = autolib.pwn_service(service, flag, limit_creds, config, resume, incremental, priority, deadline)
     logger.debug("pwned %d", team.number)
     return result
 
 
 def _print_result(result, verbose):
-    if result.success:
+    if result.timed_out:
+        utils.report_warning(result)
+    elif result.success:
         utils.report_success(result)
     elif result.skipped:
         if verbose:
@@ -60,105 +69,321 @@ def _print_result(result, verbose):
         utils.report_error(result)
 
 
-@autopwn.command()
-@pass_config
-@click.option('-v', '--verbose', is_flag=True)
-@click.option('-P', '--parallel', is_flag=True, help="Async AutoPWN attack")
-@click.option('-N', '--processes', type=click.INT, default=None, help="How manny process to use for async AutoPWN")
-@click.option('-c', '--limit-creds', type=click.STRING, multiple=True, help="Limit the attack to the given creds")
-@click.option('-t', '--team', type=click.INT, default=None, help="Limit the attack to the given team")
-@click.option('-s', '--service', type=click.STRING, default=None, help="Limit the attack to the given service name")
-@click.option('-r', '--randomize', is_flag=True, help="Randomize autopwn order")
-def pwn(config, verbose, parallel, processes, limit_creds, team, service, randomize):
+def _select_services(team, service):
+    services = models.Service.select()
+
+    if team:
+        utils.report_status('Limited to team {}'.format(team))
+        services = services.join(models.Team).where(models.Team.number == team)
+
+    if service:
+        utils.report_status('Limited to service {}'.format(service))
+        services = services.where(models.Service.service_name == service)
+    return services
+
+
+def _scan_services(config, services, verbose):
+    """
+    Scan every service's port, recording which are up, and return the services that can be attacked.
+    """
+    utils.report_status("Scanning {} service(s)".format(len(services)))
+    status = scanner.scan(services, utils.parse_duration(config['autopwn']['scan_timeout']),
+                          config.getint('autopwn', 'scan_concurrency'))
+
+    found = records.Records()
+    for service in services:
+        found.status(service, status[service.id])
+        if verbose and not status[service.id]:
+            utils.report_warning("{}/{}:{}/{} is down".format(service.team.number, service.service_url,
+                                                              service.service_port, service.service_name))
+    found.commit()
+
+    up = [service for service in services if status[service.id]]
+    utils.report_status("{} of {} service(s) are up".format(len(up), len(services)))
+    return up
+
+
+def _detect_protocols(config, services):
+    """
+    Detect the protocol of every service that hasn't been probed yet, and remember it for later runs.
+    """
+    unprobed = [service for service in services if service.protocol is None]
+    if not unprobed or not config.getboolean('autopwn', 'detect'):
+        return
+
+    utils.report_status("Detecting the protocol of {} service(s)".format(len(unprobed)))
+    protocols = scanner.detect(unprobed, utils.parse_duration(config['autopwn']['scan_timeout']),
+                               config.getint('autopwn', 'scan_concurrency'))
+
+    found = records.Records()
+    for service in unprobed:
+        # Services that couldn't be reached are probed again next time
+        if protocols[service.id] is not None:
+            service.protocol = protocols[service.id]
+            found.protocol(service, service.protocol)
+    found.commit()
+
+
+def _deadlines(config):
+    """
+    How long a service may be attacked for, and when the engine gives up waiting on it.
+
+    Workers stop trying new credentials once ``autopwn->service_deadline`` has passed. The engine allows twice the
+    longest protocol timeout on top of that for the attempt in progress to finish.
+    """
+    budget = utils.parse_duration(config['autopwn']['service_deadline'])
+    timeouts = [utils.parse_duration(config['autopwn']['{}_timeout'.format(proto)])
+                for proto in ('ssh', 'smtp', 'http', 'dns')]
+    return budget, budget + 2 * max(timeouts)
+
+
+def _run_engine(config, p, func, services, callback, parallel, engine, processes, concurrency, start=None,
+                on_late=None):
+    budget, deadline = _deadlines(config)
+    func = partial(func, deadline=budget)
+    if parallel and engine == 'async':
+        utils.report_status("Using async engine with concurrency: {}".format(concurrency))
+        engines.run_async(func, services, callback, concurrency, start, deadline, on_late)
+    elif parallel:
+        print("Using pool size: {}".format(processes))
+        with Manager() as manager:
+            ctx = manager.dict()
+            context.serialize(ctx, config, p)
+            engines.run_pool(partial(func, ctx=ctx), services, callback, processes, start, deadline, on_late)
+    else:
+        engines.run_serial(func, services, callback, start)
+
+
+def _pwn(config, verbose, parallel, processes, limit_creds, team, service, randomize, order, engine, concurrency,
+         incremental, scan):
+    """
+    Attack every selected service, reporting on each result as it comes in.
+    """
     utils.report_status("Starting AutoPWN")
     p = Project.get_instance()
 
     if not processes:
         processes = os.cpu_count() + 1
+    if not engine:
+        engine = config['autopwn']['engine']
+    if not concurrency:
+        concurrency = config.getint('autopwn', 'concurrency')
 
     p.connect_database()
     utils.report_status("Loaded project from {}".format(p.base))
 
-    services = models.Service.select()
+    services = _select_services(team, service)
 
-    if team:
-        utils.report_status('Limited to team {}'.format(team))
-        services = services.join(models.Team).where(models.Team.number == team)
+    incremental = incremental or config.getboolean('autopwn', 'incremental')
+    if incremental:
+        utils.report_status('Skipping credentials checked in the last {} (works) or {} (reject)'.format(
+            config['autopwn']['works_ttl'], config['autopwn']['reject_ttl']))
 
-    if service:
-        utils.report_status('Limited to service {}'.format(service))
-        services = services.where(models.Service.service_name == service)
+    if randomize or (not order and config.getboolean('autopwn', 'random')):
+        order = 'random'
+    elif not order:
+        order = config['autopwn']['order']
 
-    if randomize or config.getboolean('autopwn', 'random'):
+    if order == 'random':
         utils.report_status('Shuffling services')
         services = services.order_by(fn.Random())
 
-    if parallel:
-        print("Using pool size: {}".format(processes))
-        with Manager() as manager, Pool(processes=processes) as pool:
-            ctx = manager.dict()
-            context.serialize(ctx, config, p)
-            pwn_service = partial(_pwn_service, limit_creds, ctx=ctx)
-            results = pool.map(pwn_service, services)
+    services = list(services)
+    if order == 'priority':
+        utils.report_status('Ordering by previous success')
+        services = priority.rank_services(services, priority.hit_rates())
 
-        for result in results:
-            _print_result(result, verbose)
-    else:
-        for service in services:
-            result = _pwn_service(limit_creds, service)
-            _print_result(result, verbose)
-
-    bags = models.CredentialBag.select()
-    if limit_creds:
-        bags = bags.where(models.CredentialBag.username.in_(limit_creds))
-
-    for cred in bags:
-        working = cred.credentials.where(models.Credential.state == models.Credential.WORKS).execute()
-        if len(working):
-            def display_service(cred: models.Credential):
-                return "{}/{}".format(cred.service.team.number, cred.service.service_name)
-
-            utils.report_success("Credential {} works on the following teams: \n\t- {}".format(cred, "\n\t- ".join(
-                map(display_service, working))))
-        else:
-            utils.report_warning("Credential {} works on no teams".format(cred))
+    # Resolve every host up front so attack workers never block on DNS
+    hosts = {s.service_url for s in services}
+    utils.report_status("Resolving {} host(s)".format(len(hosts)))
+    Governor.resolver.resolve_all(hosts)
+
+    if scan is None:
+        scan = config.getboolean('autopwn', 'scan')
+    if scan:
+        services = _scan_services(config, services, verbose)
+    _detect_protocols(config, services)
+    progress = engines.Progress(len(services))
+
+    # Results are only ever written from here, the workers just report what they found
+    writer = records.RecordWriter(batch_size=config.getint('autopwn', 'write_batch'))
+
+    timed_out = []
+
+    def _on_result(result):
+        writer.write(result.records)
+        if result.timed_out:
+            timed_out.append(result.service)
+        progress.advance()
+        utils.clear_progress()
+        _print_result(result, verbose)
+        utils.report_progress(progress)
+
+    def _on_late(result):
+        # Already reported as timed out, but keep what it found
+        writer.write(result.records)
+
+    with writer:
+        func = partial(_pwn_service, limit_creds, incremental=incremental, priority=order == 'priority')
+        _run_engine(config, p, func, services, _on_result, parallel, engine, processes, concurrency,
+                    on_late=_on_late)
+    utils.clear_progress()
+
+    if timed_out:
+        utils.report_warning("{} service(s) ran out of time, retry them with: autopwn pwn --incremental".format(
+            len(timed_out)))
 
 
 @autopwn.command()
-@click.option('-r', '--reconcile', is_flag=True, help='Remove teams that do not exist in IScorE')
 @pass_config
-def generate(config, reconcile):
+@click.option('-v', '--verbose', is_flag=True)
+@click.option('-P', '--parallel', is_flag=True, help="Async AutoPWN attack")
+@click.option('-N', '--processes', type=click.INT, default=None, help="How manny process to use for async AutoPWN")
+@click.option('-c', '--limit-creds', type=click.STRING, multiple=True, help="Limit the attack to the given creds")
+@click.option('-t', '--team', type=click.INT, default=None, help="Limit the attack to the given team")
+@click.option('-s', '--service', type=click.STRING, default=None, help="Limit the attack to the given service name")
+@click.option('-r', '--randomize', is_flag=True, help="Randomize autopwn order")
+@click.option('-o', '--order', type=click.Choice(['db', 'random', 'priority']), default=None,
+              help="The order to attack services and credentials in (default: autopwn->order)")
+@click.option('-e', '--engine', type=click.Choice(['pool', 'async']), default=None,
+              help="How to run parallel AutoPWN (default: autopwn->engine)")
+@click.option('-C', '--concurrency', type=click.INT, default=None,
+              help="Max services in flight for the async engine (default: autopwn->concurrency)")
+@click.option('-i', '--incremental', is_flag=True,
+              help="Only try credentials that are new or haven't been checked recently")
+@click.option('--scan/--no-scan', default=None,
+              help="Skip services whose port is closed (default: autopwn->scan)")
+@click.option('--summary-format', type=click.Choice(['table', 'json']), default='table',
+              help="How to print which credentials worked at the end of the attack")
+def pwn(config, verbose, parallel, processes, limit_creds, team, service, randomize, order, engine, concurrency,
+        incremental, scan, summary_format):
+    with contextlib.ExitStack() as stack:
+        if summary_format == 'json':
+            # Keep stdout for the summary alone, so it can be piped straight into other tools
+            stack.enter_context(contextlib.redirect_stdout(sys.stderr))
+        _pwn(config, verbose, parallel, processes, limit_creds, team, service, randomize, order, engine, concurrency,
+             incremental, scan)
+    _print_summary(report.credential_summary(limit_creds), summary_format)
+
+
+def _print_summary(summary, summary_format):
+    if summary_format == 'json':
+        click.echo(json.dumps(summary))
+        return
+
+    data = [['Credential', 'Hits', 'Works On']]
+    for cred in summary:
+        hits = ["{}/{}".format(hit['team'], hit['service']) for hit in cred['hits']]
+        data.append(["{}:{}".format(cred['username'], cred['password']), len(hits), "\n".join(hits)])
+    click.echo(AsciiTable(data).table)
+
+
+@autopwn.command()
+@pass_config
+@click.option('-v', '--verbose', is_flag=True)
+@click.option('-P', '--parallel', is_flag=True, help="Async AutoPWN attack")
+@click.option('-N', '--processes', type=click.INT, default=None, help="How manny process to use for async AutoPWN")
+@click.option('-c', '--limit-creds', type=click.STRING, multiple=True, help="Limit the attack to the given creds")
+@click.option('-t', '--team', type=click.INT, default=None, help="Limit the attack to the given team")
+@click.option('-s', '--service', type=click.STRING, default=None, help="Limit the attack to the given service name")
+@click.option('-e', '--engine', type=click.Choice(['pool', 'async']), default=None,
+              help="How to run parallel AutoPWN (default: autopwn->engine)")
+@click.option('-C', '--concurrency', type=click.INT, default=None,
+              help="Max services in flight for the async engine (default: autopwn->concurrency)")
+@click.option('-i', '--incremental', is_flag=True,
+              help="Only try credentials that are new or haven't been checked recently")
+def daemon(config, verbose, parallel, processes, limit_creds, team, service, engine, concurrency, incremental):
+    """
+    Keep attacking every service, each on its own schedule.
+
+    Services are checked again sooner when their result changes and less
+    often the longer they hold out, between autopwn->daemon_min_interval and
+    autopwn->daemon_max_interval. The schedule is kept in the project
+    database, so a restarted daemon picks up where it left off. Stop it
+    with Ctrl-C.
+    """
+    utils.report_status("Starting AutoPWN daemon")
     p = Project.get_instance()
+
+    if not processes:
+        processes = os.cpu_count() + 1
+    if not engine:
+        engine = config['autopwn']['engine']
+    if not concurrency:
+        concurrency = config.getint('autopwn', 'concurrency')
+    incremental = incremental or config.getboolean('autopwn', 'incremental')
+
     p.connect_database()
-    teams = utils.get_teams()
+    utils.report_status("Loaded project from {}".format(p.base))
+
+    services = list(_select_services(team, service))
+    recheck = engines.Recheck(utils.parse_duration(config['autopwn']['daemon_min_interval']),
+                              utils.parse_duration(config['autopwn']['daemon_max_interval']))
+
+    # Pick up the schedule a previous daemon left behind
+    schedules, start = {}, {}
+    for schedule in models.ServiceSchedule.select():
+        schedules[schedule.service_id] = (schedule.interval, schedule.success)
+        start[schedule.service_id] = schedule.next_check.timestamp()
+    utils.report_status("Resuming the schedule of {} service(s)".format(len(start)))
+
+    Governor.resolver.resolve_all({s.service_url for s in services})
+    _detect_protocols(config, services)
+    writer = records.RecordWriter(batch_size=config.getint('autopwn', 'write_batch'))
+
+    def _on_result(result):
+        interval, success = schedules.get(result.service.id, (None, None))
+        interval = int(recheck.interval(result, interval, success))
+        schedules[result.service.id] = (interval, result.success)
+        next_check = time.time() + interval
+
+        result.records.schedule(result.service, datetime.fromtimestamp(next_check), interval, result.success)
+        writer.write(result.records)
+        # Results can be minutes apart, so don't leave the schedule unwritten until the next one
+        writer.flush()
+        _print_result(result, verbose)
+        return next_check
+
+    def _on_late(result):
+        # Already rescheduled as timed out, but keep what it found
+        writer.write(result.records)
+        writer.flush()
+
+    with writer:
+        try:
+            _run_engine(config, p, partial(_pwn_service, limit_creds, incremental=incremental), services,
+                        _on_result, parallel, engine, processes, concurrency, start, _on_late)
+        except KeyboardInterrupt:
+            utils.report_status("Stopping AutoPWN daemon")
 
-    if reconcile:
-        ids = [t['id'] for t in teams]
-        old_teams = models.Team.select().where(~models.Team.id << ids)
-        if old_teams.count() > 0:
-            utils.report_status("Reconciling {} team(s)".format(old_teams.count()))
-            map(lambda x: x.delete_instance(), old_teams)
 
-    with models.database_proxy.obj:
-        for team in teams:
-            if config['iscore']['ignore_guest_division'] and team['guest_division']:
-                continue
+@autopwn.command()
+@click.option('-r', '--reconcile', is_flag=True,
+              help='Remove teams, services and credentials that no longer exist in IScorE')
+@pass_config
+def generate(config, reconcile):
+    p = Project.get_instance()
+    p.connect_database()
+    # TODO: When /services.json gets fixed, use get_services() instead of the service status
+    teams, service_status = utils.fetch_all(utils.get_teams, utils.get_service_status)
 
-            t, _ = models.Team.get_or_create(id=team['id'], name=team['name'], number=team['number'],
-                                             domain=team['team_url'])
-        models.database_proxy.commit()
+    if config['iscore']['ignore_guest_division']:
+        teams = [team for team in teams if not team['guest_division']]
 
-    # TODO: When /services.json gets fixed, use get_services()
-    service_status = utils.get_service_status()
-    for status in service_status:
-        if not models.Team.select().where(models.Team.id == status['team_id']).exists():
-            continue
+    with models.database_proxy.atomic():
+        if reconcile and not teams:
+            utils.report_warning("IScorE returned no teams, not reconciling")
+        elif reconcile and not service_status:
+            utils.report_warning("IScorE returned no services, not reconciling")
+        elif reconcile:
+            removed = roster.reconcile(teams, service_status)
+            summary = ', '.join('{}: {}'.format(name, count) for name, count in removed.items() if count)
+            utils.report_status("Reconciled, removed {}".format(summary or 'nothing'))
 
-        service = utils.get_service(status['service_name'])
-        service_url = service['url'].format(num=status['team_number'])
-        st, _ = models.Service.get_or_create(remote_id=status['id'], service_id=status['service_id'],
-                                             service_name=status['service_name'], service_port=service['port'],
-                                             service_url=service_url, team_id=status['team_id'])
+        created, updated = roster.import_teams(teams)
+        utils.report_status("Imported {} team(s): {} new, {} updated".format(len(teams), created, updated))
+        created, updated = roster.import_services(service_status, utils.get_service)
+        utils.report_status("Imported services: {} new, {} updated".format(created, updated))
 
 
 @autopwn.command()
@@ -168,32 +393,23 @@ def results():
 
     utils.report_status("Found the following flags")
     utils.report_status("Key: {} Used Sudo".format(SUDO_FLAG))
-    flags = models.Flag.select()
-    if len(flags) == 0:
+    if not models.Flag.select().exists():
         utils.report_warning('No Flags Found')
 
-    for flag in flags:
-        notes = flag.notes.select().execute()
+    for flag, notes in report.captures():
         if len(notes) == 1:
             note = notes[0]
             utils.report_success(
                 "{}/{}: {} -> {}".format(flag.team.number, note.service.service_name, note.location, note.data))
-        elif len(notes) > 1:
+        else:
             data = "\n\t".join(map(str, notes))
             utils.report_success("{}/{}:\n\t{}".format(flag.team.number, notes[0].service.service_name, data))
-        else:
-            continue
 
     click.echo()
     utils.report_status("Found the following credentials")
     utils.report_status("Key: {} Sudo".format(SUDO_FLAG))
 
-    services = models.Service.select()
-    for service in services:
-        creds = service.credentials.where(models.Credential.state == models.Credential.WORKS)
-        if len(creds) == 0:
-            continue
-
+    for service, creds in report.working_credentials():
         utils.report_success("{}/{}:{}/{} Succeeded!  Found credentials: {}".format(
             service.team.number, service.service_url, service.service_port, service.service_name,
             ",".join(map(str, creds))
@@ -0,0 +1,127 @@
+"""
+An on-disk cache of IScorE API responses.
+
+The team, service and flag lists rarely change during a competition, but
+every ``generate`` and ``plant`` would otherwise download them again, right
+when IScorE is at its busiest. Responses are kept in the project directory:
+
+- Within ``iscore->cache_ttl`` the cached response is used without asking
+  IScorE at all.
+- After that the request is revalidated with ``If-None-Match`` and
+  ``If-Modified-Since``, so an unchanged list costs an empty ``304``.
+- If IScorE can't be reached, or responds with a server error, the stale
+  response is used rather than failing.
+- In offline mode (``--offline`` or ``iscore->offline``) only the cache is
+  used.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Optional
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class CacheMiss(requests.exceptions.RequestException):
+    """
+    Raised in offline mode when a response hasn't been cached.
+    """
+
+
+class ResponseCache:
+    """
+    Cached API responses, one JSON file per url and identity.
+
+    >>> cache = ResponseCache(project.base / 'api_cache', ttl=60)
+    >>> resp = cache.get(session, url, headers={'Authorization': 'Token ...'})
+    """
+
+    def __init__(self, path: Path, ttl: float = 60, offline: bool = False, clock=time.time):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.offline = offline
+        self.clock = clock
+
+    def _file(self, url: str, kwargs: dict) -> Path:
+        # Responses can differ by user, so who is asking is part of the key
+        identity = [url, kwargs.get('headers', {}).get('Authorization'), kwargs.get('auth')]
+        key = hashlib.sha256(json.dumps(identity, default=str).encode()).hexdigest()
+        return self.path / '{}.json'.format(key)
+
+    def _load(self, file: Path) -> Optional[dict]:
+        try:
+            with open(str(file)) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    def _save(self, file: Path, entry: dict):
+        self.path.mkdir(parents=True, exist_ok=True)
+        # Write then rename, so a concurrent reader never sees half a file
+        tmp = file.with_suffix('.tmp{}'.format(os.getpid()))
+        with open(str(tmp), 'w') as fp:
+            json.dump(entry, fp)
+        os.replace(str(tmp), str(file))
+
+    @staticmethod
+    def _response(url: str, entry: dict) -> requests.Response:
+        resp = requests.Response()
+        resp.url = url
+        resp.status_code = 200
+        resp.headers.update(entry['headers'])
+        resp.encoding = 'utf-8'
+        resp._content = entry['body'].encode('utf-8')
+        return resp
+
+    def get(self, session: requests.Session, url: str, **kwargs) -> requests.Response:
+        """
+        GET a url through the cache.
+
+        :param session: The session to make requests with
+        :param url: The url to get
+        :param kwargs: Extra arguments for ``session.get``
+        :raises CacheMiss: If offline and the url hasn't been cached
+        """
+        file = self._file(url, kwargs)
+        entry = self._load(file)
+
+        if self.offline:
+            if entry is None:
+                raise CacheMiss('{} has not been cached, it can only be fetched online'.format(url))
+            return self._response(url, entry)
+        if entry is not None and self.clock() - entry['fetched'] < self.ttl:
+            return self._response(url, entry)
+
+        headers = dict(kwargs.pop('headers', None) or {})
+        if entry is not None:
+            if 'ETag' in entry['headers']:
+                headers['If-None-Match'] = entry['headers']['ETag']
+            if 'Last-Modified' in entry['headers']:
+                headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+
+        try:
+            resp = session.get(url, headers=headers, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if entry is None:
+                raise
+            logger.warning("Using a stale response for %s, IScorE could not be reached", url)
+            return self._response(url, entry)
+
+        if resp.status_code == 304 and entry is not None:
+            entry['fetched'] = self.clock()
+            self._save(file, entry)
+            return self._response(url, entry)
+        if resp.status_code >= 500 and entry is not None:
+            logger.warning("Using a stale response for %s, IScorE responded with %d", url, resp.status_code)
+            return self._response(url, entry)
+
+        if resp.status_code == 200:
+            cached = {name: resp.headers[name] for name in ('ETag', 'Last-Modified', 'Content-Type')
+                      if name in resp.headers}
+            self._save(file, {'url': url, 'headers': cached, 'body': resp.text, 'fetched': self.clock()})
+        return resp
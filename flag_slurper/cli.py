@@ -21,13 +21,16 @@ pass_conf = click.make_pass_decorator(Config)
 @click.option('--api-token', envvar='ISCORE_API_TOKEN', default=None)
 @click.option('-p', '--project', envvar='SLURPER_PROJECT', type=click.Path(), default=None)
 @click.option('-np', '--no-project', is_flag=True)
+@click.option('--offline', is_flag=True, envvar='ISCORE_OFFLINE', help='Only use cached IScorE responses')
 @click.option('-d', '--debug', count=True)
 @click.version_option(version=__version__, prog_name='flag-slurper')
 @click.pass_context
-def cli(ctx, config, iscore_url, api_token, project, debug, no_project):
+def cli(ctx, config, iscore_url, api_token, project, debug, no_project, offline):
     ctx.obj = Config.load(config)
     ctx.obj.cond_set('iscore', 'url', iscore_url)
     ctx.obj.cond_set('iscore', 'api_token', api_token)
+    if offline:
+        ctx.obj.cond_set('iscore', 'offline', 'true')
 
     if ctx.invoked_subcommand is None:
         click.echo(ctx.get_help())
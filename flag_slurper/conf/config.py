@@ -3,8 +3,11 @@ from pathlib import Path
 from typing import Optional
 import os
 
+import requests
 from click import echo, prompt
 from jinja2 import Environment
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from flag_slurper.autolib.governor import Governor
 from flag_slurper.config import ROOT
@@ -16,6 +19,7 @@ class Config(ConfigParser):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._user = None
+        self._session = None
 
     @classmethod
     def load(cls, extra: Optional[str] = None, noflagrc: bool = False):
@@ -51,6 +55,8 @@ class Config(ConfigParser):
         gov.delay = parse_duration(self['autopwn']['delay'])
         gov.window = parse_duration(self['autopwn']['window'])
         gov.times = self.getint('autopwn', 'times')
+        gov.resolver.ttl = parse_duration(self['autopwn']['dns_ttl'])
+        gov.resolver.negative_ttl = parse_duration(self['autopwn']['dns_negative_ttl'])
 
     @staticmethod
     def get_instance(*args, **kwargs):
@@ -73,6 +79,25 @@ class Config(ConfigParser):
             self._user = get_user()
         return self._user
 
+    @property
+    def session(self) -> requests.Session:
+        """
+        The HTTP session shared by every IScorE API call.
+
+        Connections are kept alive between calls so each one doesn't pay for a new TLS handshake. Requests that
+        fail to connect or get a 5xx response are retried ``iscore->retries`` times, backing off exponentially
+        from ``iscore->backoff`` seconds.
+        """
+        if self._session is None:
+            retry = Retry(total=self.getint('iscore', 'retries'), backoff_factor=self.getfloat('iscore', 'backoff'),
+                          status_forcelist=(500, 502, 503, 504), raise_on_status=False)
+            adapter = HTTPAdapter(max_retries=retry)
+            self._session = requests.Session()
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
+            self._session.headers['Accept-Encoding'] = 'gzip, deflate'
+        return self._session
+
     def prompt_creds(self):
         if 'api_token' not in self['iscore'] or not self['iscore']['api_token']:
             echo('Enter your IScorE API Token (leave blank to use your credentials)')
@@ -91,7 +116,7 @@ class Config(ConfigParser):
 
         Example:
         >>> extras = config.request_extras()
-        >>> requests.get(url, **extras)
+        >>> config.session.get(url, **extras)
         """
         conf = {}
         self.prompt_creds()
@@ -108,5 +133,15 @@ class Config(ConfigParser):
         tpl = env.from_string(self['database']['url'])
         return tpl.render(project=project)
 
+    def governor_store(self, project: str) -> Optional[str]:
+        """
+        The path to the shared governor store for the given project, if one is configured.
+        """
+        if not self['autopwn'].get('governor_store'):
+            return None
+        env = self.template_environment()
+        tpl = env.from_string(self['autopwn']['governor_store'])
+        return tpl.render(project=project)
+
     def template_environment(self) -> Environment:
         return Environment()
@@ -7,6 +7,7 @@ from schema import Schema, Use, Optional
 from yaml import safe_load
 
 from flag_slurper.autolib import models
+from flag_slurper.autolib.governor import Governor, GovernorStore
 from flag_slurper.conf.config import Config
 
 project_schema_v1_0 = Schema({
@@ -171,3 +172,7 @@ class Project:
         conf = Config.get_instance()
         db_path = conf.database(str(self.base))
         models.initialize(db_path)
+
+        store = conf.governor_store(str(self.base))
+        gov = Governor.get_instance()
+        gov.store = GovernorStore(store) if store else None
@@ -1,6 +1,7 @@
 import click
 from terminaltables import AsciiTable
 
+from .autolib import filetype
 from .autolib.models import database_proxy, File, Service, Team
 from flag_slurper.conf.project import Project
 from . import utils
@@ -58,6 +59,11 @@ def show(id):
     """
     file = File.select().where(File.id == id).get()
 
+    if file.info is None or file.mime_type is None:
+        # Files collected without type information are described on first view
+        file.info, file.mime_type = filetype.detect(file.contents.tobytes())
+        file.save()
+
     data = [
         ['ID', id],
         ['Path', file.path],
@@ -1,8 +1,9 @@
 import click
+from peewee import JOIN
 from terminaltables import AsciiTable
 
 from . import utils
-from .autolib.models import database_proxy, Service, Team
+from .autolib.models import database_proxy, Service, ServiceStatus, Team
 from flag_slurper.conf.project import Project
 
 
@@ -20,21 +21,33 @@ def services(ctx):
     ctx.obj = p
 
 
+def _liveness(service: Service) -> str:
+    status = getattr(service, 'liveness', None)
+    if status is None or status.up is None:
+        return '?'
+    return 'yes' if status.up else 'no'
+
+
 @services.command()
 @click.option('-t', '--team', default=None)
 def ls(team):
     """
     List all services.
+
+    ``Protocol`` is the protocol AutoPWN detected from the service's banner, and ``Up?`` is whether the service's
+    port was open the last time AutoPWN scanned it.
     """
     query = Service.select(Service.id, Team.number, Service.service_name, Service.service_port, Service.service_url,
-                           Service.is_rand, Service.high_target, Service.low_target).join(Team)
+                           Service.is_rand, Service.high_target, Service.low_target, Service.protocol,
+                           ServiceStatus.up).join(Team) \
+        .switch(Service).join(ServiceStatus, JOIN.LEFT_OUTER, attr='liveness')
     if team:
         query = query.where(Service.team.number == team)
 
     services = [
-        [s.id, s.team.number, s.service_name, s.service_port, s.service_url, s.is_rand, s.high_target, s.low_target] for
-        s in query]
-    services.insert(0, ['ID', 'Team', 'Name', 'Port', 'URL', 'Random?', 'High', 'Low'])
+        [s.id, s.team.number, s.service_name, s.service_port, s.service_url, s.is_rand, s.high_target, s.low_target,
+         s.protocol or '?', _liveness(s)] for s in query]
+    services.insert(0, ['ID', 'Team', 'Name', 'Port', 'URL', 'Random?', 'High', 'Low', 'Protocol', 'Up?'])
     table = AsciiTable(services)
     utils.conditional_page(table.table, len(services))
 
@@ -82,6 +95,7 @@ def mass_add(name: str, port: int, url: str, is_rand: bool, high: int, low: int)
 @click.option('-r', '--is-rand', type=click.BOOL, default=None)
 @click.option('-i', '--high', 'high_target', default=None)
 @click.option('-l', '--low', 'low_target', default=None)
+@click.option('--protocol', default=None, help='The protocol the service speaks, overriding detection')
 def edit(id, **kwargs):
     updates = {key: value for (key, value) in kwargs.items() if value is not None}
     Service.update(**updates).where(Service.id == id).execute()
@@ -1,21 +1,61 @@
 import os
 import shutil
+import sys
 import zipfile
-from typing import Tuple, Dict, Union, Callable, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, Dict, Union, Callable, Optional, List, Any
 import string
 
 import click
 import requests
 
 from flag_slurper.conf.config import Config
+from .cache import CacheMiss, ResponseCache
 from .models import User
 
 
+def api_get(url: str, **kwargs) -> requests.Response:
+    """
+    GET an IScorE API url over the shared session, with the configured timeout.
+
+    With an active project responses are cached in the project directory, see :py:mod:`flag_slurper.cache`.
+
+    :raises CacheMiss: If offline and the response can't come from the cache
+    """
+    from flag_slurper.conf.project import Project
+    conf = Config.get_instance()
+    kwargs.setdefault('timeout', parse_duration(conf['iscore']['timeout']))
+    offline = conf.getboolean('iscore', 'offline')
+
+    p = Project.get_instance()
+    if not p.enabled:
+        if offline:
+            raise CacheMiss('Offline mode requires an active project to cache IScorE responses in')
+        return conf.session.get(url, **kwargs)
+
+    cache = ResponseCache(p.base / 'api_cache', ttl=parse_duration(conf['iscore']['cache_ttl']), offline=offline)
+    return cache.get(conf.session, url, **kwargs)
+
+
+def fetch_all(*funcs: Callable[[], Any]) -> List[Any]:
+    """
+    Call independent API functions at the same time.
+
+    >>> teams, services = fetch_all(get_teams, get_services)
+
+    :param funcs: The functions to call, without any arguments
+    :return: What each function returned, in the same order
+    """
+    with ThreadPoolExecutor(max_workers=len(funcs)) as executor:
+        futures = [executor.submit(func) for func in funcs]
+        return [future.result() for future in futures]
+
+
 def get_user() -> User:
     conf = Config.get_instance()
     extras = conf.request_extras()
     url = '{}/user/show.json'.format(conf.api_url)
-    resp = requests.get(url, **extras)
+    resp = api_get(url, **extras)
     if resp.status_code == 403:
         report_error('Unauthorized: Invalid authentication information')
         exit(1)
@@ -38,7 +78,7 @@ def get_flags(team=None):
     if team:
         url = '{}?team_number={}'.format(url, team)
 
-    resp = requests.get(url, **extras)
+    resp = api_get(url, **extras)
     resp.raise_for_status()
     resp = resp.json()
 
@@ -72,7 +112,7 @@ def get_teams() -> list:
     conf = Config.get_instance()
     url = '{}/teams.json'.format(conf.api_url)
 
-    resp = requests.get(url)
+    resp = api_get(url)
     resp.raise_for_status()
     resp = resp.json()
     return resp
@@ -88,7 +128,7 @@ def get_service_status() -> list:
     conf = Config.get_instance()
     url = '{}/servicestatus.json'.format(conf.api_url)
 
-    resp = requests.get(url)
+    resp = api_get(url)
     resp.raise_for_status()
     return resp.json()
 
@@ -97,7 +137,7 @@ def get_services() -> list:
     conf = Config.get_instance()
     url = '{}/services.json'.format(conf.api_url)
 
-    resp = requests.get(url)
+    resp = api_get(url)
     resp.raise_for_status()
     return resp.json()
 
@@ -140,6 +180,27 @@ def report_success(msg):
     click.echo(msg)
 
 
+def report_progress(msg):
+    """
+    Show a progress line that is overwritten by the next progress line.
+
+    This is only shown when stdout is a terminal, otherwise it would
+    just clutter up logs.
+    """
+    if not sys.stdout.isatty():
+        return
+    click.echo('\r\033[K{} {}'.format(click.style('[-]', fg='cyan'), msg), nl=False)
+
+
+def clear_progress():
+    """
+    Clear the current progress line so other output can take its place.
+    """
+    if not sys.stdout.isatty():
+        return
+    click.echo('\r\033[K', nl=False)
+
+
 def parse_remote(remote: str) -> Tuple[str, str, int]:
     username = 'root'
     port = 22
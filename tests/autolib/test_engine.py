@@ -0,0 +1,223 @@
+import itertools
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from flag_slurper.autolib import engine
+
+
+def _result(value, not_before=None, resume=None):
+    return SimpleNamespace(service=value, value=value, deferred=not_before is not None, not_before=not_before,
+                           resume=resume)
+
+
+def _values(results):
+    return sorted(r.value for r in results)
+
+
+def test_run_async_calls_back_every_result():
+    results = []
+    engine.run_async(lambda s: _result(s * 2), [1, 2, 3], results.append, concurrency=2)
+    assert _values(results) == [2, 4, 6]
+
+
+def test_run_async_callback_on_calling_thread():
+    threads = set()
+    engine.run_async(_result, [1, 2, 3], lambda _: threads.add(threading.current_thread()), concurrency=3)
+    assert threads == {threading.current_thread()}
+
+
+def test_run_async_respects_concurrency():
+    lock = threading.Lock()
+    state = {'current': 0, 'peak': 0}
+    barrier = threading.Event()
+
+    def _pwn(service):
+        with lock:
+            state['current'] += 1
+            state['peak'] = max(state['peak'], state['current'])
+        barrier.wait(0.05)
+        with lock:
+            state['current'] -= 1
+        return _result(service)
+
+    engine.run_async(_pwn, range(10), lambda _: None, concurrency=3)
+    assert state['peak'] <= 3
+
+
+def test_run_async_invalid_concurrency():
+    with pytest.raises(ValueError, match='concurrency must be at least 1'):
+        engine.run_async(_result, [], lambda _: None, concurrency=0)
+
+
+class Deferring:
+    """
+    Defers service 1 once, then finishes it with the resume state it was given.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, service, resume=None):
+        self.calls.append((service, resume))
+        if service == 1 and resume is None:
+            return _result(service, not_before=0, resume={'left': [2]})
+        return _result(service if resume is None else resume['left'])
+
+
+@pytest.mark.parametrize('run', [
+    engine.run_serial,
+    lambda func, services, callback: engine.run_async(func, services, callback, concurrency=2),
+])
+def test_engines_reschedule_deferred(run):
+    func = Deferring()
+    results = []
+    run(func, [1, 3], results.append)
+    assert sorted(map(str, (r.value for r in results))) == ['3', '[2]']
+    assert (1, {'left': [2]}) in func.calls
+
+
+def test_run_serial_in_order():
+    results = []
+    engine.run_serial(lambda s: _result(s + 1), [1, 2, 3], results.append)
+    assert [r.value for r in results] == [2, 3, 4]
+
+
+def test_run_pool_streams_results():
+    results = []
+    engine.run_pool(_pool_result, [-1, -2, -3], results.append, processes=2)
+    assert _values(results) == [1, 2, 3]
+
+
+def _pool_result(service):
+    return _result(abs(service))
+
+
+def test_schedule_orders_by_not_before():
+    now = [100]
+    schedule = engine.Schedule(['a', 'b'], clock=lambda: now[0])
+    assert schedule.pop_ready() == ('a', None)
+    schedule.push('a', 150, {'resume': True})
+    assert schedule.pop_ready() == ('b', None)
+    assert schedule.pop_ready() is None
+    assert schedule.wait_time() == 50
+    now[0] = 150
+    assert schedule.pop_ready() == ('a', {'resume': True})
+    assert not schedule
+    assert schedule.wait_time() is None
+
+
+def test_progress():
+    clock = itertools.chain([0], itertools.repeat(10)).__next__
+    progress = engine.Progress(4, clock=clock)
+    progress.advance()
+    assert progress.rate == 0.1
+    assert progress.eta == 30
+    assert str(progress) == '1/4 done, 0.1/s, ETA 0:00:30'
+
+
+def test_progress_without_results():
+    progress = engine.Progress(4, clock=lambda: 0)
+    assert progress.rate == 0
+    assert progress.eta is None
+    assert str(progress) == '0/4 done, 0.0/s, ETA ?'
+
+
+@pytest.mark.parametrize('run', [engine.run_serial, lambda f, s, c: engine.run_async(f, s, c, concurrency=2)])
+def test_engines_repeat_when_callback_returns_time(run):
+    seen = []
+
+    def _callback(result):
+        seen.append(result.service)
+        if seen.count(result.service) < 3:
+            return time.time()
+
+    run(lambda service: _result(service), ['a', 'b'], _callback)
+    assert sorted(seen) == ['a', 'a', 'a', 'b', 'b', 'b']
+
+
+def test_schedule_start_times():
+    services = [SimpleNamespace(id=1), SimpleNamespace(id=2)]
+    schedule = engine.Schedule(services, clock=lambda: 10, start={1: 20})
+    assert schedule.pop_ready() == (services[1], None)
+    assert schedule.pop_ready() is None
+    assert schedule.wait_time() == 10
+
+
+@pytest.mark.parametrize('previous,success,result,expected', [
+    ((None, None), False, {}, 60),
+    ((60, False), True, {}, 60),
+    ((60, False), False, {}, 120),
+    ((480, False), False, {}, 600),
+    ((240, True), True, {}, 240),
+    ((240, True), False, {'skipped': True}, 600),
+    ((480, False), False, {'timed_out': True}, 60),
+])
+def test_recheck(previous, success, result, expected):
+    recheck = engine.Recheck(60, 600)
+    result = SimpleNamespace(success=success, skipped=result.get('skipped', False),
+                             timed_out=result.get('timed_out', False))
+    assert recheck.interval(result, *previous) == expected
+
+
+def _slow_result(service):
+    if service.id == 1:
+        time.sleep(1)
+    return _result(service)
+
+
+@pytest.mark.parametrize('run', [
+    lambda f, s, c: engine.run_async(f, s, c, concurrency=2, deadline=0.2),
+    lambda f, s, c: engine.run_pool(f, s, c, processes=2, deadline=0.2),
+])
+def test_engines_give_up_after_deadline(run):
+    services = [SimpleNamespace(id=1, service_url='shell.team1', service_port=22, protocol=None),
+                SimpleNamespace(id=2, service_url='shell.team2', service_port=22, protocol=None)]
+    results = []
+    run(_slow_result, services, results.append)
+    timed_out = {r.service.id: getattr(r, 'timed_out', False) for r in results}
+    assert timed_out == {1: True, 2: False}
+
+
+def _stuck_result(service):
+    time.sleep(0.6 if service.id == 1 else 0.05)
+    return _result(service)
+
+
+@pytest.mark.parametrize('run', [
+    lambda f, s, c, late: engine.run_async(f, s, c, concurrency=1, deadline=0.3, on_late=late),
+    lambda f, s, c, late: engine.run_pool(f, s, c, processes=1, deadline=0.3, on_late=late),
+])
+def test_engines_deadline_starts_with_attack(run):
+    services = [SimpleNamespace(id=1, service_url='shell.team1', service_port=22, protocol=None),
+                SimpleNamespace(id=2, service_url='shell.team2', service_port=22, protocol=None)]
+    results, late = [], []
+    run(_stuck_result, services, results.append, late.append)
+    # Service 2 waits for service 1's worker to come back, but still gets its full deadline once it starts
+    timed_out = {r.service.id: getattr(r, 'timed_out', False) for r in results}
+    assert timed_out == {1: True, 2: False}
+    # What service 1 eventually found isn't thrown away
+    assert [r.service.id for r in late] == [1]
+
+
+def _flaky_result(service):
+    if service.id == 1:
+        raise RuntimeError('plugin exploded')
+    return _result(service)
+
+
+@pytest.mark.parametrize('run', [
+    engine.run_serial,
+    lambda f, s, c: engine.run_async(f, s, c, concurrency=2),
+    lambda f, s, c: engine.run_pool(f, s, c, processes=2),
+])
+def test_engines_survive_errors(run):
+    services = [SimpleNamespace(id=1, service_url='shell.team1', service_port=22, protocol=None),
+                SimpleNamespace(id=2, service_url='shell.team2', service_port=22, protocol=None)]
+    results = []
+    run(_flaky_result, services, results.append)
+    failed = {r.service.id: (r.success, r.message) for r in results if hasattr(r, 'success')}
+    assert failed == {1: (False, "Error: RuntimeError('plugin exploded')")}
+    assert len(results) == 2
@@ -1,9 +1,15 @@
-from datetime import datetime, timedelta
 import socket
+import time
+from collections import deque
 
 import pytest
 
-from flag_slurper.autolib.governor import Governor
+from flag_slurper.autolib.governor import Governor, GovernorStore, ResolverCache, throttle
+
+
+def _attempts(*minutes_ago):
+    now = time.monotonic()
+    return deque(now - minutes * 60 for minutes in minutes_ago)
 
 
 @pytest.fixture
@@ -22,44 +28,70 @@ def test_governor_singleton():
     assert gov.times == 3
 
 
-def test_governor_tracks(mocker, governor):
-    sleep = mocker.patch('flag_slurper.autolib.governor.time.sleep')
-    governor.attempt('192.168.1.113')
-    assert not sleep.called
+def test_governor_tracks(governor):
+    assert governor.attempt('192.168.1.113') is None
+    assert len(governor.limits['192.168.1.113']) == 1
 
 
 def test_governor_filter(governor):
-    governor.limits['192.168.1.113'] = [datetime.now() - timedelta(minutes=3),
-                                        datetime.now() - timedelta(minutes=29),
-                                        datetime.now() - timedelta(minutes=1),
-                                        datetime.now() - timedelta(minutes=35)]
+    governor.limits['192.168.1.113'] = _attempts(35, 29, 3, 1)
     governor.filter('192.168.1.113')
     assert len(governor.limits['192.168.1.113']) == 3
 
 
+def test_governor_sweep_drops_idle_ips(governor):
+    governor.limits['192.168.1.113'] = _attempts(35, 31)
+    governor.slots['192.168.1.113'] = time.time() - 60
+    governor.limits['192.168.1.114'] = _attempts(35, 1)
+    governor.sweep()
+    assert list(governor.limits) == ['192.168.1.114']
+    assert len(governor.limits['192.168.1.114']) == 1
+    assert governor.slots == {}
+
+
+def test_governor_sweeps_once_per_window(mocker, governor):
+    sweep = mocker.spy(governor, 'sweep')
+    governor.attempt('192.168.1.113')
+    assert not sweep.called
+    governor.last_sweep -= governor.window + 1
+    governor.attempt('192.168.1.113')
+    assert sweep.call_count == 1
+
+
 def test_governor_limits(mocker, governor):
-    governor.limits['192.168.1.113'] = [datetime.now() - timedelta(minutes=3),
-                                        datetime.now() - timedelta(minutes=29),
-                                        datetime.now() - timedelta(minutes=1),
-                                        datetime.now() - timedelta(minutes=35)]
+    governor.limits['192.168.1.113'] = _attempts(35, 29, 3, 1)
     sleep = mocker.patch('flag_slurper.autolib.governor.time.sleep')
-    governor.attempt('192.168.1.113')
-    assert sleep.called
+    clock = mocker.patch('flag_slurper.autolib.governor.time.time')
+    clock.return_value = 1000
+    assert governor.attempt('192.168.1.113') == 1000 + governor.delay
+    assert not sleep.called
+    assert len(governor.limits['192.168.1.113']) == 3
+
+
+def test_governor_spaces_attempts_over_limit(mocker, governor):
+    clock = mocker.patch('flag_slurper.autolib.governor.time.time')
+    clock.return_value = 1000
+    for _ in range(governor.times):
+        assert governor.attempt('192.168.1.113') is None
+    assert governor.attempt('192.168.1.113') == 1300
+    assert governor.attempt('192.168.1.114') is None
+
+    clock.return_value = 1299
+    assert governor.attempt('192.168.1.113') == 1300
+    clock.return_value = 1300
+    assert governor.attempt('192.168.1.113') is None
+    assert governor.attempt('192.168.1.113') == 1600
 
 
 def test_governer_doesnt_limit_when_disabled(mocker):
     Governor.instance = None
     governor = Governor.get_instance(False)
-    governor.limits['192.168.1.113'] = [datetime.now() - timedelta(minutes=3),
-                                        datetime.now() - timedelta(minutes=29),
-                                        datetime.now() - timedelta(minutes=1),
-                                        datetime.now() - timedelta(minutes=35)]
-    sleep = mocker.patch('flag_slurper.autolib.governor.time.sleep')
-    governor.attempt('192.168.1.113')
-    assert not sleep.called
+    governor.limits['192.168.1.113'] = _attempts(35, 29, 3, 1)
+    assert governor.attempt('192.168.1.113') is None
 
 
 def test_governor_resolve(mocker):
+    Governor.resolver.clear()
     addrhost = mocker.patch('flag_slurper.autolib.governor.socket.gethostbyname')
     addrhost.return_value = '192.168.1.113'
     ipaddr = Governor.resolve_url('example.com')
@@ -68,6 +100,7 @@ def test_governor_resolve(mocker):
 
 
 def test_governor_resolve_failure(mocker):
+    Governor.resolver.clear()
     addrhost = mocker.patch('flag_slurper.autolib.governor.socket.gethostbyname')
     addrhost.side_effect = socket.gaierror()
     ipaddr = Governor.resolve_url('invalid.invalid')
@@ -75,8 +108,85 @@ def test_governor_resolve_failure(mocker):
     assert ipaddr is None
 
 
-def test_governor_does_not_limit_invalid_ip(mocker, governor):
-    governor.attempt(None)
-    sleep = mocker.patch('flag_slurper.autolib.governor.time.sleep')
+def test_governor_does_not_limit_invalid_ip(governor):
+    assert governor.attempt(None) is None
     assert len(governor.limits) == 0
-    assert not sleep.called
+
+
+@pytest.fixture
+def store(tmpdir):
+    return GovernorStore(str(tmpdir.join('governor.sqlite3')))
+
+
+def test_governor_store_counts_window(store):
+    for _ in range(3):
+        assert store.acquire('192.168.1.113', 60, 3, 10) is None
+    assert store.acquire('192.168.1.113', 60, 3, 10) is not None
+    assert store.acquire('192.168.1.114', 60, 3, 10) is None
+
+
+def test_governor_store_expires(store, mocker):
+    clock = mocker.patch('flag_slurper.autolib.governor.time.time')
+    clock.return_value = 1000
+    assert store.acquire('192.168.1.113', 60, 1, 10) is None
+    assert store.acquire('192.168.1.113', 60, 1, 10) == 1010
+    clock.return_value = 1061
+    assert store.acquire('192.168.1.113', 60, 1, 10) is None
+
+
+def test_governor_store_is_shared(store):
+    other = GovernorStore(store.path)
+    assert store.acquire('192.168.1.113', 60, 1, 10) is None
+    assert other.acquire('192.168.1.113', 60, 1, 10) is not None
+
+
+def test_governor_limits_with_store(governor, store):
+    governor.store = store
+    for _ in range(governor.times):
+        assert governor.attempt('192.168.1.113') is None
+    assert governor.attempt('192.168.1.113') is not None
+    assert len(governor.limits) == 0
+
+
+@pytest.mark.parametrize('count,slot,now,expected', [
+    (2, None, 100, (None, None)),
+    (3, None, 100, (110, 110)),
+    (3, 110, 105, (110, 110)),
+    (3, 110, 110, (None, 120)),
+])
+def test_throttle(count, slot, now, expected):
+    assert throttle(count, slot, now, 3, 10) == expected
+
+
+@pytest.fixture
+def resolver():
+    return ResolverCache(ttl=60, negative_ttl=10)
+
+
+def test_resolver_caches(mocker, resolver):
+    addrhost = mocker.patch('flag_slurper.autolib.governor.socket.gethostbyname', return_value='192.168.1.113')
+    assert resolver.resolve('example.com') == '192.168.1.113'
+    assert resolver.resolve('example.com') == '192.168.1.113'
+    assert addrhost.call_count == 1
+
+
+def test_resolver_negative_cache(mocker, resolver):
+    addrhost = mocker.patch('flag_slurper.autolib.governor.socket.gethostbyname', side_effect=socket.gaierror())
+    assert resolver.resolve('invalid.invalid') is None
+    assert resolver.resolve('invalid.invalid') is None
+    assert addrhost.call_count == 1
+
+
+def test_resolver_expires(mocker, resolver):
+    addrhost = mocker.patch('flag_slurper.autolib.governor.socket.gethostbyname', return_value='192.168.1.113')
+    clock = mocker.patch('flag_slurper.autolib.governor.time.monotonic', return_value=1000)
+    resolver.resolve('example.com')
+    clock.return_value = 1061
+    resolver.resolve('example.com')
+    assert addrhost.call_count == 2
+
+
+def test_resolver_resolve_all(mocker, resolver):
+    mocker.patch('flag_slurper.autolib.governor.socket.gethostbyname', side_effect=lambda host: host.upper())
+    assert resolver.resolve_all(['a', 'b', 'a']) == {'a': 'A', 'b': 'B'}
+    assert resolver.resolve_all([]) == {}
@@ -1,6 +1,7 @@
 import click
+from peewee import SqliteDatabase
 
-from flag_slurper.autolib.models import CaptureNote, Flag
+from flag_slurper.autolib.models import CaptureNote, Credential, Flag, upgrade
 
 SUDO_FLAG = click.style('!', fg='red', bold=True)
 
@@ -44,3 +45,46 @@ def test_flag_on_delete_cascade(team, flag):
     team.delete().execute()
     after = Flag.select().count()
     assert initial - after == 1
+
+
+def test_upgrade_adds_missing_columns(tmpdir):
+    database = SqliteDatabase(str(tmpdir.join('old.sqlite3')))
+    database.execute_sql('CREATE TABLE credential (id INTEGER PRIMARY KEY, state VARCHAR(255), bag_id INTEGER, '
+                         'service_id INTEGER, sudo INTEGER)')
+    database.execute_sql('CREATE TABLE service (id INTEGER PRIMARY KEY, service_port INTEGER)')
+    upgrade(database)
+    assert 'checked' in {column.name for column in database.get_columns('credential')}
+    assert 'protocol' in {column.name for column in database.get_columns('service')}
+
+    # Already up to date
+    upgrade(database)
+
+
+def test_upgrade_adds_indexes(tmpdir):
+    database = SqliteDatabase(str(tmpdir.join('old.sqlite3')))
+    database.execute_sql('CREATE TABLE credential (id INTEGER PRIMARY KEY, state VARCHAR(255), bag_id INTEGER, '
+                         'service_id INTEGER, sudo INTEGER, checked DATETIME)')
+    database.execute_sql('CREATE TABLE capturenote (id INTEGER PRIMARY KEY, flag_id INTEGER, service_id INTEGER, '
+                         'used_creds_id INTEGER)')
+    database.execute_sql("INSERT INTO credential (bag_id, service_id, state, sudo) VALUES (1, 1, 'reject', 0), "
+                         "(1, 1, 'works', 1), (1, 2, 'reject', 0)")
+    database.execute_sql('INSERT INTO capturenote (flag_id, service_id, used_creds_id) VALUES (1, 1, 2)')
+
+    with database.bind_ctx([Credential, CaptureNote]):
+        upgrade(database)
+        assert [(c.id, c.service_id, c.state, c.sudo) for c in Credential.select().order_by(Credential.id)] == \
+            [(1, 1, Credential.WORKS, True), (3, 2, Credential.REJECT, False)]
+        assert CaptureNote.select(CaptureNote.used_creds).scalar() == 1
+
+    indexes = {tuple(index.columns): index.unique for index in database.get_indexes('credential')}
+    assert indexes[('bag_id', 'service_id')] is True
+    assert indexes[('state',)] is False
+
+    # Already up to date
+    upgrade(database)
+
+
+def test_upgrade_empty_database(tmpdir):
+    database = SqliteDatabase(str(tmpdir.join('new.sqlite3')))
+    upgrade(database)
+    assert not database.get_tables()
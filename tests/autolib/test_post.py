@@ -1,10 +1,13 @@
+import tarfile
 from io import BytesIO, StringIO
 from textwrap import dedent
 
+import paramiko
 import pytest
 from schema import SchemaError, Optional
 
 from flag_slurper.autolib import post, models
+from flag_slurper.autolib.sessions import SSHSessions
 
 SHADOW_FILE = dedent("""
 root:$6$tLFrPk73$3dvrIViNCOl8F4ib63vWlliwqklJofCqIv0.Oc5.rTEKr4KOU5jzYNhoRf9E6.6xSjfLd66UpCThA0Vk4ntOu/:18349:0:99999:7:::
@@ -60,6 +63,27 @@ def test_plugin_registered():
     assert 'test' in pm.registry
 
 
+def test_plugin_configuration_is_thread_local():
+    import threading
+
+    pm = post.PluginRegistry()
+    pm.register(TestPlugin)
+    pm.configure([{'test': {'foo': 'bar'}}])
+
+    seen = {}
+
+    def _worker():
+        seen['config'] = pm.registry['test'].config
+        seen['run_plugins'] = pm.run_plugins
+
+    thread = threading.Thread(target=_worker)
+    thread.start()
+    thread.join()
+
+    assert pm.registry['test'].config == {'foo': 'bar'}
+    assert seen == {'config': None, 'run_plugins': []}
+
+
 def test_register_non_subclass():
     pm = post.PluginRegistry()
     with pytest.raises(ValueError, match='Plugins must extend PostPlugin'):
@@ -153,6 +177,13 @@ def test_ssh_plugin_predicate_accepts(service):
     assert plugin.predicate(service, post.PostContext())
 
 
+def test_ssh_plugin_predicate_accepts_detected_ssh(service):
+    plugin = post.SSHFileExfil()
+    service.service_port = 2222
+    service.protocol = 'ssh'
+    assert plugin.predicate(service, post.PostContext())
+
+
 def test_ssh_plugin_predicate_rejects(service):
     plugin = post.SSHFileExfil()
     assert not plugin.predicate(service, post.PostContext())
@@ -167,17 +198,117 @@ def test_ssh_plugin_run(service, mocker, sudobag, sudocred):
     validate = mocker.patch('flag_slurper.autolib.post.Schema.validate')
     validate.return_value = {}
 
-    run_sudo = mocker.patch('flag_slurper.autolib.post.run_sudo')
+    run_sudo = mocker.patch('flag_slurper.autolib.exploit.run_sudo')
     run_sudo.return_value = [StringIO(), BytesIO(b""), BytesIO()]
 
     ssh.exec_command.return_value = [StringIO(), BytesIO(b""), BytesIO()]
-    context = post.PostContext(ssh=ssh, credentials=[sudocred.bag])
+    sessions = SSHSessions()
+    sessions.add(service.service_url, service.service_port, sudobag.username, ssh)
+    context = post.PostContext(sessions=sessions, credentials=[sudocred.bag])
 
     plugin = post.SSHFileExfil()
     plugin.run(service, context)
 
     assert run_sudo.called
-    assert ssh.exec_command.called
+    assert not ssh.connect.called
+    commands = [c[0][1] for c in run_sudo.call_args_list] + [c[0][0] for c in ssh.exec_command.call_args_list]
+    assert not [c for c in commands if c.startswith('file ')]
+
+
+def _archive(files):
+    data = BytesIO()
+    with tarfile.open(fileobj=data, mode='w:gz') as tar:
+        for path, contents in files.items():
+            info = tarfile.TarInfo(path.lstrip('/'))
+            info.size = len(contents)
+            tar.addfile(info, BytesIO(contents))
+    return data.getvalue()
+
+
+def test_ssh_plugin_bulk(service, mocker, sudobag, sudocred):
+    sudocred.bag.save()
+    sudocred.save()
+    models.File.create(service=service, path='/etc/passwd', contents=b'old')
+
+    get_archive = mocker.patch('flag_slurper.autolib.post.get_archive')
+    get_archive.return_value = _archive({
+        '/etc/passwd': b'root:x:0:0:root:/root:/bin/bash\n',
+        '/etc/cron.daily/backup': b'#!/bin/sh\nbackup\n',
+    })
+    ssh = mocker.MagicMock()
+    sessions = SSHSessions()
+    sessions.add(service.service_url, service.service_port, sudobag.username, ssh)
+
+    plugin = post.SSHFileExfil()
+    context = post.PostContext(sessions=sessions, credentials=[sudocred.bag])
+    plugin.run(service, context)
+    context.records.commit()
+
+    assert get_archive.call_args[0][2] == 'cdc'
+    assert not ssh.exec_command.called
+    files = {f.path: f for f in models.File.select().where(models.File.service == service)}
+    assert set(files) == {'/etc/passwd', '/etc/cron.daily/backup'}
+    assert files['/etc/passwd'].contents.tobytes() == b'old'
+    assert files['/etc/cron.daily/backup'].info == 'sh script, ASCII text executable'
+    assert files['/etc/cron.daily/backup'].mime_type == 'text/x-shellscript; charset=us-ascii'
+
+
+def test_ssh_plugin_bulk_invalid_archive_falls_back(service, mocker, sudobag, sudocred):
+    sudocred.bag.save()
+    sudocred.save()
+    mocker.patch('flag_slurper.autolib.post.get_archive', return_value=b'not a tarball')
+    post_files = mocker.patch.object(post.SSHFileExfil, '_post_files', return_value=True)
+    ssh = mocker.MagicMock()
+    sessions = SSHSessions()
+    sessions.add(service.service_url, service.service_port, sudobag.username, ssh)
+
+    plugin = post.SSHFileExfil()
+    plugin.run(service, post.PostContext(sessions=sessions, credentials=[sudocred.bag]))
+    assert post_files.called
+
+
+def test_ssh_plugin_uses_credentials_found_this_run(service, mocker, sudobag):
+    sudobag.save()
+    context = post.PostContext(credentials=[sudobag])
+    context.records.credential(sudobag, service, works=True, sudo=True)
+    ssh = mocker.MagicMock()
+    sessions = SSHSessions()
+    sessions.add(service.service_url, service.service_port, sudobag.username, ssh)
+    context['sessions'] = sessions
+    archive = _archive({'/etc/shadow': SHADOW_FILE.encode('utf-8')})
+    mocker.patch('flag_slurper.autolib.post.get_archive', return_value=archive)
+
+    post.SSHFileExfil().run(service, context)
+    post.ShadowExtractor().run(service, context)
+    assert models.File.select().count() == 0
+
+    context.records.commit()
+    assert models.File.select().count() == 1
+    assert models.ShadowEntry.select().count() == 2
+
+
+def test_ssh_plugin_skips_credentials_that_failed_this_run(service, mocker, sudobag, sudocred):
+    sudocred.bag.save()
+    sudocred.save()
+    context = post.PostContext(sessions=SSHSessions(), credentials=[sudobag])
+    context.records.credential(sudobag, service, works=False)
+    connect = mocker.patch.object(SSHSessions, 'connect')
+    post_creds = mocker.patch.object(post.SSHFileExfil, '_post')
+
+    post.SSHFileExfil().run(service, context)
+    assert not connect.called
+    assert not post_creds.called
+
+
+def test_ssh_plugin_skips_credentials_that_no_longer_log_in(service, mocker, sudobag, sudocred):
+    sudocred.bag.save()
+    sudocred.save()
+    context = post.PostContext(sessions=SSHSessions(), credentials=[sudobag])
+    mocker.patch.object(SSHSessions, 'connect', side_effect=paramiko.AuthenticationException())
+    post_creds = mocker.patch.object(post.SSHFileExfil, '_post')
+
+    post.SSHFileExfil().run(service, context)
+    assert not post_creds.called
 
 
 def test_shadow_plugin_predicate_accepts(service):
@@ -186,6 +317,13 @@ def test_shadow_plugin_predicate_accepts(service):
     assert plugin.predicate(service, post.PostContext())
 
 
+def test_shadow_plugin_predicate_accepts_detected_ssh(service):
+    plugin = post.ShadowExtractor()
+    service.service_port = 2222
+    service.protocol = 'ssh'
+    assert plugin.predicate(service, post.PostContext())
+
+
 def test_shadow_plugin_predicate_rejects(service):
     plugin = post.ShadowExtractor()
     assert not plugin.predicate(service, post.PostContext())
@@ -197,7 +335,9 @@ def test_shadow_plugin_run(service, mocker):
 
     plugin = post.ShadowExtractor()
     plugin.run(service, context)
+    assert models.ShadowEntry.select().count() == 0
 
+    context.records.commit()
     assert models.ShadowEntry.select().count() == 2
 
     entry = models.ShadowEntry.select().first()
@@ -0,0 +1,57 @@
+from types import SimpleNamespace
+
+import pytest
+
+from flag_slurper.autolib import models, priority
+
+
+@pytest.fixture
+def bags(db):
+    return [models.CredentialBag.create(username='root', password='cdc'),
+            models.CredentialBag.create(username='cdc', password='cdc')]
+
+
+def _service(team, name):
+    return models.Service.create(service_name=name, service_port=22, service_url='shell.team{}'.format(team.number),
+                                 team=team)
+
+
+@pytest.fixture
+def teams(db):
+    return [models.Team.create(id=number, name='CDC Team {}'.format(number), number=number,
+                               domain='team{}.isucdc.com'.format(number)) for number in (1, 2)]
+
+
+def test_hit_rates(teams, bags):
+    root, cdc = bags
+    for team in teams:
+        shell = _service(team, 'Shell SSH')
+        models.Credential.create(bag=root, service=shell, state=models.Credential.REJECT)
+        models.Credential.create(bag=cdc, service=shell, state=models.Credential.WORKS)
+
+    rates = priority.hit_rates()
+    assert rates == {(root.id, 'Shell SSH'): 0.25, (cdc.id, 'Shell SSH'): 0.75}
+    assert priority.hit_rates('WWW SSH') == {}
+
+
+def test_rank_credentials(bags):
+    root, cdc = bags
+    service = SimpleNamespace(service_name='Shell SSH')
+    rates = {(cdc.id, 'Shell SSH'): 0.75}
+    assert priority.rank_credentials(bags, service, rates) == [cdc, root]
+    assert priority.rank_credentials(bags, service, {}) == [root, cdc]
+
+
+def test_rank_services_interleaves_teams():
+    def _service(team, name):
+        return SimpleNamespace(team_id=team, service_name=name)
+
+    services = [_service(1, 'WWW HTTP'), _service(1, 'Shell SSH'), _service(1, 'DB SSH'),
+                _service(2, 'WWW HTTP'), _service(2, 'DB SSH')]
+    rates = {(1, 'Shell SSH'): 0.9, (1, 'DB SSH'): 0.6, (2, 'WWW HTTP'): 0.2}
+    ranked = priority.rank_services(services, rates)
+    assert [(s.team_id, s.service_name) for s in ranked] == [
+        (1, 'Shell SSH'), (2, 'DB SSH'),
+        (1, 'DB SSH'), (2, 'WWW HTTP'),
+        (1, 'WWW HTTP'),
+    ]
@@ -1,5 +1,13 @@
+from datetime import datetime, timedelta
+from io import BytesIO, StringIO
+
+import paramiko
+import pytest
+
+from flag_slurper.autolib import protocols
+from flag_slurper.autolib.models import Credential, CredentialBag
 from flag_slurper.autolib.post import PostContext
-from flag_slurper.autolib.protocols import pwn_smtp
+from flag_slurper.autolib.protocols import pwn_api_exec, pwn_smtp, pwn_ssh
 
 
 def test_smtp_failure(mocker, service):
@@ -18,9 +26,155 @@ def test_smtp_non_relay(mocker, service):
     assert message == 'Not an open-relay'
 
 
+def test_smtp_timeout(mocker, service):
+    smtp = mocker.patch('flag_slurper.autolib.protocols.SMTP')
+    pwn_smtp(service.service_url, 25, service, [], None, PostContext())
+    assert smtp.call_args[1]['timeout'] == 10
+
+
 def test_smtp_success(mocker, service):
     smtp = mocker.patch('flag_slurper.autolib.protocols.SMTP')
     smtp.return_value.__enter__.return_value.docmd.return_value = (250, b'Ok')
     message, success, _ = pwn_smtp(service.service_url, 25, service, [], None, PostContext())
     assert success
     assert message == 'Open Relay detected'
+
+
+def test_api_exec_uses_port(mocker, service):
+    post = mocker.patch('flag_slurper.autolib.protocols.requests.post')
+    post.return_value.status_code = 404
+    message, success, _ = pwn_api_exec(service.service_url, 8080, service, [], None, PostContext())
+    assert not success
+    assert post.call_args[0][0] == 'http://www.team1.isucdc.com:8080/api/exec'
+
+
+@pytest.fixture
+def ssh_bags(db):
+    return [CredentialBag.create(username='root', password='cdc'),
+            CredentialBag.create(username='cdc', password='cdc'),
+            CredentialBag.create(username='chris', password='cdc')]
+
+
+@pytest.fixture
+def ssh_clients(mocker):
+    """
+    Every login except root:cdc fails.
+    """
+    def _client():
+        client = mocker.MagicMock()
+
+        def _connect(url, port, username, password, **kwargs):
+            if username != 'root':
+                raise paramiko.ssh_exception.AuthenticationException()
+        client.connect.side_effect = _connect
+        client.exec_command.return_value = [StringIO(), BytesIO(b""), BytesIO(b"")]
+        return client
+    return mocker.patch('flag_slurper.autolib.protocols._get_ssh_client', side_effect=_client)
+
+
+def test_ssh_logins_serial_tries_everything(ssh_bags, ssh_clients):
+    logins, not_before = protocols._ssh_logins('shell.team1', 22, ssh_bags, workers=1)
+    assert not_before is None
+    assert [bag.username for bag, _ in logins] == ['root', 'cdc', 'chris']
+    assert [login is not None for _, login in logins] == [True, False, False]
+
+
+def test_ssh_logins_fan_out_stops_at_root(ssh_bags, ssh_clients):
+    logins, not_before = protocols._ssh_logins('shell.team1', 22, ssh_bags, workers=2)
+    assert not_before is None
+    assert [bag.username for bag, login in logins if login] == ['root']
+    assert len(logins) <= len(ssh_bags)
+
+
+def test_ssh_logins_use_timeouts(ssh_bags, ssh_clients):
+    logins, _ = protocols._ssh_logins('shell.team1', 22, ssh_bags[:1], workers=1)
+    kwargs = logins[0][1][0].connect.call_args[1]
+    assert kwargs['timeout'] == kwargs['banner_timeout'] == kwargs['auth_timeout'] == 10
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_ssh_logins_stop_at_deadline(ssh_bags, ssh_clients, workers):
+    logins, not_before = protocols._ssh_logins('shell.team1', 22, ssh_bags, workers, deadline=0)
+    assert logins == []
+    assert not_before is None
+
+
+def test_pwn_ssh_times_out(service, ssh_bags, ssh_clients):
+    context = PostContext(deadline=0)
+    message, success, skipped = pwn_ssh(service.service_url, 22, service, [], None, context)
+    assert context['timed_out']
+    assert message == 'Ran out of time after 0 credential(s)'
+    assert not success
+
+
+def test_ssh_logins_fan_out_governed(ssh_bags, ssh_clients, mocker):
+    attempt = mocker.patch('flag_slurper.autolib.protocols.Governor.attempt', return_value=None)
+    mocker.patch('flag_slurper.autolib.protocols.Governor.resolve_url', return_value='10.0.0.1')
+    logins, _ = protocols._ssh_logins('shell.team1', 22, ssh_bags, workers=3)
+    assert attempt.call_count == len(logins)
+
+
+def test_pwn_ssh_records_credentials(service, ssh_bags, ssh_clients):
+    context = PostContext()
+    message, success, skipped = pwn_ssh(service.service_url, 22, service, [], None, context)
+    assert success
+    assert not skipped
+    assert context['sessions'].get(service.service_url, 22, 'root') is not None
+    assert Credential.select().where(Credential.service == service).count() == 0
+
+    context.records.commit()
+    states = {c.bag.username: c.state for c in Credential.select().where(Credential.service == service)}
+    assert states == {'root': Credential.WORKS, 'cdc': Credential.REJECT, 'chris': Credential.REJECT}
+
+
+def test_pwn_ssh_incremental(service, ssh_bags, ssh_clients):
+    root, cdc, chris = ssh_bags
+    Credential.create(bag=root, service=service, state=Credential.WORKS, checked=datetime.now() - timedelta(hours=1))
+    Credential.create(bag=cdc, service=service, state=Credential.REJECT, checked=datetime.now())
+    context = PostContext(incremental=True)
+    message, success, skipped = pwn_ssh(service.service_url, 22, service, [], None, context)
+    assert success
+    assert not skipped
+    # The stale working credential is re-verified first, the recent reject is skipped
+    assert [fields['bag'] for kind, fields in context.records if kind == 'credential'] == [root.id, chris.id]
+
+
+def test_pwn_ssh_incremental_nothing_new(service, ssh_bags, ssh_clients):
+    for bag in ssh_bags:
+        Credential.create(bag=bag, service=service, state=Credential.REJECT, checked=datetime.now())
+    message, success, skipped = pwn_ssh(service.service_url, 22, service, [], None, PostContext(incremental=True))
+    assert not success
+    assert skipped
+    assert not ssh_clients.called
+
+
+def test_pwn_ssh_incremental_revokes(service, ssh_bags, ssh_clients):
+    root, cdc, chris = ssh_bags
+    Credential.create(bag=cdc, service=service, state=Credential.WORKS, checked=None)
+    context = PostContext(incremental=True)
+    pwn_ssh(service.service_url, 22, service, [], None, context)
+    context.records.commit()
+    assert Credential.get(Credential.bag == cdc).state == Credential.REJECT
+    assert Credential.get(Credential.bag == root).state == Credential.WORKS
+
+
+def test_pwn_ssh_deferred_then_resumed(service, ssh_bags, ssh_clients, mocker):
+    attempt = mocker.patch('flag_slurper.autolib.protocols.Governor.attempt')
+    mocker.patch('flag_slurper.autolib.protocols.Governor.resolve_url', return_value='10.0.0.1')
+
+    # The governor allows the first credential, then throttles
+    attempt.side_effect = [None, 1234.0]
+    context = PostContext()
+    message, success, _ = pwn_ssh(service.service_url, 22, service, [], None, context)
+    assert success
+    assert context['not_before'] == 1234.0
+    assert context['resume']['credentials'] == [bag.id for bag in ssh_bags[1:]]
+    assert len(context['resume']['working']) == 1
+
+    attempt.side_effect = None
+    attempt.return_value = None
+    resumed = PostContext(resume=context['resume'])
+    message, success, _ = pwn_ssh(service.service_url, 22, service, [], None, resumed)
+    assert success
+    assert 'not_before' not in resumed
+    assert attempt.call_count == 4
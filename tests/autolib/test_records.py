@@ -0,0 +1,151 @@
+import itertools
+from datetime import datetime
+
+import pytest
+
+from flag_slurper.autolib import models
+from flag_slurper.autolib.records import Records, RecordWriter
+
+
+@pytest.fixture
+def root(db):
+    return models.CredentialBag.create(username='root', password='cdc')
+
+
+def test_records_credential_never_rejects_working(service, root):
+    records = Records()
+    records.credential(root, service, works=True, sudo=True)
+    records.credential(root, service, works=False)
+    records.commit()
+
+    cred = models.Credential.get()
+    assert cred.state == models.Credential.WORKS
+    assert cred.sudo
+    assert len(records) == 0
+
+
+def test_records_credentials_batched(service, root, sudobag, mocker):
+    sudobag.save()
+    models.Credential.create(bag=root, service=service, state=models.Credential.REJECT)
+    records = Records()
+    records.credential(root, service, works=True, sudo=True)
+    records.credential(sudobag, service, works=False)
+
+    insert_many = mocker.spy(models.Credential, 'insert_many')
+    records.commit()
+    assert insert_many.call_count == 1
+
+    states = {c.bag.username: (c.state, c.sudo) for c in models.Credential.select()}
+    assert states == {'root': (models.Credential.WORKS, True), 'cdc': (models.Credential.REJECT, False)}
+    assert models.Credential.select().count() == 2
+
+
+def test_records_credentials_checked(service, root):
+    records = Records()
+    records.credential(root, service, works=False)
+    records.commit()
+    first = models.Credential.get().checked
+    assert first is not None
+
+    records.credential(root, service, works=False)
+    records.commit()
+    assert models.Credential.get().checked > first
+
+
+def test_records_credentials_failure_does_not_confirm_working(service, root, sudobag):
+    sudobag.save()
+    records = Records()
+    records.credential(root, service, works=True)
+    records.commit()
+    first = models.Credential.get().checked
+
+    records.credential(root, service, works=False)
+    records.credential(sudobag, service, works=True)
+    records.commit()
+    stored = models.Credential.get(models.Credential.bag == root)
+    assert stored.state == models.Credential.WORKS
+    assert stored.checked == first
+
+    records.credential(root, service, works=False, revoke=True)
+    records.commit()
+    stored = models.Credential.get(models.Credential.bag == root)
+    assert stored.state == models.Credential.REJECT
+    assert stored.checked > first
+
+
+def test_records_credentials_checked_per_pair(service, root, sudobag):
+    sudobag.save()
+    records = Records()
+    records.credential(root, service, works=True)
+    records.credential(sudobag, service, works=True)
+    records.commit()
+
+    records.credential(root, service, works=True)
+    records.credential(sudobag, service, works=True)
+    records.items[0][1]['checked'] = datetime(2020, 1, 1)
+    records.items[1][1]['checked'] = datetime(2020, 1, 2)
+    records.commit()
+    checked = {c.bag_id: c.checked for c in models.Credential.select()}
+    assert checked == {root.id: datetime(2020, 1, 1), sudobag.id: datetime(2020, 1, 2)}
+
+
+def test_records_capture_uses_recorded_credential(service, root):
+    records = Records()
+    records.credential(root, service, works=True)
+    records.flag(service.team, 'team1_www_root.flag')
+    records.capture(service.team, 'team1_www_root.flag', service, root, data='abc', location='/root/flag',
+                    notes='Linux')
+    records.capture(service.team, 'team1_www_root.flag', service, root, data='abc', location='/root/flag',
+                    notes='Linux')
+    records.commit()
+
+    assert models.Flag.select().count() == 1
+    note = models.CaptureNote.get()
+    assert note.used_creds.bag == root
+    assert not note.searched
+    assert models.CaptureNote.select().count() == 1
+
+
+def test_records_shadow_uses_recorded_file(service):
+    records = Records()
+    records.file(service, '/etc/shadow', b'root:x:::', 'ASCII text', 'text/plain')
+    records.file(service, '/etc/shadow', b'duplicate', 'ASCII text', 'text/plain')
+    records.shadow(service, '/etc/shadow', 'root', 'x')
+    records.commit()
+
+    assert models.File.select().count() == 1
+    entry = models.ShadowEntry.get()
+    assert entry.source.contents.tobytes() == b'root:x:::'
+
+
+def test_records_working(service, root, sudobag):
+    records = Records()
+    records.credential(root, service, works=True)
+    records.credential(sudobag, service, works=False)
+    assert records.working(service) == {root.id: False}
+
+
+def test_writer_batches(service, mocker):
+    write = mocker.patch('flag_slurper.autolib.records.write')
+    records = Records()
+    records.dns(service.team, 'www', 'www IN A 10.0.0.1')
+
+    with RecordWriter(batch_size=2, interval=60, clock=itertools.repeat(0).__next__) as writer:
+        writer.write(records)
+        assert not write.called
+        writer.write(records)
+        assert write.call_count == 1
+        writer.write(records)
+    assert write.call_count == 2
+
+
+def test_writer_flushes_on_interval(service, mocker):
+    write = mocker.patch('flag_slurper.autolib.records.write')
+    records = Records()
+    records.dns(service.team, 'www', 'www IN A 10.0.0.1')
+
+    writer = RecordWriter(batch_size=100, interval=5, clock=iter([0, 1, 6, 6]).__next__)
+    writer.write(records)
+    assert not write.called
+    writer.write(records)
+    assert write.call_args[0][0] == list(records) * 2
@@ -0,0 +1,60 @@
+from peewee import PostgresqlDatabase
+
+from flag_slurper.autolib import report
+from flag_slurper.autolib.models import SUDO_FLAG, CaptureNote, Credential, CredentialBag, Flag, Service
+
+
+def _services(team, count):
+    return [Service.create(remote_id=100 + i, service_id=100 + i, service_name='Shell SSH', service_port=22,
+                           service_url='shell{}.team1.isucdc.com'.format(i), team=team) for i in range(count)]
+
+
+def test_captures(team, mocker):
+    services = _services(team, 3)
+    flags = [Flag.create(team=team, name='Flag {}'.format(i)) for i in range(3)]
+    Flag.create(team=team, name='Not Found')
+    for flag, service in zip(flags, services):
+        CaptureNote.create(flag=flag, service=service, data='flag', location='/root/flag', notes='')
+    CaptureNote.create(flag=flags[0], service=services[1], data='flag', location='/home/flag', notes='Used Sudo')
+
+    execute_sql = mocker.spy(PostgresqlDatabase, 'execute_sql')
+    found = report.captures()
+    lines = [(flag.team.number, [(note.service.service_name, str(note)) for note in notes]) for flag, notes in found]
+
+    assert execute_sql.call_count == 1
+    assert [flag for flag, _ in found] == flags
+    assert lines[0] == (1, [('Shell SSH', '/root/flag -> flag'), ('Shell SSH', '/home/flag -> flag' + SUDO_FLAG)])
+
+
+def test_working_credentials(team, mocker):
+    services = _services(team, 3)
+    bags = [CredentialBag.create(username='root', password=str(i)) for i in range(3)]
+    for service in services[:2]:
+        for bag in bags:
+            Credential.create(bag=bag, service=service, state=Credential.WORKS, sudo=bag == bags[0])
+    Credential.create(bag=bags[0], service=services[2], state=Credential.REJECT)
+
+    execute_sql = mocker.spy(PostgresqlDatabase, 'execute_sql')
+    found = report.working_credentials()
+    lines = [(service.team.number, service.service_url, ",".join(map(str, creds))) for service, creds in found]
+
+    assert execute_sql.call_count == 1
+    assert lines == [(1, 'shell0.team1.isucdc.com', 'root:0' + SUDO_FLAG + ',root:1,root:2'),
+                     (1, 'shell1.team1.isucdc.com', 'root:0' + SUDO_FLAG + ',root:1,root:2')]
+
+
+def test_credential_summary(team, mocker):
+    services = _services(team, 2)
+    works = CredentialBag.create(username='root', password='cdc')
+    rejected = CredentialBag.create(username='admin', password='cdc')
+    for service in services:
+        Credential.create(bag=works, service=service, state=Credential.WORKS)
+        Credential.create(bag=rejected, service=service, state=Credential.REJECT)
+
+    execute_sql = mocker.spy(PostgresqlDatabase, 'execute_sql')
+    summary = report.credential_summary()
+
+    assert execute_sql.call_count == 1
+    assert {'username': 'root', 'password': 'cdc', 'hits': [{'team': 1, 'service': 'Shell SSH'}] * 2} in summary
+    assert {'username': 'admin', 'password': 'cdc', 'hits': []} in summary
+    assert report.credential_summary(['admin']) == [{'username': 'admin', 'password': 'cdc', 'hits': []}]
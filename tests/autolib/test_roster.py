@@ -0,0 +1,87 @@
+import pytest
+
+from flag_slurper.autolib import roster
+from flag_slurper.autolib.models import CaptureNote, Credential, CredentialBag, Flag, Service, Team
+
+SERVICES = {
+    'Shell SSH': {'name': 'Shell SSH', 'port': 22, 'url': 'shell.team{num}.isucdc.com'},
+    'WWW HTTP': {'name': 'WWW HTTP', 'port': 80, 'url': 'www.team{num}.isucdc.com'},
+}
+
+
+def _team(id, number):
+    return {'id': id, 'number': number, 'name': 'CDC Team {}'.format(number),
+            'team_url': 'team{}.isucdc.com'.format(number), 'guest_division': False}
+
+
+def _status(id, team_id, team_number, name):
+    return {'id': id, 'service_id': id + 100, 'team_id': team_id, 'team_number': team_number, 'service_name': name}
+
+
+def test_import_teams(db):
+    assert roster.import_teams([_team(1, 1), _team(2, 2)]) == (2, 0)
+    assert roster.import_teams([_team(1, 1), _team(2, 3)]) == (0, 1)
+    assert Team.get_by_id(2).number == 3
+    assert Team.select().where(Team.id.in_([1, 2])).count() == 2
+
+
+def test_import_services(db):
+    roster.import_teams([_team(1, 1), _team(2, 2)])
+    statuses = [_status(10, 1, 1, 'Shell SSH'), _status(11, 2, 2, 'Shell SSH'), _status(12, 3, 3, 'Shell SSH')]
+    assert roster.import_services(statuses, SERVICES.get) == (2, 0)
+    assert {s.service_url for s in Service.select()} == {'shell.team1.isucdc.com', 'shell.team2.isucdc.com'}
+
+    # Nothing changed
+    assert roster.import_services(statuses, SERVICES.get) == (0, 0)
+
+
+def test_import_services_moved(db):
+    roster.import_teams([_team(1, 1)])
+    roster.import_services([_status(10, 1, 1, 'Shell SSH'), _status(11, 1, 1, 'WWW HTTP')], SERVICES.get)
+    Service.update(protocol='ssh').execute()
+
+    services = dict(SERVICES)
+    services['Shell SSH'] = {'name': 'Shell SSH', 'port': 2222, 'url': 'shell.team{num}.isucdc.com'}
+    assert roster.import_services([_status(10, 1, 1, 'Shell SSH'), _status(11, 1, 1, 'WWW HTTP')],
+                                  services.get) == (0, 1)
+    moved = Service.get(Service.remote_id == 10)
+    assert moved.service_port == 2222
+    assert moved.protocol is None
+    assert Service.get(Service.remote_id == 11).protocol == 'ssh'
+
+
+def test_reconcile(db):
+    roster.import_teams([_team(1, 1), _team(2, 2)])
+    statuses = [_status(10, 1, 1, 'Shell SSH'), _status(11, 1, 1, 'WWW HTTP'), _status(12, 2, 2, 'Shell SSH')]
+    roster.import_services(statuses, SERVICES.get)
+    manual = Service.create(service_id=0, service_name='Custom', service_port=8080, service_url='team1.isucdc.com',
+                            team=1)
+    bag = CredentialBag.create(username='root', password='cdc')
+    for service in Service.select().where(Service.team.in_([1, 2])):
+        Credential.create(bag=bag, service=service, state=Credential.WORKS)
+    flag = Flag.create(team=2, name='Team 2 Flag')
+    CaptureNote.create(flag=flag, service=Service.get(Service.remote_id == 12), data='flag', location='/root/flag')
+
+    removed = roster.reconcile([_team(1, 1)], statuses[:1])
+
+    assert removed['services'] >= 2
+    assert removed['credentials'] >= 2
+    assert removed['capture notes'] >= 1
+    assert not Team.select().where(Team.id == 2).exists()
+    assert not Flag.select().where(Flag.id == flag.id).exists()
+    assert {s.remote_id for s in Service.select().where(Service.team == 1)} == {10, None}
+    kept = [Service.get(Service.remote_id == 10), manual]
+    assert Credential.select().where(Credential.service.in_(kept)).count() == 2
+
+
+def test_reconcile_no_teams(db):
+    with pytest.raises(ValueError):
+        roster.reconcile([], [])
+
+
+def test_reconcile_no_services(db):
+    roster.import_teams([_team(1, 1)])
+    roster.import_services([_status(10, 1, 1, 'Shell SSH')], SERVICES.get)
+    with pytest.raises(ValueError, match='no services'):
+        roster.reconcile([_team(1, 1)], [])
+    assert Service.select().where(Service.remote_id == 10).exists()
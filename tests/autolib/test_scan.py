@@ -0,0 +1,100 @@
+import asyncio
+import socket
+from types import SimpleNamespace
+
+import pytest
+
+from flag_slurper.autolib import scan
+
+
+@pytest.fixture
+def listener():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen()
+    yield sock.getsockname()[1]
+    sock.close()
+
+
+@pytest.fixture
+def closed_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def test_is_open(listener):
+    assert asyncio.run(scan.is_open('127.0.0.1', listener, 1))
+
+
+def test_is_open_closed(closed_port):
+    assert not asyncio.run(scan.is_open('127.0.0.1', closed_port, 1))
+
+
+def test_is_open_unresolved():
+    assert not asyncio.run(scan.is_open(None, 22, 1))
+
+
+def test_scan(listener, closed_port, mocker):
+    mocker.patch('flag_slurper.autolib.scan.Governor.resolve_url', return_value='127.0.0.1')
+    services = [SimpleNamespace(id=1, service_url='shell.team1', service_port=listener),
+                SimpleNamespace(id=2, service_url='shell.team2', service_port=closed_port)]
+    assert scan.scan(services, timeout=1, concurrency=1) == {1: True, 2: False}
+
+
+def test_scan_invalid_concurrency():
+    with pytest.raises(ValueError, match='concurrency must be at least 1'):
+        scan.scan([], concurrency=0)
+
+
+@pytest.fixture
+def server():
+    """
+    A server that greets clients with the given banner, or answers HTTP if the banner is None.
+    """
+    servers = []
+
+    def _serve(banner):
+        async def _handle(reader, writer):
+            if banner is not None:
+                writer.write(banner)
+            else:
+                await reader.read(64)
+                writer.write(b'HTTP/1.0 200 OK\r\n\r\n')
+            await writer.drain()
+            writer.close()
+
+        async def _probe():
+            server = await asyncio.start_server(_handle, '127.0.0.1', 0)
+            servers.append(server)
+            async with server:
+                return await scan.probe('127.0.0.1', server.sockets[0].getsockname()[1], 0.2)
+
+        return asyncio.run(_probe())
+    return _serve
+
+
+@pytest.mark.parametrize('banner,protocol', [
+    (b'SSH-2.0-OpenSSH_7.4\r\n', 'ssh'),
+    (b'220 mail.team1 ESMTP Postfix\r\n', 'smtp'),
+    (b'220-mx.team1.isucdc.com Microsoft ESMTP MAIL Service ready\r\n', 'smtp'),
+    (b'220 (vsFTPd 3.0.3)\r\n', 'unknown'),
+    (None, 'http'),
+    (b'* OK IMAP4rev1 ready\r\n', 'unknown'),
+])
+def test_probe(server, banner, protocol):
+    assert server(banner) == protocol
+
+
+def test_probe_closed(closed_port):
+    assert asyncio.run(scan.probe('127.0.0.1', closed_port, 1)) is None
+    assert asyncio.run(scan.probe(None, 22, 1)) is None
+
+
+def test_detect(listener, mocker):
+    mocker.patch('flag_slurper.autolib.scan.Governor.resolve_url', return_value='127.0.0.1')
+    services = [SimpleNamespace(id=1, service_url='shell.team1', service_port=listener)]
+    # The listener accepts but never answers, even to HTTP
+    assert scan.detect(services, timeout=0.1, concurrency=1) == {1: 'unknown'}
@@ -1,3 +1,4 @@
+import time
 from copy import deepcopy
 
 import pytest
@@ -33,6 +34,17 @@ class TestResult:
         result = Result(service, "test message", success=False, skipped=False)
         assert result.__str__() == "1/www.team1.isucdc.com:80/http Failed pwn: test message"
 
+    def test_result_deferred__str__(self, service):
+        not_before = time.mktime((2019, 2, 16, 13, 30, 0, 0, 0, -1))
+        result = Result(service, "test message", success=False, skipped=False, not_before=not_before)
+        assert result.deferred
+        assert result.__str__() == "1/www.team1.isucdc.com:80/http Deferred pwn until 13:30:00: test message"
+
+    def test_result_timed_out__str__(self, service):
+        result = Result.timeout(service, 30)
+        assert result.timed_out
+        assert result.__str__() == "1/www.team1.isucdc.com:80/http Timed out pwn: No result within 30s"
+
     def test_result__eq__(self, service):
         result = Result(service, "test message", success=False, skipped=False)
         result2 = deepcopy(result)
@@ -54,6 +66,15 @@ def test_detect_service(service):
     assert data[2] == 80
 
 
+def test_detect_service_from_banner(invalid_service):
+    invalid_service.protocol = 'ssh'
+    assert detect_service(invalid_service)[0] == 'ssh'
+
+    # An unrecognised banner falls back to the port
+    invalid_service.protocol = 'unknown'
+    assert detect_service(invalid_service)[0] == 'unknown'
+
+
 def test_detect_unknown_service(invalid_service):
     data = detect_service(invalid_service)
     assert data[0] == 'unknown'
@@ -89,3 +110,35 @@ def test_pwn_flag_conf(service, mocker, project):
 
     result = Result(service, "service up", success=True, skipped=False)
     assert result == res
+
+
+def test_pwn_service_carries_records_when_deferred(service, mocker, project):
+    def _pwn_http(url, port, service, flag_conf, limit_creds, context):
+        context.records.dns(service.team, 'www', 'www IN A 10.0.0.1')
+        if 'resume' not in context:
+            context['not_before'] = 1234.0
+            context['resume'] = {}
+        return "service up", True, False
+
+    mocker.patch.dict(PWN_FUNCS, {'http': _pwn_http})
+    deferred = pwn_service(service, None, None, project.post(service))
+    assert deferred.deferred
+    assert len(deferred.records) == 0
+
+    res = pwn_service(service, None, None, project.post(service), resume=deferred.resume)
+    assert not res.deferred
+    assert len(res.records) == 2
+    assert 'records' in deferred.resume
+
+
+def test_pwn_service_deadline(service, mocker, project):
+    def _pwn_http(url, port, service, flag_conf, limit_creds, context):
+        assert context['deadline'] <= time.time() + 60
+        context['timed_out'] = True
+        return "Ran out of time after 0 credential(s)", False, False
+
+    mocker.patch.dict(PWN_FUNCS, {'http': _pwn_http})
+    post = mocker.patch('flag_slurper.autolib.service.registry.post')
+    res = pwn_service(service, None, None, project.post(service), deadline=60)
+    assert res.timed_out
+    assert not post.called
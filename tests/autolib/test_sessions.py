@@ -0,0 +1,43 @@
+import pytest
+
+from flag_slurper.autolib.sessions import SSHSessions
+
+
+@pytest.fixture
+def sessions():
+    return SSHSessions()
+
+
+def test_sessions_reuse(sessions, mocker):
+    client = mocker.MagicMock()
+    sessions.add('shell.team1', 22, 'root', client)
+    assert sessions.get('shell.team1', 22, 'root') is client
+    assert sessions.connect('shell.team1', 22, 'root', 'cdc') is client
+    assert sessions.get('shell.team1', 22, 'cdc') is None
+
+
+def test_sessions_drop_dead(sessions, mocker):
+    client = mocker.MagicMock()
+    client.get_transport.return_value.is_active.return_value = False
+    sessions.add('shell.team1', 22, 'root', client)
+    assert sessions.get('shell.team1', 22, 'root') is None
+    assert len(sessions) == 0
+
+
+def test_sessions_connect(sessions, mocker):
+    client = mocker.patch('flag_slurper.autolib.sessions.paramiko.SSHClient')
+    ssh = sessions.connect('shell.team1', 22, 'root', 'cdc')
+    assert ssh is client.return_value
+    ssh.connect.assert_called_with('shell.team1', port=22, username='root', password='cdc', look_for_keys=False,
+                                   allow_agent=False)
+    assert sessions.get('shell.team1', 22, 'root') is ssh
+
+
+def test_sessions_close(sessions, mocker):
+    first, second = mocker.MagicMock(), mocker.MagicMock()
+    sessions.add('shell.team1', 22, 'root', first)
+    sessions.add('shell.team1', 22, 'root', second)
+    assert first.close.called
+    sessions.close()
+    assert second.close.called
+    assert len(sessions) == 0
@@ -48,6 +48,14 @@ def test_config_request_extras_creds(config):
     assert extras['auth'] == ('testuser', 'testpass')
 
 
+def test_config_session(config):
+    session = config.session
+    assert session is config.session
+    adapter = session.get_adapter('https://iscore.iseage.org')
+    assert adapter.max_retries.total == 3
+    assert 503 in adapter.max_retries.status_forcelist
+
+
 def test_config_user(config):
     with mock.patch('flag_slurper.utils.get_user') as get_user:
         user = User({
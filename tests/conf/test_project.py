@@ -1,6 +1,7 @@
 import pytest
 from schema import SchemaMissingKeyError, SchemaUnexpectedTypeError, SchemaError
 
+from flag_slurper.autolib.governor import Governor
 from flag_slurper.conf import Project
 from flag_slurper.conf.project import project_schema, detect_version, project_schema_v1_0
 
@@ -398,3 +399,11 @@ def test_project_post_command(create_project, service):
             },
         },
     ]
+
+
+def test_project_connect_database_configures_governor_store(basic_project, mocker):
+    mocker.patch('flag_slurper.conf.project.models.initialize')
+    basic_project.connect_database()
+    gov = Governor.get_instance()
+    assert gov.store.path == str(basic_project.base / 'governor.sqlite3')
+    gov.store = None
@@ -12,7 +12,17 @@ from flag_slurper.conf import Project
 from flag_slurper.conf.config import Config
 
 MODELS = [models.Service, models.Credential, models.CredentialBag, models.Team, models.Flag, models.CaptureNote,
-          models.File, models.DNSResult, models.Key, models.ShadowEntry]
+          models.File, models.DNSResult, models.Key, models.ShadowEntry, models.ServiceSchedule,
+          models.ServiceStatus]
+
+
+@pytest.fixture(autouse=True)
+def reset_project():
+    """
+    Unload the project after each test, so cached IScorE responses don't leak into the next test.
+    """
+    yield
+    Project.instance = None
 
 
 @pytest.fixture
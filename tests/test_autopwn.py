@@ -1,8 +1,13 @@
+import json
+from datetime import datetime, timedelta
+
 import pytest
 import vcr
 from click.testing import CliRunner
 
-from flag_slurper.autolib.models import Team
+from flag_slurper.autolib import priority, records
+from flag_slurper.autolib.models import Credential, CredentialBag, Service, ServiceSchedule, ServiceStatus, Team
+from flag_slurper.autolib.service import Result
 from flag_slurper.cli import cli
 from flag_slurper.conf import Config
 from flag_slurper.conf.project import Project
@@ -40,9 +45,10 @@ def test_autopwn_no_project():
 def test_autopwn_pwn_limit_team(pwn_project, mocker, service):
     runner = CliRunner()
     pwn_service = mocker.patch('flag_slurper.autopwn._pwn_service')
-    result = runner.invoke(cli, ['autopwn', 'pwn', '-t', service.team.number])
+    pwn_service.return_value.deferred = False
+    result = runner.invoke(cli, ['autopwn', 'pwn', '--no-scan', '-t', service.team.number])
     assert result.exit_code == 0
-    pwn_service.assert_called_with((), service)
+    pwn_service.assert_called_with((), service, incremental=False, priority=False, deadline=300)
 
 
 def test_autopwn_pwn_limit_service(pwn_project, mocker):
@@ -53,6 +59,34 @@ def test_autopwn_pwn_limit_service(pwn_project, mocker):
     pwn_service.assert_not_called()
 
 
+def test_autopwn_pwn_skips_down_services(pwn_project, mocker, service):
+    runner = CliRunner()
+    pwn_service = mocker.patch('flag_slurper.autopwn._pwn_service')
+    scan = mocker.patch('flag_slurper.autopwn.scanner.scan', return_value={service.id: False})
+    result = runner.invoke(cli, ['autopwn', 'pwn', '--scan', '-v'])
+    assert result.exit_code == 0
+    assert scan.called
+    pwn_service.assert_not_called()
+    assert '0 of 1 service(s) are up' in result.output
+    assert not ServiceStatus.get(ServiceStatus.service == service).up
+
+
+def test_autopwn_pwn_detects_protocols(pwn_project, mocker, service):
+    runner = CliRunner()
+    pwn_service = mocker.patch('flag_slurper.autopwn._pwn_service')
+    pwn_service.return_value.deferred = False
+    detect = mocker.patch('flag_slurper.autopwn.scanner.detect', return_value={service.id: 'ssh'})
+    result = runner.invoke(cli, ['autopwn', 'pwn', '--no-scan'])
+    assert result.exit_code == 0
+    assert Service.get_by_id(service.id).protocol == 'ssh'
+
+    # Detected protocols are remembered
+    detect.reset_mock()
+    result = runner.invoke(cli, ['autopwn', 'pwn', '--no-scan'])
+    assert result.exit_code == 0
+    assert not detect.called
+
+
 def test_autopwn_pwn_random(pwn_project, mocker):
     runner = CliRunner()
     mocker.patch('flag_slurper.autopwn._pwn_service')
@@ -63,6 +97,21 @@ def test_autopwn_pwn_random(pwn_project, mocker):
     random.assert_called()
 
 
+def test_autopwn_pwn_summary_json(pwn_project, mocker, service):
+    bag = CredentialBag.create(username='root', password='cdc')
+    Credential.create(bag=bag, service=service, state=Credential.WORKS)
+    pwn_service = mocker.patch('flag_slurper.autopwn._pwn_service')
+    pwn_service.return_value.deferred = False
+    runner = CliRunner(mix_stderr=False)
+
+    result = runner.invoke(cli, ['autopwn', 'pwn', '--no-scan', '-c', 'root', '--summary-format', 'json'])
+
+    assert result.exit_code == 0
+    assert 'Starting AutoPWN' in result.stderr
+    summary = json.loads(result.stdout)
+    assert summary == [{'username': 'root', 'password': 'cdc', 'hits': [{'team': 1, 'service': 'WWW HTTP'}]}]
+
+
 @vcr.use_cassette('fixtures/autopwn_generate.yaml')
 def test_autopwn_generate(pwn_project):
     _clear_teams()
@@ -86,6 +135,98 @@ def test_autopwn_generate_ignore_guest(pwn_project, custom_config):
     assert Team.select().count() == 18
 
 
+@vcr.use_cassette('fixtures/autopwn_generate.yaml')
+def test_autopwn_generate_reconcile(pwn_project):
+    _clear_teams()
+    Team.create(id=9999, name='Old Team', number=99, domain='team99.isucdc.com')
+    runner = CliRunner()
+
+    result = runner.invoke(cli, ['autopwn', 'generate', '--reconcile'])
+
+    assert result.exit_code == 0
+    assert 'Reconciled, removed teams: 1' in result.output
+    assert not Team.select().where(Team.id == 9999).exists()
+    assert Team.select().count() == 18
+
+
+def test_autopwn_generate_reconcile_no_services(pwn_project, mocker):
+    team = {'id': 9998, 'number': 98, 'name': 'CDC Team 98', 'team_url': 'team98.isucdc.com', 'guest_division': False}
+    mocker.patch('flag_slurper.autopwn.utils.fetch_all', return_value=([team], []))
+    reconcile = mocker.patch('flag_slurper.autopwn.roster.reconcile')
+    mocker.patch('flag_slurper.autopwn.roster.import_teams', return_value=(0, 0))
+    mocker.patch('flag_slurper.autopwn.roster.import_services', return_value=(0, 0))
+    runner = CliRunner()
+
+    result = runner.invoke(cli, ['autopwn', 'generate', '--reconcile'])
+
+    assert result.exit_code == 0
+    assert 'IScorE returned no services, not reconciling' in result.output
+    assert not reconcile.called
+
+
 def _clear_teams():
     for team in Team.select():
         team.delete_instance()
+
+
+def test_autopwn_pwn_async_engine(pwn_project, mocker, service):
+    runner = CliRunner()
+    run_async = mocker.patch('flag_slurper.autopwn.engines.run_async')
+    result = runner.invoke(cli, ['autopwn', 'pwn', '-P', '-e', 'async', '-C', '8'])
+    assert result.exit_code == 0
+    assert run_async.called
+    assert run_async.call_args[0][3] == 8
+
+
+def test_autopwn_daemon_reschedules(pwn_project, mocker, service):
+    interval = mocker.patch('flag_slurper.autopwn.engines.Recheck.interval', return_value=0)
+    runner = CliRunner()
+    pwn_service = mocker.patch('flag_slurper.autopwn._pwn_service')
+    pwn_service.side_effect = [Result(service, 'Authentication failed', success=False, skipped=False),
+                               Result(service, 'Found credentials', success=True, skipped=False),
+                               KeyboardInterrupt()]
+    result = runner.invoke(cli, ['autopwn', 'daemon', '-t', service.team.number])
+    assert result.exit_code == 0
+    assert pwn_service.call_count == 3
+    assert 'Stopping AutoPWN daemon' in result.output
+    assert interval.call_args[0][1:] == (0, False)
+
+    schedule = ServiceSchedule.get(ServiceSchedule.service == service)
+    assert schedule.success
+    assert schedule.interval == 0
+
+
+def test_autopwn_daemon_survives_errors(pwn_project, mocker, service):
+    mocker.patch('flag_slurper.autopwn.engines.Recheck.interval', return_value=0)
+    flush = mocker.spy(records.RecordWriter, 'flush')
+    runner = CliRunner()
+    pwn_service = mocker.patch('flag_slurper.autopwn._pwn_service')
+    pwn_service.side_effect = [RuntimeError('plugin exploded'), KeyboardInterrupt()]
+    result = runner.invoke(cli, ['autopwn', 'daemon', '-t', service.team.number])
+    assert result.exit_code == 0
+    assert pwn_service.call_count == 2
+    assert 'plugin exploded' in result.output
+    # Flushed after the result, not just when the daemon stopped
+    assert flush.call_count == 2
+    assert ServiceSchedule.get(ServiceSchedule.service == service).success is False
+
+
+def test_autopwn_daemon_resumes_schedule(pwn_project, mocker, service):
+    next_check = datetime.now() + timedelta(minutes=5)
+    ServiceSchedule.create(service=service, next_check=next_check, interval=300, success=False)
+    runner = CliRunner()
+    run_serial = mocker.patch('flag_slurper.autopwn.engines.run_serial')
+    result = runner.invoke(cli, ['autopwn', 'daemon'])
+    assert result.exit_code == 0
+    assert run_serial.call_args[0][3] == {service.id: next_check.timestamp()}
+
+
+def test_autopwn_pwn_priority(pwn_project, mocker, service):
+    runner = CliRunner()
+    pwn_service = mocker.patch('flag_slurper.autopwn._pwn_service')
+    pwn_service.return_value.deferred = False
+    rank = mocker.spy(priority, 'rank_services')
+    result = runner.invoke(cli, ['autopwn', 'pwn', '--no-scan', '-o', 'priority'])
+    assert result.exit_code == 0
+    assert rank.called
+    pwn_service.assert_called_with((), service, incremental=False, priority=True, deadline=300)
@@ -0,0 +1,103 @@
+import pytest
+import requests
+import responses
+
+from flag_slurper.cache import CacheMiss, ResponseCache
+
+URL = 'https://iscore.iseage.org/api/v1/teams.json'
+
+
+@pytest.fixture
+def clock():
+    now = [1000.0]
+
+    def _clock():
+        return now[0]
+    _clock.now = now
+    return _clock
+
+
+@pytest.fixture
+def cache(tmpdir, clock):
+    return ResponseCache(tmpdir.join('api_cache'), ttl=60, clock=clock)
+
+
+@responses.activate
+def test_cache_within_ttl(cache, clock):
+    responses.add(responses.GET, URL, json=[{'number': 1}], headers={'ETag': '"abc"'})
+    session = requests.Session()
+    assert cache.get(session, URL).json() == [{'number': 1}]
+    clock.now[0] += 30
+    assert cache.get(session, URL).json() == [{'number': 1}]
+    assert len(responses.calls) == 1
+
+
+@responses.activate
+def test_cache_revalidates(cache, clock):
+    responses.add(responses.GET, URL, json=[{'number': 1}], headers={'ETag': '"abc"', 'Last-Modified': 'yesterday'})
+    responses.add(responses.GET, URL, status=304)
+    session = requests.Session()
+    cache.get(session, URL)
+    clock.now[0] += 120
+    assert cache.get(session, URL).json() == [{'number': 1}]
+    assert responses.calls[1].request.headers['If-None-Match'] == '"abc"'
+    assert responses.calls[1].request.headers['If-Modified-Since'] == 'yesterday'
+
+    # The 304 refreshed the cached response
+    clock.now[0] += 30
+    cache.get(session, URL)
+    assert len(responses.calls) == 2
+
+
+@responses.activate
+def test_cache_stale_on_server_error(cache, clock):
+    responses.add(responses.GET, URL, json=[{'number': 1}])
+    responses.add(responses.GET, URL, status=503)
+    session = requests.Session()
+    cache.get(session, URL)
+    clock.now[0] += 120
+    resp = cache.get(session, URL)
+    assert resp.status_code == 200
+    assert resp.json() == [{'number': 1}]
+
+
+@responses.activate
+def test_cache_stale_on_connection_error(cache, clock):
+    responses.add(responses.GET, URL, json=[{'number': 1}])
+    responses.add(responses.GET, URL, body=requests.exceptions.ConnectionError())
+    session = requests.Session()
+    cache.get(session, URL)
+    clock.now[0] += 120
+    assert cache.get(session, URL).json() == [{'number': 1}]
+
+
+@responses.activate
+def test_cache_by_identity(cache):
+    responses.add(responses.GET, URL, json=[{'number': 1}])
+    responses.add(responses.GET, URL, json=[{'number': 2}])
+    session = requests.Session()
+    assert cache.get(session, URL, headers={'Authorization': 'Token A'}).json() == [{'number': 1}]
+    assert cache.get(session, URL, headers={'Authorization': 'Token B'}).json() == [{'number': 2}]
+
+
+@responses.activate
+def test_cache_errors_not_cached(cache):
+    responses.add(responses.GET, URL, status=403)
+    responses.add(responses.GET, URL, json=[])
+    session = requests.Session()
+    assert cache.get(session, URL).status_code == 403
+    assert cache.get(session, URL).status_code == 200
+
+
+@responses.activate
+def test_cache_offline(cache, tmpdir, clock):
+    responses.add(responses.GET, URL, json=[{'number': 1}])
+    session = requests.Session()
+    offline = ResponseCache(tmpdir.join('api_cache'), ttl=60, offline=True, clock=clock)
+    with pytest.raises(CacheMiss):
+        offline.get(session, URL)
+
+    cache.get(session, URL)
+    clock.now[0] += 3600
+    assert offline.get(session, URL).json() == [{'number': 1}]
+    assert len(responses.calls) == 1
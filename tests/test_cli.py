@@ -133,7 +133,7 @@ def test_cli_load_project_append_file(mocker, dummy_cmd, tmpdir):
     assert project.load.called_with(str(tmpdir.join('project.yml')))
 
 
-def test_cli_dbshell(mocker):
+def test_cli_dbshell(mocker, basic_project):
     prompt = mocker.patch('flag_slurper.conf.config.prompt')
     prompt.side_effect = ['ABC', '']
     click = mocker.patch('flag_slurper.cli.click.prompt')
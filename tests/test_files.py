@@ -81,6 +81,21 @@ def test_show_file(found_file, mocker, files_project):
     assert found_file.service.service_name in result.output
 
 
+def test_show_file_detects_type(found_file, mocker, files_project):
+    found_file.info = None
+    found_file.mime_type = None
+    found_file.save()
+    mocker.patch('flag_slurper.files.click.edit')
+    runner = CliRunner()
+    result = runner.invoke(cli, ['-p', files_project, 'files', 'show', str(found_file.id)])
+    assert result.exit_code == 0
+    assert 'ASCII text' in result.output
+
+    found_file = File.get(File.id == found_file.id)
+    assert found_file.info == 'ASCII text'
+    assert found_file.mime_type == 'text/plain; charset=us-ascii'
+
+
 def test_get_file(found_file, tmpdir, files_project):
     file = tmpdir.join('testfile')
     runner = CliRunner()
@@ -1,7 +1,9 @@
+from datetime import datetime
+
 import pytest
 from click.testing import CliRunner
 
-from flag_slurper.autolib.models import Service, Team
+from flag_slurper.autolib.models import Service, ServiceStatus, Team
 from flag_slurper.cli import cli
 from flag_slurper.conf.project import Project
 
@@ -34,6 +36,15 @@ def test_list_services(service, services_project):
     assert service.service_name in result.output
 
 
+def test_list_services_liveness(service, services_project):
+    ServiceStatus.create(service=service, up=False, checked=datetime.now())
+    runner = CliRunner()
+    result = runner.invoke(cli, ['-p', services_project, 'services', 'ls'])
+    assert result.exit_code == 0
+    assert 'Up?' in result.output
+    assert '| no ' in result.output
+
+
 def test_list_service_team(service, services_project):
     runner = CliRunner()
     result = runner.invoke(cli, ['-p', services_project, 'services', 'ls', '-t', service.team.number])
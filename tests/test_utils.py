@@ -3,6 +3,7 @@ import zipfile
 
 import click
 import pytest
+import responses
 import vcr
 from click.testing import CliRunner
 from hypothesis import given, assume
@@ -164,6 +165,26 @@ def test_get_teams(config):
 
 
 
+@responses.activate
+def test_api_get_shares_session(config, mocker):
+    responses.add(responses.GET, 'https://iscore.iseage.org/api/v1/teams.json', status=200, json=[{'number': 1}])
+    get = mocker.spy(config.session, 'get')
+    assert utils.get_teams() == [{'number': 1}]
+    assert utils.get_teams() == [{'number': 1}]
+    assert get.call_count == 2
+    assert get.call_args[1]['timeout'] == 30
+
+
+def test_api_get_offline_without_project(config):
+    config['iscore']['offline'] = 'true'
+    with pytest.raises(utils.CacheMiss):
+        utils.api_get('https://iscore.iseage.org/api/v1/teams.json')
+
+
+def test_fetch_all():
+    assert utils.fetch_all(lambda: 1, lambda: 2, lambda: 3) == [1, 2, 3]
+
+
 @pytest.mark.parametrize('given,expected', (
     ('root', ('root', None)),
     ('root:cdc', ('root', 'cdc')),